@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from enums import MotionState, TargetMode
+from ordering import move_time
+
+
+def speed_for_duration(distance, duration, max_speed, start_speed, acceleration):
+    # Lowest top speed, at most max_speed, that still covers distance within
+    # duration. Move time falls with top speed, so bisect.
+    def duration_at(speed):
+        return float(move_time(distance, speed, start_speed, acceleration))
+
+    low, high = start_speed, max_speed
+    if duration_at(high) >= duration:
+        return high
+    for i in range(50):
+        mid = (low + high) / 2
+        if duration_at(mid) > duration:
+            low = mid
+        else:
+            high = mid
+    return high
+
+
+class AxisGroup(object):
+    # Named axes, each with its own controller and motor. Polling runs the
+    # controllers concurrently, so the USB transfers of the axes overlap
+    # instead of adding up; pyusb releases the GIL while it waits.
+    def __init__(self, controllers: dict, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controllers = controllers
+        self.pool = ThreadPoolExecutor(
+            max_workers=len(controllers), thread_name_prefix='axis')
+
+
+    def run_all(self, func, names=None):
+        # Calls func(name, controller) for the named axes, or all,
+        # concurrently
+        names = list(self.controllers) if names is None else names
+        if len(names) == 1:
+            return [func(names[0], self.controllers[names[0]])]
+        futures = [self.pool.submit(func, n, self.controllers[n]) for n in names]
+        return [f.result() for f in futures]
+
+
+    def event_periodic(self):
+        self.run_all(lambda name, ctrl: ctrl.event_periodic())
+
+
+    def is_moving(self):
+        moving_states = [MotionState.MOVING, MotionState.STOPPING]
+        return any(c.get_motion_state() in moving_states
+                   for c in self.controllers.values())
+
+
+    def plan_speeds(self, names):
+        # Speeds making the moves of the named axes, each at most at its set
+        # speed, take as long as the slowest one
+        plans = {}
+        for name in names:
+            ctrl = self.controllers[name]
+            distance = abs(ctrl.target_reg - ctrl.position_reg) / ctrl.steps_per_deg
+            plans[name] = distance, ctrl.speed, ctrl.config
+        durations = [
+            float(move_time(d, speed, config.start_speed, config.acceleration))
+            for d, speed, config in plans.values()
+        ]
+        duration = max(durations, default=0.0)
+
+        speeds = {}
+        for name, (distance, speed, config) in plans.items():
+            speed = speed_for_duration(
+                distance, duration, speed, config.start_speed,
+                config.acceleration)
+            # A move too short to stretch to the duration with the lowest
+            # speed finishes early
+            speeds[name] = max(speed, self.controllers[name].min_speed)
+        return speeds
+
+
+    def event_start_stop(self):
+        # Stops all axes if any is moving, otherwise starts all axes that
+        # are ready to move together, finishing together
+        if self.is_moving():
+            self.run_all(lambda name, ctrl: ctrl.event_start_stop())
+            return
+        names = [n for n, c in self.controllers.items()
+                 if c.get_motion_state() == MotionState.READY_TO_MOVE]
+        if not names:
+            return
+        speeds = self.plan_speeds(names)
+        self.run_all(lambda name, ctrl: ctrl.event_start_stop(speeds[name]), names)
+
+
+    def coordinated_move(self, angles: dict):
+        # Moves the named axes to absolute angles, starting and finishing
+        # together
+        for name, angle in angles.items():
+            ctrl = self.controllers[name]
+            if ctrl.get_target_mode() != TargetMode.ABSOLUTE:
+                ctrl.event_target_mode_set(TargetMode.ABSOLUTE)
+            ctrl.event_target_set(angle)
+        self.event_start_stop()
+
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,113 @@
+# Motor backends, selected by the backend key of the Motor section. A
+# backend is a factory called as factory(config, **options) returning a
+# Motor; options a backend does not use are ignored. Backends import their
+# driver modules when called, so only the selected one is loaded.
+#
+# Other packages add backends through entry points in this group, e.g. in
+# pyproject.toml:
+#   [project.entry-points."rotary.motor_backends"]
+#   grbl = "rotary_grbl:make_motor"
+entry_point_group = 'rotary.motor_backends'
+
+
+# The home switch of the fake motor, in degrees from where it starts
+fake_home_switch_angle = 30.0
+fake_home_switch_width = 0.5
+
+
+def fake_backend(config, clock=None, **options):
+    from motor import FakeMotor
+    kwargs = {}
+    if clock is not None:
+        kwargs['clock'] = clock
+    if config is not None:
+        steps_per_deg = config.steps_per_rev / 360
+        kwargs['home_switch'] = (
+            round(fake_home_switch_angle * steps_per_deg),
+            max(1, round(fake_home_switch_width * steps_per_deg)),
+            config.steps_per_rev,
+        )
+    return FakeMotor(**kwargs)
+
+
+def pololu_backend(config, stats=None, keepalive_timeout=None,
+                   serial_number=None, open_device=None, retain_position=False,
+                   **options):
+    from motor import PololuT249
+    home_switch = 'reverse'
+    if config is not None:
+        if serial_number is None:
+            serial_number = config.serial_number
+        home_switch = config.home_switch
+    return PololuT249(
+        stats=stats,
+        keepalive_timeout=keepalive_timeout,
+        serial_number=serial_number,
+        open_device=open_device,
+        home_switch=home_switch,
+        retain_position=retain_position,
+    )
+
+
+def pololu_serial_backend(config, port=None, baudrate=None, **options):
+    # Keys of the Motor section: port, baudrate, device_number (Pololu
+    # protocol, leave out for the compact protocol)
+    from tictransport import open_serial_tic
+    device_number = None
+    if config is not None:
+        section = config.motor_section
+        port = port or section.get('port')
+        baudrate = baudrate or section.getint('baudrate', fallback=None)
+        device_number = section.getint('device_number', fallback=None)
+    if port is None:
+        raise RuntimeError('pololu-serial backend needs a port')
+    baudrate = baudrate or 115200
+    open_device = open_serial_tic(port, baudrate, device_number)
+    return pololu_backend(config, open_device=open_device, **options)
+
+
+def emulated_backend(config, **options):
+    from ticemu import EmulatedBus, EmulatedTic
+    kwargs = {}
+    if config is not None:
+        kwargs['command_timeout'] = config.command_timeout
+        if config.serial_number is not None:
+            kwargs['serial_number'] = config.serial_number
+    device = EmulatedTic(**kwargs)
+    options['open_device'] = EmulatedBus([device]).open
+    options['serial_number'] = device.serial_number
+    return pololu_backend(config, **options)
+
+
+builtin_backends = {
+    'fake': fake_backend,
+    'pololu': pololu_backend,
+    'pololu-serial': pololu_serial_backend,
+    'emulated': emulated_backend,
+}
+
+
+def discovered_backends():
+    # Entry points are only listed here, not loaded. importlib.metadata is
+    # slow to import, it is only needed once a backend is looked up.
+    from importlib import metadata
+    return {ep.name: ep for ep in metadata.entry_points(group=entry_point_group)}
+
+
+def backend_names():
+    return sorted(set(builtin_backends) | set(discovered_backends()))
+
+
+def get_backend(name):
+    if name in builtin_backends:
+        return builtin_backends[name]
+    entry_points = discovered_backends()
+    if name not in entry_points:
+        raise ValueError(
+            f'unknown motor backend {name}, '
+            f'available: {", ".join(backend_names())}')
+    return entry_points[name].load()
+
+
+def create_motor(name, config, **options):
+    return get_backend(name)(config, **options)
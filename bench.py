@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+from configuration import Configuration
+from enums import TargetMode
+from motion import MotionController
+from motor import FakeMotor
+
+
+benchmarks = {}
+
+
+def benchmark(name):
+    # Registers a setup function, which returns the callable to be timed
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+def make_controller(config, motor=None):
+    return MotionController(motor or FakeMotor(), config)
+
+
+def moving_controller(config, motor=None):
+    # A controller in the middle of a long, slow move
+    ctrl = make_controller(config, motor)
+    ctrl.event_power()
+    ctrl.event_speed_set(ctrl.min_speed)
+    ctrl.event_target_mode_set(TargetMode.RELATIVE)
+    ctrl.event_target_set(360 * 100)
+    ctrl.event_start_stop()
+    ctrl.event_periodic()
+    return ctrl
+
+
+@benchmark('controller.event_target_set')
+def bench_event_target_set(config):
+    ctrl = make_controller(config)
+    targets = [i * 0.5 for i in range(720)]
+    state = {'i': 0}
+
+    def run():
+        i = state['i'] = (state['i'] + 1) % len(targets)
+        ctrl.event_target_set(targets[i])
+    return run
+
+
+@benchmark('controller.event_division_set.36000')
+def bench_event_division_set(config):
+    ctrl = make_controller(config)
+    ctrl.event_target_mode_set(TargetMode.DIVISION)
+    return lambda: ctrl.event_division_set(36000, 0, 360)
+
+
+@benchmark('controller.calculate_target_reg.division')
+def bench_calculate_target_reg(config):
+    ctrl = make_controller(config)
+    ctrl.event_target_mode_set(TargetMode.DIVISION)
+    ctrl.event_division_set(36000, 0, 360)
+    ctrl.event_target_set(12345)
+    return ctrl.calculate_target_reg
+
+
+@benchmark('controller.evaluate_state_transition.moving')
+def bench_evaluate_state_transition(config):
+    ctrl = moving_controller(config)
+    return ctrl.evaluate_state_transition
+
+
+@benchmark('controller.state_machine.step.moving')
+def bench_state_machine_step(config):
+    ctrl = moving_controller(config)
+    machine = ctrl.machine
+    return lambda: machine.step(ctrl)
+
+
+@benchmark('controller.state_machine.transition')
+def bench_state_machine_transition(config):
+    # A transition with its counters, dwell time and exit and entry actions
+    ctrl = make_controller(config)
+    machine = ctrl.machine
+
+    def run():
+        ctrl.motor_energized = not ctrl.motor_energized
+        machine.step(ctrl)
+    ctrl.motor_connected = True
+    ctrl.motor_energized = False
+    ctrl.motor_stationary = True
+    ctrl.motor_stopping = False
+    return run
+
+
+@benchmark('controller.event_periodic.moving')
+def bench_event_periodic(config):
+    ctrl = moving_controller(config)
+    return ctrl.event_periodic
+
+
+@benchmark('motor.fake.update_state.moving')
+def bench_fake_update_state(config):
+    ctrl = moving_controller(config)
+    return ctrl.motor.update_state
+
+
+# Modelled duration of a Tic USB control transfer. The real figure depends
+# on the host controller, rotary.py --usb-stats measures it.
+usb_transfer_time = 0.001
+
+
+def pololu_benchmark(transport):
+    # A controller tick against an emulated Tic, over USB or a serial port
+    # at 115200 baud
+    def setup(config):
+        import contextlib
+        import io
+        from motor import PololuT249
+        from ticemu import EmulatedBus, EmulatedTic, SerialTicEmulator
+        from tictransport import open_serial_tic
+
+        device = EmulatedTic(command_timeout=config.command_timeout)
+        if transport == 'serial':
+            emulator = SerialTicEmulator(device)
+            open_device = open_serial_tic(emulator.port, device_number=14)
+        else:
+            open_device = EmulatedBus([device], usb_transfer_time).open
+        with contextlib.redirect_stdout(io.StringIO()):
+            motor = PololuT249(open_device=open_device)
+            ctrl = moving_controller(config, motor)
+        return ctrl.event_periodic
+    return setup
+
+
+for transport in ['usb', 'serial']:
+    benchmark(f'controller.event_periodic.pololu.{transport}')(pololu_benchmark(transport))
+
+
+qt_apps = []
+
+
+def qt_app():
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    if not qt_apps:
+        # The application must outlive all widgets
+        qt_apps.append(QApplication(sys.argv[:1]))
+    return qt_apps[0]
+
+
+@benchmark('presenter.timeout.moving')
+def bench_presenter_timeout(config):
+    qt_app()
+    from ui import MainWindow
+    from presenter import Presenter
+
+    ui = MainWindow()
+    ctrl = moving_controller(config)
+    pres = Presenter(ctrl, ui)
+    pres.timer.stop()
+    return pres.timeout
+
+
+def paint_benchmark(num_divs):
+    def setup(config):
+        qt_app()
+        from PyQt5.QtGui import QImage
+        from ui import PositionWidget
+        from motion import calculate_divs
+
+        widget = PositionWidget()
+        widget.resize(400, 400)
+        if num_divs:
+            widget.set_targets(calculate_divs(num_divs, 0, 360))
+        widget.set_current_target(90.0)
+        widget.set_position(45.0)
+        image = QImage(400, 400, QImage.Format_ARGB32_Premultiplied)
+        return lambda: widget.render(image)
+    return setup
+
+
+for n in [0, 24, 360, 3600, 36000]:
+    benchmark(f'ui.position_widget.paint.{n}')(paint_benchmark(n))
+
+
+def measure(func, repeat=5, min_time=0.2):
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    times = timer.repeat(repeat, number)
+    per_call = [t / number for t in times]
+    return {
+        'best_us': min(per_call) * 1e6,
+        'mean_us': sum(per_call) / len(per_call) * 1e6,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(config, selected=None, repeat=5, min_time=0.2):
+    results = {}
+    for name, setup in benchmarks.items():
+        if selected and not any(s in name for s in selected):
+            continue
+        func = setup(config)
+        results[name] = measure(func, repeat, min_time)
+        print(f'{name:50} {results[name]["best_us"]:12.2f} us')
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the names of benchmarks slower than the baseline by more than
+    # threshold, as a fraction
+    regressions = []
+    print()
+    print(f'{"benchmark":50} {"baseline":>12} {"current":>12} {"change":>8}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['best_us']
+        new = result['best_us']
+        change = (new - old) / old
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:50} {old:12.2f} {new:12.2f} {change * 100:+7.1f}%{flag}')
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser('bench')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('-o', '--output', help='write results as JSON')
+    p.add_argument('-b', '--baseline', help='compare with results from JSON file')
+    p.add_argument('-t', '--threshold', type=float, default=0.2, help='allowed slowdown against baseline, as a fraction')
+    p.add_argument('-r', '--repeat', type=int, default=5, help='repetitions per benchmark')
+    p.add_argument('-k', '--select', action='append', help='only run benchmarks containing this string')
+    p.add_argument('-l', '--list', action='store_true', help='list benchmarks')
+    args = p.parse_args()
+
+    if args.list:
+        for name in benchmarks:
+            print(name)
+        return 0
+
+    config = Configuration(args.config)
+    results = run(config, args.select, args.repeat)
+
+    if args.output:
+        report = {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmark(s) regressed')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
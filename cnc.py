@@ -0,0 +1,228 @@
+import re
+import time
+
+from enums import MotionState, TargetMode
+from motion import MotionController
+
+
+def open_serial_port(device, baudrate=115200):
+    import serial
+    return serial.Serial(device, baudrate, timeout=0)
+
+
+class CncInterface(object):
+    # Supported commands, one per line:
+    #   G0 A<angle> [F<speed>]  move to absolute angle, speed in degrees / min
+    #   M100                    index to the next division
+    #   M101                    handshake, answered with 'done' once idle
+    #   M102                    report the latency from receiving a move
+    #                           to commanding it to the motor
+    #   M103                    cut done, continues a job waiting for it
+    #   M104                    pause the job, a move in progress completes
+    #   M105                    resume the job
+    #   M106 P<step>            restart the job at step, starting at 1
+    # Every accepted line is answered with 'ok', rejected lines with
+    # 'error: <reason>'. Moves are answered with 'done' when they complete,
+    # as soon as the controller sees the motor come to rest.
+    word_re = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+
+    index_next_code = 100
+    handshake_code = 101
+    latency_code = 102
+    cut_done_code = 103
+    job_pause_code = 104
+    job_resume_code = 105
+    job_restart_code = 106
+
+    def __init__(self, controller: MotionController, port, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controller = controller
+        self.port = port
+        self.buffer = b''
+
+        self.done_pending = 0
+        # A move has been commanded, the motor has not been seen moving yet
+        self.move_commanded = False
+        self.job = None
+
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+        controller.attach_state_listener(self.event_state_changed)
+
+
+    def attach_job(self, job):
+        self.job = job
+
+
+    def fileno(self):
+        return self.port.fileno()
+
+
+    def event_readable(self):
+        data = self.port.read(max(self.port.in_waiting, 1))
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            line = line.decode('ascii', 'replace').strip()
+            if line:
+                self.handle_line(line, time.perf_counter())
+
+
+    def event_state_changed(self, old_state, new_state):
+        self.answer_pending()
+
+
+    def event_periodic(self):
+        # Answers a handshake held back by homing, which ends without a
+        # state change
+        self.answer_pending()
+
+
+    def answer_pending(self):
+        state = self.controller.get_motion_state()
+        if state in [MotionState.MOVING, MotionState.STOPPING]:
+            self.move_commanded = False
+
+        if not self.done_pending:
+            return
+
+        if self.controller.get_homing_phase() is not None:
+            # Stationary between homing moves is not done
+            return
+
+        if state == MotionState.IDLE:
+            reply = 'done'
+        elif state == MotionState.UNPOWERED:
+            reply = 'error: motor not energized'
+        elif state == MotionState.READY_TO_MOVE and not self.move_commanded:
+            # Stationary away from the target without a move in progress,
+            # e.g. the move was stopped by the operator
+            reply = 'error: not at target'
+        else:
+            return
+
+        # Answer the move and any handshakes waiting for it
+        for i in range(self.done_pending):
+            self.reply(reply)
+        self.done_pending = 0
+        self.move_commanded = False
+
+
+    def handle_line(self, line, received):
+        # Strip comments in parentheses or after a semicolon
+        line = re.sub(r'\(.*?\)', '', line).split(';', 1)[0].upper()
+        words = dict(self.word_re.findall(line))
+
+        try:
+            index_next = words.get('M') == str(self.index_next_code)
+            if self.done_pending and ('G' in words or index_next):
+                raise RuntimeError('busy')
+            homing = self.controller.get_homing_phase() is not None
+            if homing and ('G' in words or index_next):
+                raise RuntimeError('homing')
+
+            if 'G' in words:
+                self.command_g(words, received)
+            elif 'M' in words:
+                self.command_m(words, received)
+            elif words:
+                raise RuntimeError(f'unsupported command {line}')
+        except (RuntimeError, ValueError, IndexError) as e:
+            self.reply(f'error: {e}')
+
+
+    def command_g(self, words, received):
+        if float(words['G']) != 0:
+            raise RuntimeError(f'unsupported code G{words["G"]}')
+        if 'A' not in words:
+            raise RuntimeError('missing A word')
+
+        angle = float(words['A']) % 360
+        if 'F' in words:
+            self.controller.event_speed_set(float(words['F']) / 60)
+
+        if self.controller.get_target_mode() != TargetMode.ABSOLUTE:
+            self.controller.event_target_mode_set(TargetMode.ABSOLUTE)
+        self.controller.event_target_set(angle)
+        self.start_move(received)
+
+
+    def command_m(self, words, received):
+        code = int(float(words['M']))
+        if code == self.index_next_code:
+            if self.controller.get_target_mode() != TargetMode.DIVISION:
+                self.controller.event_target_mode_set(TargetMode.DIVISION)
+            num_divs = len(self.controller.get_divs())
+            _, index = self.controller.get_div_target()
+            self.controller.event_target_set((index + 1) % num_divs)
+            self.start_move(received)
+        elif code == self.handshake_code:
+            self.reply('ok')
+            self.done_pending += 1
+            self.answer_pending()
+        elif code == self.latency_code:
+            self.reply(self.latency_report())
+            self.reply('ok')
+        elif code == self.cut_done_code:
+            self.get_job().event_cut_done()
+            self.reply('ok')
+        elif code == self.job_pause_code:
+            self.get_job().pause()
+            self.reply('ok')
+        elif code == self.job_resume_code:
+            job = self.get_job()
+            if job.is_finished():
+                raise RuntimeError('job finished')
+            job.resume()
+            self.reply('ok')
+        elif code == self.job_restart_code:
+            if 'P' not in words:
+                raise RuntimeError('missing P word')
+            self.get_job().restart(int(float(words['P'])) - 1)
+            self.reply('ok')
+        else:
+            raise RuntimeError(f'unsupported code M{code}')
+
+
+    def get_job(self):
+        if self.job is None:
+            raise RuntimeError('no job running')
+        return self.job
+
+
+    def start_move(self, received):
+        state = self.controller.get_motion_state()
+        if state == MotionState.UNPOWERED:
+            raise RuntimeError('motor not energized')
+
+        self.reply('ok')
+        self.done_pending += 1
+        if state == MotionState.READY_TO_MOVE:
+            self.move_commanded = True
+            self.controller.event_start_stop()
+            self.record_latency(time.perf_counter() - received)
+        self.answer_pending()
+
+
+    def record_latency(self, latency):
+        self.latency_count += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+
+    def get_latency_stats(self):
+        n = self.latency_count
+        if n == 0:
+            return 0, 0.0, 0.0
+        return n, self.latency_sum / n, self.latency_max
+
+
+    def latency_report(self):
+        n, mean, peak = self.get_latency_stats()
+        return f'latency n={n} mean={mean * 1000:.1f}ms max={peak * 1000:.1f}ms'
+
+
+    def reply(self, message):
+        self.port.write(f'{message}\n'.encode('ascii'))
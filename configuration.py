@@ -1,14 +1,58 @@
 import configparser
 import os
+import struct
+
+# Settings MotionController applies to a running motor, and those changing
+# the relation between steps and angle, which needs a re-home. Changes to
+# any other setting need a restart.
+live_settings = [
+    'acceleration', 'start_speed', 'min_speed', 'max_speed', 'default_speed',
+    'max_current', 'home_seek_speed', 'home_approach_speed', 'home_backoff',
+    'home_angle', 'home_direction', 'home_max_travel', 'tracking_tolerance',
+]
+rehome_settings = ['steps_per_rev', 'microsteps']
+restart_settings = ['command_timeout', 'serial_number', 'backend', 'home_switch']
+
+# Keys of the Homing section
+homing_keys = [
+    'switch', 'direction', 'seek_speed', 'approach_speed', 'backoff',
+    'home_angle', 'max_travel',
+]
+
+
+def axis_names(filename):
+    config_obj = configparser.ConfigParser()
+    config_obj.read(filename)
+    prefix = 'Axis '
+    return [s[len(prefix):] for s in config_obj.sections() if s.startswith(prefix)]
+
 
 class Configuration:
-    def __init__(self, filename):
+    def __init__(self, filename, axis=None):
         if not os.path.isfile(filename):
             raise RuntimeError('config file cannot be found')
 
         self.config_obj = configparser.ConfigParser()
         self.config_obj.read(filename)
 
+        self.filename = filename
+        self.axis = axis
+        if axis is not None:
+            # Keys of an axis section override those of the Mechanical,
+            # Homing and Motor sections
+            if not self.config_obj.has_section('Homing'):
+                self.config_obj.add_section('Homing')
+            mech = self.config_obj['Mechanical']
+            homing = self.config_obj['Homing']
+            motor = self.config_obj['Motor']
+            for key, value in self.config_obj[f'Axis {axis}'].items():
+                if key in mech:
+                    mech[key] = value
+                elif key in homing_keys:
+                    homing[key] = value
+                else:
+                    motor[key] = value
+
         self.populate_config()
 
     def populate_config(self):
@@ -26,3 +70,118 @@ class Configuration:
         self.max_speed = motor.getfloat('max_speed')
         self.default_speed = motor.getfloat('default_speed')
         self.acceleration = motor.getfloat('acceleration')
+        self.command_timeout = motor.getfloat('command_timeout', fallback=1.0)
+        self.tracking_tolerance = motor.getfloat('tracking_tolerance', fallback=0.5)
+        self.serial_number = motor.get('serial_number')
+        self.backend = motor.get('backend', fallback='pololu')
+        # Backends read their own keys
+        self.motor_section = motor
+
+        # Homing, the section is optional
+        if not self.config_obj.has_section('Homing'):
+            self.config_obj.add_section('Homing')
+        homing = self.config_obj['Homing']
+        self.home_seek_speed = homing.getfloat('seek_speed', fallback=10.0)
+        self.home_approach_speed = homing.getfloat('approach_speed', fallback=0.5)
+        self.home_backoff = homing.getfloat('backoff', fallback=2.0)
+        self.home_angle = homing.getfloat('home_angle', fallback=0.0)
+        self.home_direction = homing.get('direction', fallback='ccw').lower()
+        self.home_max_travel = homing.getfloat('max_travel', fallback=370.0)
+        self.home_switch = homing.get('switch', fallback='reverse').lower()
+
+    def reload(self):
+        # The configuration as now in the file. Unlike at startup, settings
+        # a running controller could not work with are rejected.
+        config = Configuration(self.filename, self.axis)
+        config.validate()
+        return config
+
+    def validate(self):
+        problems = []
+        for name in ['start_speed', 'min_speed', 'max_speed', 'default_speed',
+                     'acceleration', 'max_current', 'command_timeout',
+                     'tracking_tolerance', 'home_seek_speed', 'home_approach_speed', 'home_backoff',
+                     'home_max_travel']:
+            if getattr(self, name) <= 0:
+                problems.append(f'{name} must be positive')
+        if not self.min_speed <= self.default_speed <= self.max_speed:
+            problems.append('default_speed must be between min_speed and max_speed')
+        if self.start_speed > self.min_speed:
+            problems.append('start_speed must not exceed min_speed')
+        if self.start_speed > self.home_approach_speed:
+            problems.append('start_speed must not exceed home_approach_speed')
+        if self.home_direction not in ['cw', 'ccw']:
+            problems.append('homing direction must be cw or ccw')
+        if problems:
+            raise ValueError(', '.join(problems))
+
+    def changed_settings(self, other):
+        settings = live_settings + rehome_settings + restart_settings
+        changed = [n for n in settings if getattr(self, n) != getattr(other, n)]
+        # Keys only read by the motor backend, e.g. port
+        own = dict(self.motor_section)
+        new = dict(other.motor_section)
+        for key in sorted(set(own) | set(new)):
+            if key not in known_motor_keys and own.get(key) != new.get(key):
+                changed.append(key)
+        return changed
+
+
+# Keys of the Motor section read by Configuration itself
+known_motor_keys = [
+    'fullsteps_per_rev', 'microsteps_per_fullstep', 'max_current',
+    'start_speed', 'min_speed', 'max_speed', 'default_speed', 'acceleration',
+    'command_timeout', 'tracking_tolerance', 'serial_number', 'backend',
+]
+
+
+class ConfigWatcher(object):
+    # Reports changes to a configuration file through inotify, without
+    # polling. fileno() becomes readable on a change, read_changed() then
+    # tells whether the file itself changed. The directory is watched, as
+    # editors often save by writing a new file and renaming it.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    event_format = struct.Struct('iIII')
+
+    def __init__(self, filename, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise RuntimeError('inotify is not available')
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.directory, self.name = os.path.split(os.path.abspath(filename))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, self.directory.encode(), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'cannot watch {self.directory}')
+
+    def fileno(self):
+        return self.fd
+
+    def read_changed(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.event_format.unpack_from(data, offset)
+                start = offset + self.event_format.size
+                name = data[start:start + length].rstrip(b'\0')
+                if name.decode(errors='replace') == self.name:
+                    changed = True
+                offset = start + length
+        return changed
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,262 @@
+import contextlib
+import io
+import sys
+import time
+
+from backends import backend_names, create_motor
+from configuration import Configuration
+from motor import Motor
+from ordering import move_time
+from usbstats import LatencyHistogram
+
+
+# Methods every backend implements, the others have defaults in Motor
+optional_methods = [
+    'get_stats', 'is_connected', 'is_home_switch_active', 'quick_stop',
+    'set_position',
+]
+required_methods = [
+    name for name, attr in vars(Motor).items()
+    if callable(attr) and not name.startswith('_') and name not in optional_methods
+]
+
+# Getters MotionController calls on every tick, after update_state
+tick_getters = [
+    'is_connected', 'is_energized', 'is_moving', 'is_stopping',
+    'get_position', 'get_velocity',
+]
+
+
+class Conformance(object):
+    # Checks a motor against the behaviour MotionController relies on:
+    # state getters reflect commands at once and are cheap, moves end
+    # exactly at their target, a stop decelerates within the stopping
+    # distance, and a tick (update_state and the getters) is cheap enough
+    # for the 20 ms polling interval.
+    def __init__(self, motor: Motor, config, interval=0.02, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.motor = motor
+        self.config = config
+        self.interval = interval
+        self.steps_per_deg = config.steps_per_rev / 360
+        self.failures = []
+        self.tick_cost = LatencyHistogram()
+        self.getter_cost = LatencyHistogram()
+
+
+    def check(self, condition, message):
+        if not condition:
+            self.failures.append(message)
+        return condition
+
+
+    def tick(self):
+        motor = self.motor
+        start = time.perf_counter_ns()
+        motor.update_state()
+        getters_start = time.perf_counter_ns()
+        for name in tick_getters:
+            getattr(motor, name)()
+        end = time.perf_counter_ns()
+        self.tick_cost.record(end - start)
+        self.getter_cost.record(end - getters_start)
+        time.sleep(self.interval)
+
+
+    def wait_stationary(self, timeout):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            self.tick()
+            if not self.motor.is_moving():
+                return True
+        return False
+
+
+    def move_timeout(self, distance, speed):
+        duration = float(move_time(
+            abs(distance), speed, self.config.start_speed,
+            self.config.acceleration))
+        return 2 * duration + 1.0
+
+
+    def check_interface(self):
+        for name in required_methods:
+            self.check(
+                getattr(type(self.motor), name) is not getattr(Motor, name),
+                f'{name} not implemented')
+
+
+    def check_types(self):
+        motor = self.motor
+        motor.update_state()
+        for name in ['is_connected', 'is_energized', 'is_moving',
+                     'is_stopping', 'is_position_retained']:
+            value = getattr(motor, name)()
+            self.check(isinstance(value, bool), f'{name} returns {type(value).__name__}, not bool')
+        position = motor.get_position()
+        self.check(isinstance(position, int), f'get_position returns {type(position).__name__}, not int')
+        velocity = motor.get_velocity()
+        self.check(isinstance(velocity, (int, float)), 'get_velocity does not return a number')
+
+
+    def check_setup(self):
+        config = self.config
+        self.motor.setup_driver(config.microsteps, config.max_current)
+        self.motor.set_acceleration(config.acceleration * self.steps_per_deg)
+        self.motor.set_start_speed(config.start_speed * self.steps_per_deg)
+
+
+    def check_power(self):
+        # The controller evaluates its state right after a power event
+        motor = self.motor
+        motor.set_power_on()
+        self.check(motor.is_energized(), 'not energized right after set_power_on')
+        motor.set_power_off()
+        self.check(not motor.is_energized(), 'energized right after set_power_off')
+        motor.set_power_on()
+        self.tick()
+        self.check(motor.is_energized(), 'not energized after set_power_on and a tick')
+
+
+    def check_move(self, distance):
+        motor = self.motor
+        speed = self.config.max_speed
+        start = motor.get_position()
+        target = start + round(distance * self.steps_per_deg)
+        motor.start_move_to_position(target, speed * self.steps_per_deg)
+        self.check(motor.get_target_position() == target,
+                   f'move {distance}: get_target_position is not the target')
+
+        sign = 1 if target > start else -1
+        last = start
+        end = time.monotonic() + self.move_timeout(distance, speed)
+        while time.monotonic() < end:
+            self.tick()
+            position = motor.get_position()
+            if not self.check((position - last) * sign >= 0,
+                              f'move {distance}: position went backwards'):
+                break
+            if motor.is_moving():
+                self.check(motor.get_velocity() * sign >= 0,
+                           f'move {distance}: velocity against the move')
+            last = position
+            if not motor.is_moving() and position == target:
+                break
+        else:
+            self.check(False, f'move {distance}: did not complete in time')
+            return
+
+        self.check(motor.get_position() == target,
+                   f'move {distance}: ended at {motor.get_position()}, not {target}')
+        self.check(motor.get_velocity() == 0,
+                   f'move {distance}: velocity not zero at rest')
+        self.check(not motor.is_stopping(),
+                   f'move {distance}: stopping after completed move')
+
+
+    def check_stop(self):
+        motor = self.motor
+        config = self.config
+        speed = config.max_speed * self.steps_per_deg
+        accel = config.acceleration * self.steps_per_deg
+        start_speed = config.start_speed * self.steps_per_deg
+        start = motor.get_position()
+        target = start + round(360 * self.steps_per_deg)
+        motor.start_move_to_position(target, speed)
+
+        # Stop while at speed
+        for i in range(max(1, int(config.max_speed / config.acceleration / self.interval))):
+            self.tick()
+        velocity = abs(motor.get_velocity())
+        stop_position = motor.get_position()
+        motor.stop()
+        if not self.check(self.wait_stationary(self.move_timeout(360, config.max_speed)),
+                          'stop: motor did not come to rest'):
+            return
+
+        stopping_distance = max(0.0, velocity**2 - start_speed**2) / (2 * accel)
+        # Allow for the position moving on between reading and stopping
+        allowed = 1.1 * stopping_distance + velocity * self.interval + 1
+        travelled = motor.get_position() - stop_position
+        self.check(travelled <= allowed,
+                   f'stop: travelled {travelled} steps after stop, '
+                   f'allowed {allowed:.0f}')
+        self.check(motor.get_position() != target, 'stop: move ran to its target')
+        self.check(not motor.is_stopping(), 'stop: still stopping at rest')
+
+
+    def check_tick_cost(self, max_tick_cost, max_getter_cost):
+        tick_p99 = self.tick_cost.percentile(99) / 1e6
+        getter_p99 = self.getter_cost.percentile(99) / 1e6
+        self.check(tick_p99 <= max_tick_cost,
+                   f'tick cost p99 {tick_p99:.3f} ms above {max_tick_cost} ms')
+        self.check(getter_p99 <= max_getter_cost,
+                   f'getter cost p99 {getter_p99:.3f} ms above {max_getter_cost} ms')
+
+
+    def run(self, max_tick_cost, max_getter_cost):
+        checks = [
+            ('interface', self.check_interface),
+            ('types', self.check_types),
+            ('setup', self.check_setup),
+            ('power', self.check_power),
+            ('move forward', lambda: self.check_move(10.0)),
+            ('move backward', lambda: self.check_move(-10.0)),
+            ('short move', lambda: self.check_move(0.05)),
+            ('stop', self.check_stop),
+            ('tick cost', lambda: self.check_tick_cost(max_tick_cost, max_getter_cost)),
+        ]
+        results = []
+        for name, check in checks:
+            before = len(self.failures)
+            try:
+                check()
+            except Exception as e:
+                self.failures.append(f'{name}: {type(e).__name__}: {e}')
+            results.append((name, self.failures[before:]))
+        return results
+
+
+    def summary(self):
+        t = self.tick_cost
+        g = self.getter_cost
+        return (
+            f'tick cost p50 {t.percentile(50) / 1e3:.1f} us, '
+            f'p99 {t.percentile(99) / 1e3:.1f} us, max {t.max / 1e3:.1f} us '
+            f'over {t.count} ticks\n'
+            f'getters p50 {g.percentile(50) / 1e3:.1f} us, '
+            f'p99 {g.percentile(99) / 1e3:.1f} us'
+        )
+
+
+def main():
+    import argparse
+
+    p = argparse.ArgumentParser('conformance')
+    p.add_argument('backend', nargs='?', default='fake', help=f'motor backend ({", ".join(backend_names())})')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('--max-tick-cost', type=float, default=5.0, help='allowed tick cost p99 in ms')
+    p.add_argument('--max-getter-cost', type=float, default=0.05, help='allowed cost of the tick getters p99 in ms')
+    p.add_argument('-v', '--verbose', action='store_true', help='show output of the backend')
+    args = p.parse_args()
+
+    config = Configuration(args.config)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        motor = create_motor(args.backend, config)
+        conformance = Conformance(motor, config)
+        results = conformance.run(args.max_tick_cost, args.max_getter_cost)
+        close = getattr(motor, 'close', None)
+        if close is not None:
+            close()
+
+    for name, failures in results:
+        print(f'{name:15} {"ok" if not failures else "FAIL"}')
+        for failure in failures:
+            print(f'    {failure}')
+    print(conformance.summary())
+    return 1 if conformance.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
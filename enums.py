@@ -13,6 +13,7 @@ class MotionState(Enum):
     READY_TO_MOVE = auto()
     MOVING = auto()
     STOPPING = auto()
+    DISCONNECTED = auto()
 
 
 class Direction(Enum):
@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+# Levels, as in the logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {
+    DEBUG: 'debug',
+    INFO: 'info',
+    WARNING: 'warning',
+    ERROR: 'error',
+}
+levels = {name: level for level, name in level_names.items()}
+
+
+class EventLog(object):
+    # Structured event log. Callers only queue their events, a background
+    # thread writes them to the console and, with a filename, as JSON lines
+    # ({"time", "level", "category", "message", and the fields of the
+    # event}) to a file rotated by size. A slow terminal or a full pipe thus
+    # never stalls the GUI thread, which also runs the motor loop.
+    #
+    # The queue is bounded; events arriving while it is full are dropped and
+    # counted, and the count is logged once the writer catches up.
+    #
+    # Categories in use: controller, motor, ui, job, log
+    def __init__(self, filename=None, level=INFO, console=True,
+                 console_level=INFO, max_bytes=10 << 20, backups=5,
+                 max_queued=10000, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.file_level = level
+        self.console_level = console_level if console else ERROR + 1
+        if filename is None:
+            self.level = self.console_level
+        else:
+            self.level = min(level, self.console_level)
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.file = None
+        self.size = 0
+        if filename is not None:
+            self.open_file()
+
+        self.queue = queue.Queue(max_queued)
+        self.dropped = 0
+        self.reported_drops = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.writer, name='event-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+
+    def log(self, level, category, message, **fields):
+        if level < self.level:
+            return
+        # The console stream is taken here, so that redirecting stdout
+        # applies to the events logged meanwhile
+        event = (time.time(), level, category, message, fields, sys.stdout)
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+
+    def debug(self, category, message, **fields):
+        self.log(DEBUG, category, message, **fields)
+
+
+    def info(self, category, message, **fields):
+        self.log(INFO, category, message, **fields)
+
+
+    def warning(self, category, message, **fields):
+        self.log(WARNING, category, message, **fields)
+
+
+    def error(self, category, message, **fields):
+        self.log(ERROR, category, message, **fields)
+
+
+    def get_dropped(self):
+        return self.dropped
+
+
+    def close(self, timeout=5.0):
+        # Writes the events queued so far, giving up after timeout if the
+        # console does not take them
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+        if self.file is not None and not self.thread.is_alive():
+            self.file.close()
+
+
+    def open_file(self):
+        self.file = open(self.filename, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+
+    def rotate(self):
+        # filename becomes filename.1, filename.1 becomes filename.2 and so
+        # on, the oldest is removed
+        self.file.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = f'{self.filename}.{i}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.filename}.{i + 1}')
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.remove(self.filename)
+        self.open_file()
+
+
+    def writer(self):
+        streams = set()
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            self.write(event, streams)
+            if self.dropped != self.reported_drops:
+                dropped = self.dropped
+                self.write((time.time(), WARNING, 'log',
+                            f'{dropped - self.reported_drops} events dropped',
+                            {'dropped': dropped}, event[5]), streams)
+                self.reported_drops = dropped
+            if self.queue.empty():
+                self.flush(streams)
+        self.flush(streams)
+
+
+    def write(self, event, streams):
+        t, level, category, message, fields, stream = event
+        if level >= self.console_level:
+            try:
+                stream.write(message + '\n')
+                streams.add(stream)
+            except (OSError, ValueError):
+                pass
+        if self.file is not None and level >= self.file_level:
+            record = {
+                'time': t,
+                'level': level_names[level],
+                'category': category,
+                'message': message,
+            }
+            record.update(fields)
+            line = json.dumps(record, default=str) + '\n'
+            if self.size + len(line) > self.max_bytes and self.size > 0:
+                self.rotate()
+            self.file.write(line)
+            self.size += len(line)
+
+
+    def flush(self, streams):
+        for stream in streams:
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+        streams.clear()
+        if self.file is not None:
+            self.file.flush()
+
+
+# The log of the process, started on first use so that importing costs
+# nothing
+default_log = None
+default_lock = threading.Lock()
+
+
+def get_log():
+    global default_log
+    log = default_log
+    if log is None:
+        with default_lock:
+            if default_log is None:
+                default_log = EventLog()
+            log = default_log
+    return log
+
+
+def configure(*args, **kwargs):
+    # Replaces the log of the process, arguments as for EventLog
+    global default_log
+    with default_lock:
+        if default_log is not None:
+            default_log.close()
+        default_log = EventLog(*args, **kwargs)
+        return default_log
+
+
+def debug(category, message, **fields):
+    get_log().log(DEBUG, category, message, **fields)
+
+
+def info(category, message, **fields):
+    get_log().log(INFO, category, message, **fields)
+
+
+def warning(category, message, **fields):
+    get_log().log(WARNING, category, message, **fields)
+
+
+def error(category, message, **fields):
+    get_log().log(ERROR, category, message, **fields)
@@ -0,0 +1,413 @@
+import heapq
+import json
+import selectors
+import socket
+import sys
+import time
+import traceback
+
+import eventlog
+from backends import create_motor
+from configuration import Configuration, axis_names
+from enums import MotionState, TargetMode
+from motion import MotionController
+from motor import FakeMotor
+from session import apply_event
+from usbstats import LatencyHistogram
+
+
+class Table(object):
+    # One rotary table of the fleet: its controller and the figures the
+    # scheduler collects for it
+    def __init__(self, name, controller: MotionController, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.controller = controller
+        self.fault = None
+        self.ticks = 0
+        self.cpu_ns = 0
+        self.latency = LatencyHistogram()
+        self.lateness = LatencyHistogram()
+        self.driver = None
+
+
+    def interval(self):
+        state = self.controller.get_motion_state()
+        if state in [MotionState.MOVING, MotionState.STOPPING]:
+            return 0.02
+        return 0.2
+
+
+    def status(self):
+        ctrl = self.controller
+        return {
+            'table': self.name,
+            'state': ctrl.get_motion_state().name,
+            'angle': ctrl.get_position_angle(),
+            'mode': ctrl.get_target_mode().name,
+            'fault': self.fault,
+        }
+
+
+    def stats(self):
+        ticks = max(self.ticks, 1)
+        machine = self.controller.machine
+        dwell = machine.get_dwell_times()
+        transitions = machine.get_transition_counts()
+        return {
+            'table': self.name,
+            'ticks': self.ticks,
+            'cpu_ms': self.cpu_ns / 1e6,
+            'cpu_us_per_tick': self.cpu_ns / ticks / 1000,
+            'tick_p50_us': self.latency.percentile(50) / 1000,
+            'tick_p99_us': self.latency.percentile(99) / 1000,
+            'tick_max_us': self.latency.max / 1000,
+            'late_p99_ms': self.lateness.percentile(99) / 1e6,
+            'fault': self.fault,
+            'state_dwell_s': {state.name: t for state, t in dwell.items()},
+            'transitions': {
+                f'{source.name}->{target.name}': count
+                for (source, target), count in transitions.items() if count
+            },
+        }
+
+
+class FleetHost(object):
+    # Runs the tables of a cell in one thread. A heap orders the tables by
+    # the time of their next tick, and the control endpoint is served from
+    # the same selector, so there are no locks and no timer per table.
+    #
+    # The endpoint takes one JSON object per line and answers each with one
+    # line, {"ok": true, ...} or {"ok": false, "error": ...}:
+    #   {"cmd": "list"}
+    #   {"cmd": "status", "table": name}
+    #   {"cmd": "event", "table": name, "event": kind, "args": [...]}
+    #       kind as in recorded sessions: mode, position, abs_target,
+    #       rel_target, div_target, div_parameters, speed, cw, ccw, power,
+    #       start_stop
+    #   {"cmd": "stats"}
+    #   {"cmd": "reset", "table": name}
+    #   {"cmd": "subscribe", "interval": seconds}
+    #       status of all tables pushed as {"telemetry": [...]} lines
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tables = {}
+        self.heap = []
+        self.seq = 0
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.outgoing = {}
+        self.subscribers = {}
+        self.running = False
+
+
+    def add_table(self, table: Table):
+        self.tables[table.name] = table
+        self.schedule(table, time.monotonic())
+
+
+    def schedule(self, table, due):
+        # seq breaks ties, tables are not comparable
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, table))
+
+
+    def tick(self, table, due):
+        start = time.perf_counter_ns()
+        cpu_start = time.thread_time_ns()
+        table.lateness.record(int(max(0.0, time.monotonic() - due) * 1e9))
+        try:
+            table.controller.event_periodic()
+            if table.driver is not None:
+                table.driver(table)
+        except Exception as e:
+            # Only this table stops, the rest of the fleet carries on. It is
+            # no longer polled, so a move in progress is stopped here.
+            table.fault = f'{type(e).__name__}: {e}'
+            eventlog.error(
+                'controller', f'table {table.name} faulted: {table.fault}',
+                table=table.name, traceback=traceback.format_exc())
+            try:
+                table.controller.motor.quick_stop()
+            except Exception as e:
+                eventlog.error(
+                    'motor', f'table {table.name} not stopped: {e}',
+                    table=table.name)
+        table.cpu_ns += time.thread_time_ns() - cpu_start
+        table.latency.record(time.perf_counter_ns() - start)
+        table.ticks += 1
+        if table.fault is None:
+            self.schedule(table, due + table.interval())
+
+
+    def run(self, duration=None):
+        self.running = True
+        end = None if duration is None else time.monotonic() + duration
+        while self.running:
+            now = time.monotonic()
+            if end is not None and now >= end:
+                break
+            while self.heap and self.heap[0][0] <= now:
+                due, _, table = heapq.heappop(self.heap)
+                if due < now - 1.0:
+                    # Far behind, e.g. after a suspend; do not try to catch up
+                    due = now
+                self.tick(table, due)
+            self.publish_telemetry(now)
+
+            timeout = 0.2
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - time.monotonic())
+            if end is not None:
+                timeout = min(timeout, end - time.monotonic())
+            for key, mask in self.selector.select(max(0.0, timeout)):
+                key.data(key.fileobj, mask)
+
+
+    def stop(self):
+        self.running = False
+
+
+    # Control and telemetry endpoint. Answers are queued per connection and
+    # written as the socket takes them, a client reading too slowly is
+    # dropped once max_outgoing bytes are waiting.
+    max_outgoing = 1 << 20
+
+    def listen(self, host='127.0.0.1', port=7300):
+        server = socket.create_server((host, port))
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, self.accept)
+        return server.getsockname()
+
+
+    def accept(self, server, mask):
+        conn, _ = server.accept()
+        conn.setblocking(False)
+        self.clients[conn] = b''
+        self.outgoing[conn] = bytearray()
+        self.selector.register(conn, selectors.EVENT_READ, self.serve)
+
+
+    def serve(self, conn, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ and conn in self.clients:
+            self.readable(conn)
+
+
+    def readable(self, conn):
+        try:
+            data = conn.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(conn)
+            return
+        buffer = self.clients[conn] + data
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            if line.strip():
+                self.send(conn, self.handle_request(conn, line))
+        if conn in self.clients:
+            self.clients[conn] = buffer
+
+
+    def disconnect(self, conn):
+        self.selector.unregister(conn)
+        self.clients.pop(conn, None)
+        self.outgoing.pop(conn, None)
+        self.subscribers.pop(conn, None)
+        conn.close()
+
+
+    def send(self, conn, message):
+        if conn not in self.clients:
+            return
+        buffer = self.outgoing[conn]
+        pending = bool(buffer)
+        buffer += json.dumps(message).encode() + b'\n'
+        if len(buffer) > self.max_outgoing:
+            self.disconnect(conn)
+        elif not pending:
+            self.flush(conn)
+
+
+    def flush(self, conn):
+        buffer = self.outgoing[conn]
+        try:
+            sent = conn.send(buffer)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(conn)
+            return
+        del buffer[:sent]
+        # Wait for the socket to take the rest
+        events = selectors.EVENT_READ
+        if buffer:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(conn).events != events:
+            self.selector.modify(conn, events, self.serve)
+
+
+    def handle_request(self, conn, line):
+        try:
+            request = json.loads(line)
+            cmd = request['cmd']
+            if cmd == 'list':
+                return {'ok': True, 'tables': list(self.tables)}
+            elif cmd == 'stats':
+                return {'ok': True, 'stats': self.get_stats()}
+            elif cmd == 'subscribe':
+                self.subscribers[conn] = [float(request.get('interval', 1.0)), 0.0]
+                return {'ok': True}
+            table = self.tables[request['table']]
+            if cmd == 'status':
+                return {'ok': True, 'status': table.status()}
+            elif cmd == 'event':
+                if table.fault is not None:
+                    raise RuntimeError(f'table faulted: {table.fault}')
+                apply_event(table.controller, request['event'],
+                            request.get('args', []))
+                return {'ok': True, 'status': table.status()}
+            elif cmd == 'reset':
+                if table.fault is not None:
+                    table.fault = None
+                    self.schedule(table, time.monotonic())
+                return {'ok': True, 'status': table.status()}
+            raise ValueError(f'unknown command {cmd}')
+        except KeyError as e:
+            return {'ok': False, 'error': f'missing or unknown {e}'}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+
+    def publish_telemetry(self, now):
+        for conn, timing in list(self.subscribers.items()):
+            interval, last = timing
+            if now - last < interval:
+                continue
+            timing[1] = now
+            status = [t.status() for t in self.tables.values()]
+            self.send(conn, {'telemetry': status})
+
+
+    def get_stats(self):
+        return [t.stats() for t in self.tables.values()]
+
+
+def index_driver(table):
+    # Load test driver, indexes to the next division whenever idle
+    ctrl = table.controller
+    if ctrl.get_motion_state() != MotionState.IDLE:
+        return
+    num_divs = len(ctrl.get_divs())
+    _, index = ctrl.get_div_target()
+    ctrl.event_target_set((index + 1) % num_divs)
+    ctrl.event_start_stop()
+
+
+def make_simulated_table(name, config):
+    ctrl = MotionController(FakeMotor(), config)
+    ctrl.event_power()
+    ctrl.event_speed_set(ctrl.max_speed)
+    ctrl.event_target_mode_set(TargetMode.DIVISION)
+    ctrl.event_division_set(24, 0.0, 360.0)
+    table = Table(name, ctrl)
+    table.driver = index_driver
+    return table
+
+
+def load_test(config, num_tables, duration, max_late_ms):
+    host = FleetHost()
+    for i in range(num_tables):
+        host.add_table(make_simulated_table(f'sim{i:03}', config))
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    host.run(duration)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+
+    stats = host.get_stats()
+    late = LatencyHistogram()
+    for table in host.tables.values():
+        for index, count in enumerate(table.lateness.counts):
+            late.counts[index] += count
+        late.count += table.lateness.count
+        late.total += table.lateness.total
+        late.max = max(late.max, table.lateness.max)
+    ticks = sum(s['ticks'] for s in stats)
+    faults = [s for s in stats if s['fault'] is not None]
+
+    print(f'{"table":8} {"ticks":>7} {"cpu ms":>8} {"us/tick":>8} '
+          f'{"p99 us":>8} {"late p99 ms":>12}')
+    for s in sorted(stats, key=lambda s: -s['cpu_ms'])[:10]:
+        print(f'{s["table"]:8} {s["ticks"]:7} {s["cpu_ms"]:8.1f} '
+              f'{s["cpu_us_per_tick"]:8.1f} {s["tick_p99_us"]:8.1f} '
+              f'{s["late_p99_ms"]:12.2f}')
+    print()
+    print(f'{num_tables} tables, {ticks} ticks in {elapsed:.1f} s '
+          f'({ticks / elapsed:.0f} ticks/s)')
+    print(f'host CPU {100 * cpu / elapsed:.1f} %, '
+          f'{cpu / max(ticks, 1) * 1e6:.1f} us per tick')
+    print(f'schedule lateness p50 {late.percentile(50) / 1e6:.2f} ms, '
+          f'p99 {late.percentile(99) / 1e6:.2f} ms, max {late.max / 1e6:.2f} ms')
+    print(f'{len(faults)} faulted tables')
+
+    failures = []
+    if late.percentile(99) / 1e6 > max_late_ms:
+        failures.append(f'schedule lateness p99 above {max_late_ms} ms')
+    if faults:
+        failures.append(f'{len(faults)} tables faulted')
+    return failures
+
+
+def main():
+    import argparse
+
+    p = argparse.ArgumentParser('fleet')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file, one table per axis section')
+    p.add_argument('--fake', type=int, default=0, metavar='N', help='add N simulated tables')
+    p.add_argument('--host', default='127.0.0.1', help='endpoint address')
+    p.add_argument('--port', type=int, default=7300, help='endpoint port')
+    p.add_argument('--load-test', type=int, metavar='N', help='run N simulated tables indexing continuously and report scaling')
+    p.add_argument('--duration', type=float, default=30.0, help='load test duration in s')
+    p.add_argument('--max-late', type=float, default=10.0, help='allowed schedule lateness p99 in ms for the load test')
+    args = p.parse_args()
+
+    if args.load_test:
+        config = Configuration(args.config)
+        failures = load_test(config, args.load_test, args.duration, args.max_late)
+        for failure in failures:
+            print(f'FAIL: {failure}')
+        return 1 if failures else 0
+
+    host = FleetHost()
+    for name in axis_names(args.config):
+        config = Configuration(args.config, name)
+        if config.backend == 'pololu' and config.serial_number is None:
+            eventlog.warning('fleet', f'axis {name} has no serial_number, skipped', table=name)
+            continue
+        try:
+            motor = create_motor(config.backend, config)
+            host.add_table(Table(name, MotionController(motor, config)))
+        except Exception as e:
+            # A missing table must not keep the rest of the cell down
+            eventlog.warning('fleet', f'table {name} not started: {e}', table=name)
+    config = Configuration(args.config)
+    for i in range(args.fake):
+        ctrl = MotionController(FakeMotor(), config)
+        host.add_table(Table(f'fake{i}', ctrl))
+
+    address = host.listen(args.host, args.port)
+    print(f'{len(host.tables)} tables, endpoint on {address[0]}:{address[1]}')
+    try:
+        host.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
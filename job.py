@@ -0,0 +1,370 @@
+import csv
+import os
+import time
+from collections import namedtuple
+
+import eventlog
+from enums import MotionState, TargetMode, Direction
+from motion import MotionController, calculate_divs
+
+
+# Step kinds and their values:
+#   divisions  (num_divs, start_angle, extent)
+#   speed      speed in degrees / s
+#   direction  Direction for angle moves, 'cw' or 'ccw' in program files
+#   angle      absolute target angle
+#   div        division number, starting at 1
+#   dwell      time in seconds
+#   wait       None, wait for the external cut done signal
+Step = namedtuple('Step', ['kind', 'value'])
+
+move_kinds = ['angle', 'div']
+
+
+def parse_step(kind, values):
+    kind = kind.strip().lower()
+    values = [v for v in values if v.strip()]
+
+    if kind == 'divisions':
+        num_divs, start_angle, extent = values
+        return Step(kind, (int(num_divs), float(start_angle), float(extent)))
+    elif kind in ['speed', 'angle', 'dwell']:
+        value, = values
+        return Step(kind, float(value))
+    elif kind == 'div':
+        value, = values
+        return Step(kind, int(value))
+    elif kind == 'direction':
+        value, = values
+        return Step(kind, Direction[value.strip().upper()])
+    elif kind == 'wait':
+        return Step(kind, None)
+    else:
+        raise ValueError(f'unknown step kind {kind}')
+
+
+def load_csv_program(filename):
+    steps = []
+    with open(filename, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().startswith('#'):
+                continue
+            steps.append(parse_step(row[0], row[1:]))
+    return steps
+
+
+def load_toml_program(filename):
+    import tomllib
+    with open(filename, 'rb') as f:
+        program = tomllib.load(f)
+
+    # A [[step]] table may combine several kinds, these are expanded in the
+    # order they must be executed
+    steps = []
+    order = [
+        'divisions', 'speed', 'direction', 'angle', 'div', 'dwell', 'wait',
+    ]
+    for table in program.get('step', []):
+        unknown = set(table) - set(order)
+        if unknown:
+            raise ValueError(f'unknown step kind {unknown.pop()}')
+        for kind in order:
+            if kind not in table:
+                continue
+            value = table[kind]
+            if kind == 'wait':
+                if value:
+                    steps.append(parse_step(kind, []))
+            elif kind == 'divisions':
+                steps.append(parse_step(kind, [str(v) for v in value]))
+            else:
+                steps.append(parse_step(kind, [str(value)]))
+    return steps
+
+
+def load_program(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.toml':
+        return load_toml_program(filename)
+    elif ext == '.csv':
+        return load_csv_program(filename)
+    else:
+        raise ValueError('program file must be .csv or .toml')
+
+
+def optimise_program(controller: MotionController, steps, direction=None,
+                     approach=None, backlash=0.0):
+    # Reorder runs of moves that are only separated by dwells and waits, so
+    # that each run is visited in the least total move time. Every move keeps
+    # the dwells and waits that follow it. Reordered moves become angle moves
+    # with explicit direction steps, as division moves always take the
+    # shortest way.
+    result = []
+    divs = controller.get_division_angles()
+    speed, _, _ = controller.get_speeds()
+    position = controller.get_position_angle()
+
+    def flush(groups):
+        nonlocal position
+        if not groups:
+            return
+        angles = [angle for angle, group in groups]
+        order, directions, _ = controller.plan_visit_order(
+            angles, direction, approach, backlash, start_angle=position,
+            speed=speed)
+        current_dir = None
+        for index, move_dir in zip(order, directions):
+            angle, group = groups[index]
+            if move_dir != current_dir:
+                result.append(Step('direction', move_dir))
+                current_dir = move_dir
+            result.append(Step('angle', angle))
+            result.extend(group)
+        position = angles[order[-1]]
+        groups.clear()
+
+    groups = []
+    for step in steps:
+        if step.kind in move_kinds:
+            if step.kind == 'angle':
+                angle = step.value % 360
+            else:
+                angle = divs[step.value - 1]
+            groups.append((angle, []))
+        elif step.kind in ['dwell', 'wait'] and groups:
+            groups[-1][1].append(step)
+        else:
+            flush(groups)
+            if step.kind == 'divisions':
+                divs = calculate_divs(*step.value)
+            elif step.kind == 'speed':
+                speed = step.value
+            result.append(step)
+    flush(groups)
+
+    return result
+
+
+class JobRunner(object):
+    def __init__(self, controller: MotionController, steps, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.controller = controller
+        self.steps = steps
+
+        self.index = 0
+        self.running = False
+        self.finished = False
+        self.move_started = False
+        self.move_seen = False
+        self.waiting_for_cut = False
+        self.dwell_end = None
+        # Time left of a dwell interrupted by a pause
+        self.dwell_left = None
+
+        # (step index, start register, target register) of the next move,
+        # calculated while the current move is running
+        self.planned = None
+
+
+    def is_running(self):
+        return self.running
+
+
+    def is_paused(self):
+        return not self.running and not self.finished
+
+
+    def is_finished(self):
+        return self.finished
+
+
+    def get_progress(self):
+        return self.index, len(self.steps)
+
+
+    def restart(self, index=0):
+        # A move in progress runs to its end, the job then continues at
+        # index
+        if index < 0 or index >= len(self.steps):
+            raise ValueError('step out of range')
+        self.index = index
+        self.finished = False
+        self.move_started = False
+        self.waiting_for_cut = False
+        self.dwell_end = None
+        self.dwell_left = None
+        self.planned = None
+        self.running = True
+        eventlog.info('job', f'job started at step {index + 1}/{len(self.steps)}', step=index + 1)
+
+
+    def pause(self, reason='paused'):
+        # A move in progress runs to its end, a dwell keeps the time left
+        # and a wait for the cut done signal keeps waiting
+        if self.dwell_end is not None:
+            self.dwell_left = max(0.0, self.dwell_end - time.monotonic())
+            self.dwell_end = None
+        self.running = False
+        self.planned = None
+        eventlog.info('job', f'job {reason} at step {self.index + 1}/{len(self.steps)}', step=self.index + 1)
+
+
+    def resume(self):
+        if self.finished:
+            return
+        if self.dwell_left is not None:
+            self.dwell_end = time.monotonic() + self.dwell_left
+            self.dwell_left = None
+        self.running = True
+        eventlog.info('job', f'job resumed at step {self.index + 1}/{len(self.steps)}', step=self.index + 1)
+
+
+    def event_cut_done(self):
+        self.waiting_for_cut = False
+
+
+    def event_periodic(self):
+        state = self.controller.get_motion_state()
+        if self.move_started and state in [MotionState.MOVING, MotionState.STOPPING]:
+            # Also while paused, the move goes on
+            self.move_seen = True
+
+        if not self.running:
+            return
+
+        if self.controller.get_homing_phase() is not None:
+            # Homing has the motor, carry on once it is done
+            return
+
+        if state == MotionState.DISCONNECTED:
+            # Carry on where we were once the motor is back
+            return
+
+        if state in [MotionState.MOVING, MotionState.STOPPING]:
+            self.move_seen = True
+            if self.planned is None:
+                self.plan_next_move()
+            return
+
+        if state == MotionState.UNPOWERED:
+            if self.move_started:
+                self.move_started = False
+                self.index -= 1
+                self.pause('interrupted, motor not energized')
+            return
+
+        if self.move_started:
+            if state != MotionState.IDLE and not self.move_seen:
+                # The motor has not reported motion yet
+                return
+            self.move_started = False
+            if state != MotionState.IDLE:
+                # The operator stopped the move, repeat it on resume
+                self.index -= 1
+                self.pause('stopped')
+                return
+
+        try:
+            self.run_steps()
+        except (RuntimeError, ValueError, IndexError) as e:
+            # Repeat the failed step on resume
+            self.index -= 1
+            self.pause(f'failed ({e})')
+
+
+    def run_steps(self):
+        # Execute steps until one has to wait for a move, dwell or cut
+        while True:
+            if self.waiting_for_cut:
+                return
+            if self.dwell_end is not None:
+                if time.monotonic() < self.dwell_end:
+                    return
+                self.dwell_end = None
+
+            if self.index >= len(self.steps):
+                self.running = False
+                self.finished = True
+                eventlog.info('job', 'job finished')
+                return
+
+            step = self.steps[self.index]
+            self.index += 1
+
+            if step.kind == 'divisions':
+                self.controller.event_division_set(*step.value)
+            elif step.kind == 'speed':
+                self.controller.event_speed_set(step.value)
+            elif step.kind == 'direction':
+                self.controller.event_direction_set(step.value)
+            elif step.kind == 'dwell':
+                self.dwell_end = time.monotonic() + step.value
+            elif step.kind == 'wait':
+                self.waiting_for_cut = True
+            elif step.kind in move_kinds:
+                if self.start_move(self.index - 1, step):
+                    return
+
+
+    def start_move(self, index, step):
+        mode, parameter = self.move_target(step)
+        planned = self.planned
+        self.planned = None
+
+        # A planned target is valid if the move it was planned from ended on
+        # its target, which holds when idle
+        reuse = (
+            planned is not None and
+            planned[0] == index and
+            planned[1] == self.controller.get_target_reg() and
+            self.controller.get_motion_state() == MotionState.IDLE
+        )
+        if reuse:
+            target_reg = planned[2]
+        else:
+            position_reg = self.controller.get_position_reg()
+            target_reg = self.controller.plan_target_reg(
+                mode, parameter, position_reg)
+
+        self.controller.event_planned_target_set(mode, parameter, target_reg)
+        if self.controller.get_motion_state() != MotionState.READY_TO_MOVE:
+            # Already at the target
+            return False
+
+        self.controller.event_start_stop()
+        self.move_started = True
+        self.move_seen = False
+        return True
+
+
+    def move_target(self, step):
+        if step.kind == 'angle':
+            return TargetMode.ABSOLUTE, step.value % 360
+        num_divs = len(self.controller.get_division_angles())
+        if step.value < 1 or step.value > num_divs:
+            raise IndexError(f'division {step.value} out of range')
+        return TargetMode.DIVISION, step.value - 1
+
+
+    def plan_next_move(self):
+        # Only plan across steps that do not change the division setup
+        direction = self.controller.get_direction()
+        for index in range(self.index, len(self.steps)):
+            step = self.steps[index]
+            if step.kind == 'divisions':
+                return
+            elif step.kind == 'direction':
+                direction = step.value
+            elif step.kind in move_kinds:
+                break
+        else:
+            return
+
+        try:
+            mode, parameter = self.move_target(step)
+        except IndexError:
+            return
+        start_reg = self.controller.get_target_reg()
+        target_reg = self.controller.plan_target_reg(
+            mode, parameter, start_reg, direction)
+        self.planned = index, start_reg, target_reg
@@ -0,0 +1,144 @@
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+
+class PositionJournal(object):
+    # Append-only journal of the position anchor and motor register. Each
+    # line is a JSON record prefixed by its CRC32, so a line torn by a crash
+    # is detected and ignored on replay. Records are written and fsynced in
+    # batches by a background thread, the control loop only queues them.
+    def __init__(self, filename, sync_interval=0.5, max_size=1024 * 1024,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self.max_size = max_size
+
+        self.last_entry = None
+        self.last_record = self.replay()
+
+        self.queue = queue.SimpleQueue()
+        self.file = open(filename, 'a', encoding='ascii')
+        self.terminate_torn_line()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+
+    def replay(self):
+        last = None
+        try:
+            with open(self.filename, 'r', encoding='ascii', errors='replace') as f:
+                for line in f:
+                    record = self.decode(line)
+                    if record is not None:
+                        last = record
+        except FileNotFoundError:
+            pass
+        return last
+
+
+    def terminate_torn_line(self):
+        # Records appended after a torn line must start on a new line
+        if self.file.tell() == 0:
+            return
+        with open(self.filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                self.file.write('\n')
+                self.file.flush()
+
+
+    def get_last_record(self):
+        return self.last_record
+
+
+    def record(self, anchor, position_reg, state, steps_per_rev):
+        entry = anchor, position_reg, state, steps_per_rev
+        if entry == self.last_entry:
+            return
+        self.last_entry = entry
+        self.queue.put((time.time(), entry))
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+    def encode(self, timestamp, entry):
+        anchor, position_reg, state, steps_per_rev = entry
+        record = {
+            'time': timestamp,
+            'anchor': list(anchor),
+            'position': position_reg,
+            'state': state.name,
+            'steps_per_rev': steps_per_rev,
+        }
+        data = json.dumps(record, separators=(',', ':'))
+        crc = zlib.crc32(data.encode('ascii'))
+        return f'{crc:08x} {data}\n'
+
+
+    def decode(self, line):
+        crc, _, data = line.rstrip('\n').partition(' ')
+        try:
+            if int(crc, 16) != zlib.crc32(data.encode('ascii')):
+                return None
+            return json.loads(data)
+        except ValueError:
+            return None
+
+
+    def writer(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+
+            # Collect everything arriving within the sync interval
+            deadline = time.monotonic() + self.sync_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if not batch:
+                continue
+
+            lines = [self.encode(t, e) for t, e in batch]
+            self.file.write(''.join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            if self.file.tell() > self.max_size:
+                self.compact(lines[-1])
+
+
+    def compact(self, last_line):
+        # Replace the journal with its latest record
+        tmp_name = self.filename + '.tmp'
+        with open(tmp_name, 'w', encoding='ascii') as f:
+            f.write(last_line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp_name, self.filename)
+
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self.file = open(self.filename, 'a', encoding='ascii')
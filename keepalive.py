@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+
+import eventlog
+from usbstats import LatencyHistogram
+
+
+class LockedDevice(object):
+    # Wraps a ticlib device so calls from the keepalive thread and the GUI
+    # thread never interleave on the USB connection
+    def __init__(self, device):
+        self._device = device
+        self._lock = threading.RLock()
+        self._wrappers = {}
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if not callable(attr):
+            return attr
+        if name not in self._wrappers:
+            self._wrappers[name] = self._wrap(attr)
+        return self._wrappers[name]
+
+
+    def _wrap(self, method):
+        lock = self._lock
+
+        def wrapper(*args, **kwargs):
+            with lock:
+                return method(*args, **kwargs)
+
+        return wrapper
+
+
+    def try_call(self, name, timeout, *args):
+        # Returns False without calling if the device stays busy for longer
+        # than timeout seconds
+        if not self._lock.acquire(timeout=timeout):
+            return False
+        try:
+            getattr(self._device, name)(*args)
+        finally:
+            self._lock.release()
+        return True
+
+
+class KeepaliveLane(object):
+    # Keeps the Tic command timeout from expiring, independent of the Qt
+    # event loop. Polling refreshes the timeout once it is older than
+    # poll_fraction of the device timeout, instead of on every tick. The lane
+    # only steps in when polling has not done so by lane_fraction, so while
+    # the event loop runs normally it sends nothing. The alarm is raised when
+    # the timeout has not been refreshed for alarm_fraction of it.
+    def __init__(self, device: LockedDevice, timeout=1.0, poll_fraction=0.25,
+                 lane_fraction=0.5, alarm_fraction=0.75, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device = device
+        self.timeout = timeout
+        self.poll_age = timeout * poll_fraction
+        self.period = timeout * lane_fraction
+        self.alarm_age = timeout * alarm_fraction
+        self.alarm_handlers = [self.print_alarm]
+
+        self.last_refresh = time.monotonic()
+        self.refreshes = {'poll': 0, 'lane': 0}
+        self.jitter = LatencyHistogram()
+        self.gaps = LatencyHistogram()
+        self.missed_deadlines = 0
+        self.alarms = 0
+        self.alarm_raised = False
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name='keepalive', daemon=True)
+        self.thread.start()
+
+
+    def is_due(self):
+        return time.monotonic() - self.last_refresh >= self.poll_age
+
+
+    def refreshed(self, source):
+        now = time.monotonic()
+        gap = now - self.last_refresh
+        self.last_refresh = now
+        self.refreshes[source] += 1
+        self.gaps.record(int(gap * 1e9))
+        if gap > self.timeout:
+            self.missed_deadlines += 1
+        self.alarm_raised = False
+
+
+    def run(self):
+        set_realtime_priority()
+        while True:
+            scheduled = self.last_refresh + self.period
+            if self.stop_event.wait(max(0.0, scheduled - time.monotonic())):
+                break
+            now = time.monotonic()
+            self.jitter.record(int(max(0.0, now - scheduled) * 1e9))
+
+            age = now - self.last_refresh
+            if age >= self.alarm_age and not self.alarm_raised:
+                self.raise_alarm(age)
+            if age < self.period:
+                # Polling refreshed it while we slept
+                continue
+            try:
+                # A device call holding the lock must not delay the alarm
+                wait = max(0.0, self.last_refresh + self.alarm_age - now)
+                if not self.device.try_call('reset_command_timeout', wait):
+                    if not self.alarm_raised:
+                        self.raise_alarm(time.monotonic() - self.last_refresh)
+                    self.device.reset_command_timeout()
+            except Exception as e:
+                # Device gone, polling takes care of reconnecting
+                eventlog.warning('motor', f'keepalive refresh failed: {e}')
+                if self.stop_event.wait(self.period):
+                    break
+                continue
+            self.refreshed('lane')
+
+
+    def raise_alarm(self, age):
+        self.alarms += 1
+        self.alarm_raised = True
+        for handler in self.alarm_handlers:
+            handler(age)
+
+
+    def print_alarm(self, age):
+        eventlog.error(
+            'motor',
+            f'keepalive alarm: command timeout not refreshed for '
+            f'{age * 1000:.0f} ms of {self.timeout * 1000:.0f} ms',
+            age_ms=age * 1000)
+
+
+    def summary(self):
+        return (
+            f'keepalive refreshes: {self.refreshes["poll"]} by polling, '
+            f'{self.refreshes["lane"]} by lane\n'
+            f'wake jitter p50 {self.jitter.percentile(50) / 1e6:.2f} ms, '
+            f'p99 {self.jitter.percentile(99) / 1e6:.2f} ms, '
+            f'max {self.jitter.max / 1e6:.2f} ms\n'
+            f'max refresh gap {self.gaps.max / 1e6:.1f} ms, '
+            f'{self.missed_deadlines} missed deadlines, {self.alarms} alarms\n'
+        )
+
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def set_realtime_priority():
+    # Applies to the calling thread on Linux. Needs CAP_SYS_NICE, otherwise
+    # the lane runs at normal priority.
+    try:
+        param = os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO))
+        os.sched_setscheduler(0, os.SCHED_FIFO, param)
+    except (AttributeError, OSError):
+        pass
@@ -1,13 +1,131 @@
+import time
+
+import eventlog
 from enums import MotionState, TargetMode, Direction
-from configuration import Configuration
+from configuration import Configuration, live_settings, rehome_settings
 from motor import Motor
+from statemachine import InvalidEventError, StateMachine, Transition
+from tracking import TrackingMonitor
+
+
+def calculate_divs(num_divs, start_angle, extent):
+    if extent == 360.0:
+        d = num_divs
+    else:
+        d = num_divs - 1
+    r = range(num_divs)
+    s = start_angle
+    e = extent
+    return [(i * e / d + s) % 360.0 for i in r]
+
+
+stationary_states = frozenset([
+    MotionState.UNPOWERED,
+    MotionState.IDLE,
+    MotionState.READY_TO_MOVE,
+])
+moving_states = frozenset([
+    MotionState.MOVING,
+    MotionState.STOPPING,
+])
+all_states = tuple(MotionState)
+
+
+# Guards of the transitions, on the motor state sampled by
+# evaluate_state_transition. They are tried in the order of the table, so
+# each one may assume the earlier ones failed.
+def motor_disconnected(ctrl):
+    return not ctrl.motor_connected
+
+
+def motor_unpowered(ctrl):
+    return not ctrl.motor_energized
+
+
+def destination_reached(ctrl):
+    return ctrl.motor_stationary and ctrl.position_reg == ctrl.target_reg
+
+
+def motor_stationary(ctrl):
+    return ctrl.motor_stationary
+
+
+def motor_stopping(ctrl):
+    return ctrl.motor_stopping
+
+
+def motor_moving(ctrl):
+    return True
+
+
+motion_transitions = [
+    Transition(all_states, MotionState.DISCONNECTED, motor_disconnected),
+    Transition(all_states, MotionState.UNPOWERED, motor_unpowered),
+    Transition(all_states, MotionState.IDLE, destination_reached),
+    Transition(all_states, MotionState.READY_TO_MOVE, motor_stationary),
+    Transition(all_states, MotionState.STOPPING, motor_stopping),
+    # Only a move started here counts as one, a motor found moving in any
+    # other state keeps that state
+    Transition(
+        (MotionState.READY_TO_MOVE, MotionState.DISCONNECTED),
+        MotionState.MOVING,
+        motor_moving,
+    ),
+]
+
+# The states in which each event is accepted. Other events raise
+# InvalidEventError, power and start_stop are ignored.
+motion_events = {
+    'power': [s for s in all_states if s != MotionState.DISCONNECTED],
+    'start_stop': [MotionState.READY_TO_MOVE, MotionState.MOVING],
+    'home': [MotionState.IDLE, MotionState.READY_TO_MOVE],
+    'position_set': stationary_states,
+    'target_mode_set': stationary_states,
+    'target_set': stationary_states,
+    'division_set': stationary_states,
+    'planned_target_set': stationary_states,
+    'direction_set': stationary_states,
+    'speed_set': stationary_states,
+    'config_set': stationary_states,
+}
+
+# Events accepted while homing, both abort it. Homing moves the motor
+# between its phases on its own, other events would interfere.
+homing_events = ['power', 'start_stop']
+
 
 class MotionController(object):
+    # The Tic position register is a signed 32 bit value, which moves going
+    # one way, e.g. relative and division moves, keep growing. When the
+    # motor comes to rest further than this from 0, the register is moved
+    # back by whole revolutions.
+    rebase_threshold = 2**30
+
     def __init__(self, motor: Motor, config: Configuration):
         self.motor = motor
         self.config = config
+        # Simulated motors keep their own time
+        self.clock = getattr(motor, 'clock', time.monotonic)
 
         self.motion_state = MotionState.UNPOWERED
+        self.machine = StateMachine(
+            all_states,
+            self.motion_state,
+            motion_transitions,
+            motion_events,
+            on_entry={
+                MotionState.IDLE: self.enter_stationary,
+                MotionState.UNPOWERED: self.enter_stationary,
+                MotionState.STOPPING: self.enter_stopping,
+                MotionState.DISCONNECTED: self.enter_disconnected,
+            },
+            on_exit={
+                MotionState.MOVING: self.exit_moving,
+                MotionState.STOPPING: self.exit_moving,
+                MotionState.DISCONNECTED: self.exit_disconnected,
+            },
+            clock=self.clock,
+        )
         self.target_mode = TargetMode.ABSOLUTE
 
         self.target_reg = 0
@@ -18,6 +136,22 @@ class MotionController(object):
         self.div_parameters = 2, 0, 360
         self.divs = [0, 180]
 
+        self.journal = None
+        self.traces = []
+        self.move_log = None
+        self.state_listeners = []
+        self.move_start = None
+        # Top speed of the current or last move in degrees / s
+        self.move_speed = 0.0
+        self.rebases = 0
+
+        # Phase of a homing run, None when not homing
+        self.homing_phase = None
+
+        # Set when a move strayed from its planned profile, until the next
+        # move starts
+        self.fault = None
+
         self.direction = Direction.CW
         self.speed = self.config.default_speed
         self.min_speed = self.config.min_speed
@@ -26,42 +160,111 @@ class MotionController(object):
         self.setup_motor()
 
 
+    def attach_journal(self, journal):
+        # Resume with the previous angle reference if the motor has kept its
+        # position since the journal was written
+        record = journal.get_last_record()
+        valid = (
+            record is not None and
+            record['steps_per_rev'] == self.config.steps_per_rev and
+            self.motor.is_position_retained()
+        )
+        if valid:
+            self.position_anchor = tuple(record['anchor'])
+            self.target_reg = self.motor.get_position()
+            eventlog.info('controller', 'position reference restored from journal')
+        self.journal = journal
+        self.evaluate_state_transition()
+
+
+    def attach_trace(self, trace):
+        self.traces.append(trace)
+
+
+    def attach_move_log(self, move_log):
+        self.move_log = move_log
+
+
+    def attach_state_listener(self, listener):
+        # Called as listener(old_state, new_state) on every state change,
+        # as soon as the controller sees it
+        self.state_listeners.append(listener)
+
+
+    def check_event(self, event):
+        if self.homing_phase is not None and event not in homing_events:
+            raise InvalidEventError(f'Invalid event while homing: {event}')
+        self.machine.check_event(event)
+
+
+    def is_event_valid(self, event):
+        if self.homing_phase is not None and event not in homing_events:
+            return False
+        return self.machine.is_event_valid(event)
+
+
     def event_periodic(self):
         self.motor.update_state()
         self.evaluate_state_transition()
+        if self.homing_phase is not None:
+            self.advance_homing()
 
 
     def event_power(self):
-        if self.motion_state == MotionState.UNPOWERED:
+        if not self.machine.is_event_valid('power'):
+            # Invalid state, return quietly
+            return
+        elif self.motion_state == MotionState.UNPOWERED:
             self.motor.set_power_on()
         else:
             self.motor.set_power_off()
         self.evaluate_state_transition()
 
 
-    def event_start_stop(self):
-        if self.motion_state == MotionState.READY_TO_MOVE:
+    def event_start_stop(self, speed=None):
+        # speed overrides the set speed for this move only
+        if not self.machine.is_event_valid('start_stop'):
+            # Invalid state, return quietly
+            return
+        elif self.homing_phase is not None and self.motion_state == MotionState.READY_TO_MOVE:
+            # Between two homing moves, the next one is not started
+            self.abort_homing('stopped')
+        elif self.motion_state == MotionState.READY_TO_MOVE:
             self.start_reg = self.motor.get_position()
             tgt_reg = self.target_reg
-            speed = self.speed * self.steps_per_deg
+            self.move_speed = self.speed if speed is None else speed
+            speed = self.move_speed * self.steps_per_deg
             self.motor.start_move_to_position(tgt_reg, speed)
+            self.start_tracking(speed)
+            self.move_start = time.time(), self.clock()
         elif self.motion_state == MotionState.MOVING:
             self.motor.stop()
-        else:
-            # Invalid state, return quietly
-            return
+            self.tracking.cancel()
+            if self.homing_phase is not None:
+                self.abort_homing('stopped')
         self.evaluate_state_transition()
 
 
-    def event_position_set(self, position):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
+    def event_home(self):
+        # Finds the home switch at seek speed, backs off and approaches it
+        # again at the slow approach speed, always from the same side. The
+        # angle reference is set where the switch triggers on the approach.
+        self.check_event('home')
+
+        config = self.config
+        self.home_sign = 1 if config.home_direction == 'cw' else -1
+        if self.motor.is_home_switch_active():
+            # Already on the switch, back off first
+            self.home_trigger_reg = self.position_reg
+            self.homing_phase = 'seek_stop'
+        else:
+            self.homing_phase = 'seek'
+            self.homing_move(self.position_reg, config.home_max_travel, config.home_seek_speed)
+        eventlog.info('controller', 'homing started')
 
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+
+    def event_position_set(self, position):
+        self.check_event('position_set')
 
         motor_pos = self.motor.get_position()
         self.position_anchor = position, motor_pos
@@ -70,14 +273,7 @@ class MotionController(object):
 
 
     def event_target_mode_set(self, mode):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
-
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+        self.check_event('target_mode_set')
 
         self.target_mode = mode
         self.calculate_target_reg()
@@ -85,14 +281,7 @@ class MotionController(object):
 
 
     def event_target_set(self, parameter):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
-
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+        self.check_event('target_set')
 
         if self.target_mode == TargetMode.ABSOLUTE:
             self.abs_target = parameter
@@ -106,52 +295,39 @@ class MotionController(object):
 
 
     def event_division_set(self, num_divs, start_angle, extent):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
-
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+        self.check_event('division_set')
 
-        if extent == 360.0:
-            d = num_divs
-        else:
-            d = num_divs - 1
-        r = range(num_divs)
-        s = start_angle
-        e = extent
-        self.divs = [(i * e / d + s) % 360.0 for i in r]
+        self.divs = calculate_divs(num_divs, start_angle, extent)
         self.div_target = 0
         self.div_parameters = num_divs, start_angle, extent
         self.calculate_target_reg()
         self.evaluate_state_transition()
 
 
-    def event_direction_set(self, direction):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
+    def event_planned_target_set(self, mode, parameter, target_reg):
+        self.check_event('planned_target_set')
+
+        self.target_mode = mode
+        if mode == TargetMode.ABSOLUTE:
+            self.abs_target = parameter
+        elif mode == TargetMode.RELATIVE:
+            self.rel_target = parameter
+        elif mode == TargetMode.DIVISION:
+            self.div_target = parameter
+
+        self.target_reg = target_reg
+        self.evaluate_state_transition()
 
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+
+    def event_direction_set(self, direction):
+        self.check_event('direction_set')
 
         self.direction = direction
         self.calculate_target_reg()
 
 
     def event_speed_set(self, speed):
-        valid_states = [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
-
-        if self.motion_state not in valid_states:
-            raise RuntimeError('Invalid event for state')
+        self.check_event('speed_set')
 
         if speed < self.min_speed or speed > self.max_speed:
             raise RuntimeError('Speed out of range')
@@ -159,6 +335,45 @@ class MotionController(object):
         self.speed = speed
 
 
+    def event_config_set(self, config: Configuration):
+        # Applies a reloaded configuration, sending only the changed
+        # settings to the motor. Returns the names of the changed settings.
+        # A configuration with changes that cannot be applied while running
+        # is rejected as a whole.
+        self.check_event('config_set')
+
+        changed = self.config.changed_settings(config)
+        rehome = [n for n in changed if n in rehome_settings]
+        if rehome:
+            raise ValueError(
+                f'{", ".join(rehome)} changed, this needs a re-home; '
+                f'restart to apply the configuration')
+        restart = [n for n in changed if n not in live_settings]
+        if restart:
+            raise ValueError(
+                f'{", ".join(restart)} changed, restart to apply the '
+                f'configuration')
+
+        steps_per_deg = self.steps_per_deg
+        if 'max_current' in changed:
+            self.motor.set_current_limit(config.max_current)
+        if 'acceleration' in changed:
+            self.motor.set_acceleration(config.acceleration * steps_per_deg)
+        if 'start_speed' in changed:
+            self.motor.set_start_speed(config.start_speed * steps_per_deg)
+        self.tracking.tolerance = config.tracking_tolerance * steps_per_deg
+
+        # The speed set by the operator is kept within the new limits, one
+        # still at the default follows a new default
+        if self.speed == self.config.default_speed:
+            self.speed = config.default_speed
+        self.min_speed = config.min_speed
+        self.max_speed = config.max_speed
+        self.speed = min(max(self.speed, self.min_speed), self.max_speed)
+        self.config = config
+        return changed
+
+
     def get_target_mode(self):
         return self.target_mode
 
@@ -190,11 +405,24 @@ class MotionController(object):
             return []
 
 
+    def get_division_angles(self):
+        # The divisions of the division setup, in any target mode
+        return self.divs
+
+
     def get_position_angle(self):
         reg = self.motor.get_position()
         return self.reg_to_angle(reg) % 360
 
 
+    def get_position_reg(self):
+        return self.motor.get_position()
+
+
+    def get_target_reg(self):
+        return self.target_reg
+
+
     def get_direction(self):
         return self.direction
 
@@ -207,11 +435,36 @@ class MotionController(object):
         return self.motion_state
 
 
+    def get_homing_phase(self):
+        return self.homing_phase
+
+
+    def get_fault(self):
+        return self.fault
+
+
+    def get_rebase_count(self):
+        return self.rebases
+
+
+    def get_tracking_stats(self):
+        # Samples, RMS and maximum tracking error in degrees, of the last
+        # move and over all moves
+        steps_per_deg = self.steps_per_deg
+        move_n, move_rms, move_max = self.tracking.get_move_stats()
+        n, rms, max_error = self.tracking.get_stats()
+        return (
+            (move_n, move_rms / steps_per_deg, move_max / steps_per_deg),
+            (n, rms / steps_per_deg, max_error / steps_per_deg),
+        )
+
+
+    def get_device_stats(self):
+        return self.motor.get_stats()
+
+
     def get_progress(self):
-        enabled = self.motion_state in [
-            MotionState.MOVING,
-            MotionState.STOPPING,
-        ]
+        enabled = self.motion_state in moving_states
         if enabled:
             start = self.start_reg
             current = self.motor.get_position()
@@ -219,7 +472,10 @@ class MotionController(object):
 
             total_movement = abs(target - start)
             current_movement = abs(current - start)
-            progress = int(100 * current_movement / total_movement)
+            if total_movement == 0:
+                progress = 100
+            else:
+                progress = int(100 * current_movement / total_movement)
         else:
             progress = 0
 
@@ -238,65 +494,317 @@ class MotionController(object):
         motor_pos = self.motor.get_position()
         self.position_anchor = 0, motor_pos
         self.steps_per_deg = steps_per_deg
+        self.position_reg = motor_pos
         self.target_reg = motor_pos
+        self.start_reg = motor_pos
+
+        tolerance = self.config.tracking_tolerance * steps_per_deg
+        self.tracking = TrackingMonitor(tolerance, self.clock)
+
+
+    def plan_visit_order(self, angles, direction=None, approach=None,
+                         backlash=0.0, start_angle=None, speed=None):
+        # speed defaults to the set speed
+        from ordering import optimise_visit_order
+        if start_angle is None:
+            start_angle = self.get_position_angle()
+        if speed is None:
+            speed = self.speed
+        return optimise_visit_order(
+            start_angle,
+            angles,
+            speed,
+            self.config.start_speed,
+            self.config.acceleration,
+            direction=direction,
+            approach=approach,
+            backlash=backlash,
+        )
 
 
     def evaluate_state_transition(self):
-        motor_energized = self.motor.is_energized()
-        motor_stationary = not self.motor.is_moving()
-        motor_stopping = self.motor.is_stopping()
-        destination_reached = self.motor.get_position() == self.target_reg
+        motor = self.motor
+        self.motor_connected = motor.is_connected()
+        self.motor_energized = motor.is_energized()
+        self.motor_stationary = not motor.is_moving()
+        self.motor_stopping = motor.is_stopping()
+        self.last_reg = self.position_reg
+        self.position_reg = motor.get_position()
 
         old_state = self.motion_state
-        new_state = old_state
-
-        if not motor_energized:
-            new_state = MotionState.UNPOWERED
-        elif motor_stationary:
-            if destination_reached:
-                new_state = MotionState.IDLE
-            else:
-                new_state = MotionState.READY_TO_MOVE
-        elif motor_stopping:
-            new_state = MotionState.STOPPING
-        elif old_state == MotionState.READY_TO_MOVE:
-            new_state = MotionState.MOVING
-
-        is_stationary = new_state in [
-            MotionState.UNPOWERED,
-            MotionState.IDLE,
-            MotionState.READY_TO_MOVE,
-        ]
-        was_moving = old_state in [
-            MotionState.MOVING,
-            MotionState.STOPPING,
-        ]
-        rel_tgt_mode = self.target_mode == TargetMode.RELATIVE
-
-        if was_moving and is_stationary and rel_tgt_mode:
+        new_state = self.motion_state = self.machine.step(self)
+
+        if new_state == MotionState.MOVING and self.tracking.active:
+            if not self.tracking.check(self.position_reg):
+                self.tracking_fault()
+
+        if self.traces:
+            velocity = motor.get_velocity()
+            for trace in self.traces:
+                trace.record(
+                    self.position_reg,
+                    velocity,
+                    new_state,
+                    self.target_reg,
+                    self.move_speed * self.steps_per_deg,
+                )
+
+        if self.journal is not None:
+            self.journal.record(
+                self.position_anchor,
+                self.position_reg,
+                new_state,
+                self.config.steps_per_rev,
+            )
+
+        if new_state != old_state:
+            for listener in self.state_listeners:
+                listener(old_state, new_state)
+
+
+    def enter_stationary(self, old_state, new_state):
+        # A move may complete between two evaluations without having been
+        # seen moving
+        self.tracking.cancel()
+        if self.move_start is not None:
+            self.move_ended(new_state)
+        rebase = (
+            new_state == MotionState.IDLE and
+            self.homing_phase is None and
+            abs(self.position_reg) > self.rebase_threshold
+        )
+        if rebase:
+            self.rebase_register()
+
+
+    def enter_stopping(self, old_state, new_state):
+        self.tracking.cancel()
+
+
+    def enter_disconnected(self, old_state, new_state):
+        self.tracking.cancel()
+
+
+    def exit_moving(self, old_state, new_state):
+        self.tracking.cancel()
+        if new_state not in stationary_states:
+            return
+        if self.move_start is not None:
+            self.move_ended(new_state)
+        if self.target_mode == TargetMode.RELATIVE:
             self.rel_target = 0
             self.calculate_target_reg()
 
-        self.motion_state = new_state
+
+    def exit_disconnected(self, old_state, new_state):
+        self.reconcile_position(self.last_reg)
+
+
+    def get_state_machine(self):
+        return self.machine
+
+
+    def start_tracking(self, speed):
+        # speed in steps / s, as sent to the motor
+        steps_per_deg = self.steps_per_deg
+        self.fault = None
+        self.tracking.start(
+            self.position_reg,
+            self.target_reg,
+            speed,
+            self.config.start_speed * steps_per_deg,
+            self.config.acceleration * steps_per_deg,
+        )
+
+
+    def tracking_fault(self):
+        error = self.tracking.last_error / self.steps_per_deg
+        self.tracking.cancel()
+        self.motor.quick_stop()
+        if error < 0:
+            self.fault = f'stall, {-error:.2f} degrees behind the planned position'
+        else:
+            self.fault = f'{error:.2f} degrees ahead of the planned position'
+        eventlog.error(
+            'controller', f'fault: {self.fault}', error_deg=error,
+            position=self.position_reg, target=self.target_reg)
+        if self.homing_phase is not None:
+            self.abort_homing('fault')
+
+
+    def homing_move(self, start_reg, distance, speed):
+        # Moves to distance degrees from start_reg in the homing direction,
+        # the controller sees this as a move to target_reg
+        self.start_reg = self.position_reg
+        self.move_speed = speed
+        self.target_reg = start_reg + self.home_sign * round(distance * self.steps_per_deg)
+        self.evaluate_state_transition()
+        self.motor.start_move_to_position(self.target_reg, speed * self.steps_per_deg)
+        self.start_tracking(speed * self.steps_per_deg)
+        self.evaluate_state_transition()
+
+
+    def advance_homing(self):
+        config = self.config
+        phase = self.homing_phase
+        state = self.motion_state
+        if state not in [MotionState.MOVING, MotionState.STOPPING,
+                         MotionState.IDLE, MotionState.READY_TO_MOVE]:
+            self.abort_homing('motor not powered')
+            return
+
+        stationary = state in [MotionState.IDLE, MotionState.READY_TO_MOVE]
+        if phase == 'seek':
+            if self.motor.is_home_switch_active():
+                self.home_trigger_reg = self.position_reg
+                self.motor.stop()
+                self.tracking.cancel()
+                self.homing_phase = 'seek_stop'
+            elif stationary:
+                self.abort_homing('home switch not found')
+        elif phase == 'seek_stop':
+            # The seek overruns the switch while braking, the back off is
+            # from where it triggered
+            if stationary:
+                self.homing_phase = 'backoff'
+                self.homing_move(self.home_trigger_reg, -config.home_backoff, config.home_seek_speed)
+        elif phase == 'backoff':
+            if stationary:
+                if self.motor.is_home_switch_active():
+                    self.abort_homing('still on the home switch after backing off')
+                    return
+                self.homing_phase = 'approach'
+                self.home_last_reg = self.position_reg
+                self.homing_move(self.position_reg, 2 * config.home_backoff, config.home_approach_speed)
+        elif phase == 'approach':
+            if self.motor.is_home_switch_active():
+                # The switch triggered between the last two samples
+                self.home_trigger_reg = (self.home_last_reg + self.position_reg) // 2
+                self.motor.stop()
+                self.tracking.cancel()
+                self.homing_phase = 'approach_stop'
+            elif stationary:
+                self.abort_homing('home switch not found on approach')
+            else:
+                self.home_last_reg = self.position_reg
+        elif phase == 'approach_stop':
+            if stationary:
+                self.homing_phase = None
+                self.position_anchor = config.home_angle, self.home_trigger_reg
+                self.target_reg = self.position_reg
+                self.evaluate_state_transition()
+                eventlog.info(
+                    'controller',
+                    f'homed, reference {config.home_angle} at register {self.home_trigger_reg}',
+                    angle=config.home_angle, register=self.home_trigger_reg)
+
+
+    def abort_homing(self, reason):
+        # Back to the target set by the operator
+        self.homing_phase = None
+        self.calculate_target_reg()
+        eventlog.warning('controller', f'homing aborted: {reason}')
+
+
+    def rebase_register(self):
+        # Moves the register back to the first revolution, the anchor and
+        # the registers derived from it move along, so angles are unchanged
+        position_reg = self.position_reg
+        new_reg = position_reg % self.config.steps_per_rev
+        shift = new_reg - position_reg
+        try:
+            self.motor.set_position(new_reg)
+        except RuntimeError as e:
+            # Not again for this motor
+            self.rebase_threshold = float('inf')
+            eventlog.warning('controller', f'position register not moved back: {e}')
+            return
+        anch_angle, anch_reg = self.position_anchor
+        self.position_anchor = anch_angle, anch_reg + shift
+        self.position_reg = new_reg
+        self.last_reg += shift
+        self.target_reg += shift
+        self.start_reg += shift
+        self.rebases += 1
+        eventlog.info(
+            'controller', f'position register moved from {position_reg} to {new_reg}',
+            old=position_reg, new=new_reg)
+
+
+    def reconcile_position(self, last_reg):
+        # A motor that kept its position register still matches the anchor.
+        # Otherwise the register was reset while disconnected, and the
+        # spindle is assumed not to have moved from the last known position.
+        if self.motor.is_position_retained():
+            return
+        anch_angle, anch_reg = self.position_anchor
+        self.position_anchor = anch_angle, anch_reg + self.position_reg - last_reg
+        self.calculate_target_reg()
+        eventlog.warning('controller', 'position register was reset, angle carried over')
+
+
+    def move_ended(self, new_state):
+        start_time, start_clock = self.move_start
+        self.move_start = None
+        if self.move_log is None:
+            return
+
+        if new_state == MotionState.IDLE:
+            reason = 'completed'
+        elif new_state == MotionState.UNPOWERED:
+            reason = 'power_off'
+        elif self.fault is not None:
+            reason = 'fault'
+        else:
+            reason = 'stopped'
+
+        steps_per_deg = self.steps_per_deg
+        self.move_log.record_move(
+            self.target_mode.value,
+            abs(self.target_reg - self.start_reg) / steps_per_deg,
+            abs(self.position_reg - self.start_reg) / steps_per_deg,
+            self.move_speed,
+            self.config.acceleration,
+            self.config.start_speed,
+            start_time,
+            self.clock() - start_clock,
+            reason,
+        )
 
 
     def calculate_target_reg(self):
         if self.target_mode == TargetMode.ABSOLUTE:
-            tgt_cw, tgt_ccw = self.find_target_candidates(self.abs_target)
-            if self.direction == Direction.CW:
+            parameter = self.abs_target
+        elif self.target_mode == TargetMode.RELATIVE:
+            parameter = self.rel_target
+        elif self.target_mode == TargetMode.DIVISION:
+            parameter = self.div_target
+
+        position_reg = self.motor.get_position()
+        mode = self.target_mode
+        self.target_reg = self.plan_target_reg(mode, parameter, position_reg)
+
+
+    def plan_target_reg(self, mode, parameter, position_reg, direction=None):
+        if direction is None:
+            direction = self.direction
+
+        if mode == TargetMode.ABSOLUTE:
+            candidates = self.find_target_candidates(parameter, position_reg)
+            tgt_cw, tgt_ccw = candidates
+            if direction == Direction.CW:
                 target_reg = tgt_cw
             else:
                 target_reg = tgt_ccw
-        elif self.target_mode == TargetMode.RELATIVE:
-            diff_reg = self.find_rel_target(self.rel_target)
-            if self.direction == Direction.CCW:
+        elif mode == TargetMode.RELATIVE:
+            diff_reg = self.find_rel_target(parameter)
+            if direction == Direction.CCW:
                 diff_reg = -diff_reg
-            position_reg = self.motor.get_position()
             target_reg = position_reg + diff_reg
-        elif self.target_mode == TargetMode.DIVISION:
-            tgt_angle = self.divs[self.div_target]
-            tgt_cw, tgt_ccw = self.find_target_candidates(tgt_angle)
-            position_reg = self.motor.get_position()
+        elif mode == TargetMode.DIVISION:
+            tgt_angle = self.divs[parameter]
+            candidates = self.find_target_candidates(tgt_angle, position_reg)
+            tgt_cw, tgt_ccw = candidates
             diff_cw = abs(position_reg - tgt_cw)
             diff_ccw = abs(position_reg - tgt_ccw)
             if(diff_cw <= diff_ccw):
@@ -304,13 +812,14 @@ class MotionController(object):
             else:
                 target_reg = tgt_ccw
 
-        self.target_reg = target_reg
+        return target_reg
 
 
-    def find_target_candidates(self, target_angle):
+    def find_target_candidates(self, target_angle, position_reg=None):
         anchor_angle, anchor_reg = self.position_anchor
         steps_per_rev = self.config.steps_per_rev
-        position_reg = self.motor.get_position()
+        if position_reg is None:
+            position_reg = self.motor.get_position()
         target_reg = self.angle_to_reg(target_angle)
         revs = int(position_reg / steps_per_rev)
 
@@ -327,7 +836,6 @@ class MotionController(object):
 
     def find_rel_target(self, rel_target):
         steps_per_rev = self.config.steps_per_rev
-        position_reg = self.motor.get_position()
         diff_reg = int(round(rel_target * steps_per_rev / 360))
         return diff_reg
 
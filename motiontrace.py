@@ -0,0 +1,199 @@
+import mmap
+import struct
+import time
+
+from enums import MotionState
+
+
+# File layout: a fixed header followed by a ring of fixed size records.
+# count is the total number of records written, the newest record is at
+# (count - 1) % capacity.
+header_format = '<8sIIQQ32x'
+header_size = struct.calcsize(header_format)
+magic = b'ROTTRACE'
+version = 2
+
+# time (s, of the controller clock), position (reg), velocity (reg / s), target (reg),
+# commanded top speed of the current or last move (reg / s), motion state
+# value
+record_format = '<dqdqdB7x'
+record_size = struct.calcsize(record_format)
+count_offset = 8 + 4 + 4 + 8
+
+
+class TraceRecorder(object):
+    def __init__(self, filename, capacity=1 << 20, clock=time.monotonic,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The controller's clock, simulated runs keep their own time
+        self.clock = clock
+        self.capacity = capacity
+        self.count = 0
+
+        size = header_size + capacity * record_size
+        with open(filename, 'wb') as f:
+            f.truncate(size)
+        self.file = open(filename, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        struct.pack_into(header_format, self.mm, 0,
+                         magic, version, record_size, capacity, 0)
+
+        self.pack_record = struct.Struct(record_format).pack_into
+        self.pack_count = struct.Struct('<Q').pack_into
+
+
+    def record(self, position, velocity, state, target, speed):
+        offset = header_size + (self.count % self.capacity) * record_size
+        self.pack_record(self.mm, offset, self.clock(), position,
+                         velocity, target, speed, state.value)
+        self.count += 1
+        self.pack_count(self.mm, count_offset, self.count)
+
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+def record_dtype():
+    import numpy as np
+    return np.dtype([
+        ('time', '<f8'),
+        ('position', '<i8'),
+        ('velocity', '<f8'),
+        ('target', '<i8'),
+        ('speed', '<f8'),
+        ('state', 'u1'),
+        ('pad', 'V7'),
+    ])
+
+
+def load_trace(filename):
+    # Returns the records in time order. The ring is mapped, not read, so
+    # the records are only copied if the ring has wrapped.
+    import numpy as np
+    with open(filename, 'rb') as f:
+        header = struct.unpack(header_format, f.read(header_size))
+    file_magic, file_version, file_record_size, capacity, count = header
+    if file_magic != magic:
+        raise RuntimeError('not a motion trace file')
+    if file_version != version:
+        raise RuntimeError(f'unsupported trace version {file_version}')
+    if file_record_size != record_size:
+        raise RuntimeError('unsupported trace record size')
+
+    records = np.memmap(filename, dtype=record_dtype(), mode='r',
+                        offset=header_size, shape=(capacity,))
+    if count <= capacity:
+        return records[:count]
+    start = count % capacity
+    return np.concatenate((records[start:], records[:start]))
+
+
+def find_moves(records):
+    import numpy as np
+    if len(records) == 0:
+        return []
+    moving_states = [MotionState.MOVING.value, MotionState.STOPPING.value]
+    moving = np.isin(records['state'], moving_states)
+    edges = np.diff(moving.astype(np.int8))
+    starts = np.flatnonzero(edges == 1) + 1
+    ends = np.flatnonzero(edges == -1) + 1
+    if moving[0]:
+        starts = np.concatenate(([0], starts))
+    # Discard a move still running at the end of the trace
+    return list(zip(starts, ends))
+
+
+def analyse_move(records, start, end, steps_per_deg, start_speed,
+                 acceleration, stall_time):
+    import numpy as np
+    from ordering import move_time
+
+    # The sample at end is the first stationary one
+    move = records[start:end + 1]
+    t = move['time']
+    pos = move['position']
+    vel = np.abs(move['velocity'])
+
+    # Moves start from the last stationary sample before motion
+    start_pos = records['position'][max(start - 1, 0)]
+    distance = abs(int(pos[-1]) - int(start_pos)) / steps_per_deg
+    duration = t[-1] - t[0]
+    peak_speed = vel.max() / steps_per_deg
+    command_speed = float(move['speed'][0]) / steps_per_deg
+
+    # Settle time runs from the first sample of the final standstill to the
+    # controller reporting the move as complete
+    running = np.flatnonzero(vel > 0)
+    if len(running) and running[-1] + 1 < len(move):
+        settle = t[-1] - t[running[-1] + 1]
+    else:
+        settle = 0.0
+
+    # A stall is a run of samples without position change before the end
+    changed = np.flatnonzero(np.diff(pos) != 0)
+    bounds = np.concatenate(([0], changed + 1, [len(pos) - 1]))
+    still = np.diff(t[bounds])
+    stalls = still[:-1][still[:-1] >= stall_time]
+
+    # Planned from the commanded speed, a move that fell short of it takes
+    # longer than planned
+    if command_speed > 0:
+        planned = float(move_time(distance, max(command_speed, start_speed),
+                                  start_speed, acceleration))
+    else:
+        planned = 0.0
+
+    state = MotionState(int(move['state'][-1])).name
+    return {
+        'start': float(t[0]),
+        'distance': distance,
+        'duration': duration,
+        'planned': planned,
+        'peak_speed': peak_speed,
+        'command_speed': command_speed,
+        'settle': settle,
+        'stalls': len(stalls),
+        'stall_time': float(stalls.sum()),
+        'end_state': state,
+    }
+
+
+def analyse(filename, config, stall_time=0.1):
+    records = load_trace(filename)
+    steps_per_deg = config.steps_per_rev / 360
+    results = []
+    for start, end in find_moves(records):
+        results.append(analyse_move(
+            records, start, end, steps_per_deg, config.start_speed,
+            config.acceleration, stall_time))
+    return results
+
+
+def main():
+    import argparse
+    from configuration import Configuration
+
+    p = argparse.ArgumentParser('motiontrace')
+    p.add_argument('trace', help='motion trace file')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('--stall-time', type=float, default=0.1, help='minimum standstill in s counted as stall')
+    args = p.parse_args()
+
+    config = Configuration(args.config)
+    results = analyse(args.trace, config, args.stall_time)
+
+    print(f'{"move":>5} {"dist °":>9} {"time s":>8} {"plan s":>8} '
+          f'{"cmd °/s":>8} {"peak °/s":>9} {"settle s":>9} {"stalls":>7} '
+          f'{"end":>14}')
+    for i, r in enumerate(results):
+        print(f'{i + 1:5} {r["distance"]:9.3f} {r["duration"]:8.3f} '
+              f'{r["planned"]:8.3f} {r["command_speed"]:8.3f} '
+              f'{r["peak_speed"]:9.3f} '
+              f'{r["settle"]:9.3f} {r["stalls"]:7} {r["end_state"]:>14}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 import math
-from datetime import datetime
+import threading
+import time
 from itertools import chain
 
+import eventlog
+from tictransport import TicTimeoutError
+
 class Motor(object):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -30,9 +34,18 @@ class Motor(object):
     def get_target_position(self):
         raise NotImplementedError('implement in subclass')
 
+    def get_velocity(self):
+        raise NotImplementedError('implement in subclass')
+
+    def is_position_retained(self):
+        raise NotImplementedError('implement in subclass')
+
     def setup_driver(self, num_microsteps, max_current):
         raise NotImplementedError('implement in subclass')
 
+    def set_current_limit(self, max_current):
+        raise NotImplementedError('implement in subclass')
+
     def set_acceleration(self, acceleration):
         raise NotImplementedError('implement in subclass')
 
@@ -45,11 +58,48 @@ class Motor(object):
     def stop(self):
         raise NotImplementedError('implement in subclass')
 
+    def get_stats(self):
+        # Device call statistics, if the backend collects them
+        return None
+
+    def is_connected(self):
+        # Backends that can lose their device connection override this
+        return True
+
+    def is_home_switch_active(self):
+        # Backends with a home switch override this
+        raise RuntimeError('motor has no home switch')
+
+    def quick_stop(self):
+        # Stops as fast as the backend can, for faults
+        self.stop()
+
+    def set_position(self, position):
+        # Sets the position register of the stationary motor, backends that
+        # can override this
+        raise RuntimeError('motor cannot set its position register')
+
+
+def open_tic_usb(serial_number=None):
+    from tictransport import UsbTransport
+    return UsbTransport(serial_number)
+
 
 class PololuT249(Motor):
     acceleration_factor = 100
     speed_factor = 10000
 
+    # Normal operation and soft error (e.g. command timeout), in both the
+    # motor is energized
+    retaining_op_states = [10, 4]
+
+    # Misc flags bits of the limit switch inputs, either can serve as the
+    # home switch. The input must be configured as a limit switch in the Tic.
+    limit_switch_flags = {
+        'forward': 0x04,
+        'reverse': 0x08,
+    }
+
     microstep_table = {
         1:  0,
         2:  1,
@@ -59,53 +109,214 @@ class PololuT249(Motor):
         32: 5,
     }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        import ticlib
-        self.device = ticlib.TicUSB()
+    # Raised when the connection to the Tic is lost: USBError of pyusb and
+    # SerialException of pyserial, both OSErrors, and TicTimeoutError of the
+    # transports on missing or short answers. Any other exception is a bug
+    # and is not taken for a lost connection.
+    transport_errors = (OSError, TicTimeoutError)
 
-        if self.device.usb.idProduct != ticlib.TIC_T249:
-            raise RuntimeError('Unknown Pololu device')
+    # Reconnect attempts start after this delay, doubling up to the maximum
+    reconnect_delay = 0.05
+    max_reconnect_delay = 2.0
 
-        #self.device.reset_command_timeout()
-        #self.device.exit_safe_start()
-        self.device.deenergize()
-        self.device.halt_and_set_position(0)
-        self.device.set_target_position(0)
+    def __init__(self, stats=None, keepalive_timeout=None, serial_number=None,
+                 open_device=None, home_switch='reverse', retain_position=False,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if home_switch not in self.limit_switch_flags:
+            raise ValueError(f'home switch must be one of {", ".join(self.limit_switch_flags)}')
+        self.home_switch_flag = self.limit_switch_flags[home_switch]
+        self.stats = stats
+        self.open_device = open_device or open_tic_usb
+        self.keepalive = None
+        self.keepalive_timeout = keepalive_timeout
+        self.device = self.wrap_device(self.open_device(serial_number))
+
+        # Reconnect to the same unit if the connection drops
+        self.serial_number = self.device.address
+        self.pipelined = self.device.pipelined
+        self.connected = True
+        self.new_device = None
+        self.reconnects = 0
+        self.settings = {}
+
+        # With retain_position, e.g. when a position journal is kept, and if
+        # the driver has stayed energized since the previous session, the
+        # position register still matches the spindle and is kept.
+        # Otherwise the Tic starts de-energized at position 0.
+        op_state = self.device.get_operation_state()
+        self.position_retained = (
+            retain_position and op_state in self.retaining_op_states)
+        if self.position_retained:
+            self.device.halt_and_hold()
+        else:
+            #self.device.reset_command_timeout()
+            #self.device.exit_safe_start()
+            self.device.deenergize()
+            self.device.halt_and_set_position(0)
+            self.device.set_target_position(0)
         self.stop_signal = False
-        for k, v in self.device.get_variables().items():
-            print(f'{k:40}: {v}')
+        self.velocity = 0
+        # Target of a commanded move the Tic has not been seen executing
+        # yet, None otherwise
+        self.move_pending = None
+        self.op_state = self.device.get_operation_state()
+        self.position = self.device.get_current_position()
+        eventlog.debug('motor', 'Tic variables', variables=self.device.get_variables())
+
+        if keepalive_timeout is not None:
+            from keepalive import KeepaliveLane
+            self.keepalive = KeepaliveLane(self.device, keepalive_timeout)
+
+
+    def wrap_device(self, device):
+        if self.stats is not None:
+            from usbstats import InstrumentedDevice
+            device = InstrumentedDevice(device, self.stats)
+        if self.keepalive_timeout is not None:
+            from keepalive import LockedDevice
+            device = LockedDevice(device)
+        return device
 
 
     def update_state(self):
-        self.device.reset_command_timeout()
-        self.device.exit_safe_start()
-        if self.stop_signal:
-            vel = self.device.get_current_velocity()
-            if vel == 0:
-                self.stop_signal = False
+        if not self.connected:
+            if self.new_device is not None:
+                self.attach_new_device()
+            return
+        if self.stats is not None:
+            self.stats.tick()
+        # The state read here serves the getters until the next tick
+        try:
+            refresh = self.keepalive is None or self.keepalive.is_due()
+            if self.pipelined:
+                state = self.device.poll(refresh)
+            else:
+                if refresh:
+                    self.device.reset_command_timeout()
+                self.device.exit_safe_start()
+                state = (
+                    self.device.get_operation_state(),
+                    self.device.get_current_position(),
+                    self.device.get_current_velocity(),
+                )
+            if refresh and self.keepalive is not None:
+                self.keepalive.refreshed('poll')
+        except self.transport_errors as e:
+            self.connection_lost(e)
+            return
+        self.op_state, self.position, self.velocity = state
+        if self.stop_signal and self.velocity == 0:
+            self.stop_signal = False
+        if self.move_pending is not None:
+            # Moving, or a short move completed between two polls, or the
+            # Tic will not move
+            done = (
+                self.velocity != 0 or
+                self.position == self.move_pending or
+                self.op_state != 10
+            )
+            if done:
+                self.move_pending = None
+
+
+    def connection_lost(self, error):
+        # Getters return the last known values until the reconnect thread
+        # has found the device again
+        if not self.connected:
+            return
+        self.connected = False
+        self.new_device = None
+        eventlog.warning('motor', f'Tic connection lost: {error}')
+        thread = threading.Thread(
+            target=self.reconnect, name='tic-reconnect', daemon=True)
+        thread.start()
+
+
+    def reconnect(self):
+        delay = self.reconnect_delay
+        while True:
+            time.sleep(delay)
+            try:
+                self.new_device = self.open_device(self.serial_number)
+                return
+            except Exception:
+                delay = min(2 * delay, self.max_reconnect_delay)
+
+
+    def attach_new_device(self):
+        # Runs in the polling thread, the reconnect thread only opens the
+        # device
+        device = self.wrap_device(self.new_device)
+        self.new_device = None
+        try:
+            op_state = device.get_operation_state()
+            self.device = device
+            self.pipelined = device.pipelined
+            self.connected = True
+            # A Tic that stayed energized kept its position register and
+            # any move in progress continues. Otherwise it has been reset,
+            # and the driver settings are sent again.
+            self.position_retained = op_state in self.retaining_op_states
+            if not self.position_retained:
+                for name, args in self.settings.items():
+                    getattr(self, name)(*args)
+            self.op_state = device.get_operation_state()
+            self.position = device.get_current_position()
+            self.velocity = device.get_current_velocity()
+        except self.transport_errors as e:
+            self.connected = True
+            self.connection_lost(e)
+            return
+        if self.keepalive is not None:
+            self.keepalive.device = device
+        self.reconnects += 1
+        eventlog.info('motor', f'Tic reconnected, position {self.position}', position=self.position)
+
+
+    def command(self, name, *args):
+        # A lost connection rejects the event like any invalid event
+        if not self.connected:
+            raise RuntimeError('Tic is disconnected')
+        try:
+            return getattr(self.device, name)(*args)
+        except self.transport_errors as e:
+            self.connection_lost(e)
+            raise RuntimeError(f'Tic connection lost: {e}') from e
 
 
     def set_power_on(self):
-        self.device.energize()
-        for k, v in self.device.get_variables().items():
-            print(f'{k:40}: {v}')
+        self.command('energize')
+        self.print_variables()
 
 
     def set_power_off(self):
-        self.device.deenergize()
-        for k, v in self.device.get_variables().items():
-            print(f'{k:40}: {v}')
+        self.command('deenergize')
+        self.print_variables()
+
+
+    def print_variables(self):
+        # The controller evaluates its state right after a power event, the
+        # variables read here bring the polled state up to date
+        variables = self.command('get_variables')
+        eventlog.debug('motor', 'Tic variables', variables=variables)
+        self.op_state = variables['operation_state']
+        self.position = variables['current_position']
+        self.velocity = variables['current_velocity']
+
+
+    def is_connected(self):
+        return self.connected
 
 
     def is_energized(self):
-        op_state = self.device.get_operation_state()
-        return op_state == 10
+        return self.op_state == 10
 
 
     def is_moving(self):
-        vel = self.device.get_current_velocity()
-        return vel != 0
+        # A commanded move counts as moving at once, not only from the next
+        # poll on
+        return self.velocity != 0 or self.move_pending is not None
 
 
     def is_stopping(self):
@@ -113,20 +324,41 @@ class PololuT249(Motor):
 
 
     def get_position(self):
-        return self.device.get_current_position()
+        return self.position
 
 
     def get_target_position(self):
-        return self.device.get_target_position()
+        return self.command('get_target_position')
+
+
+    def get_velocity(self):
+        return self.velocity / self.speed_factor
+
+
+    def is_position_retained(self):
+        return self.position_retained
+
+
+    def is_home_switch_active(self):
+        # Read when asked, only homing needs the switch
+        return bool(self.command('get_misc_flags') & self.home_switch_flag)
 
 
     def setup_driver(self, num_microsteps, max_current):
+        self.set_step_mode(num_microsteps)
+        self.set_current_limit(max_current)
+
+
+    def set_step_mode(self, num_microsteps):
         if num_microsteps in self.microstep_table:
             value = self.microstep_table[num_microsteps]
         else:
             raise ValueError('num_microsteps is invalid, check datasheet')
-        self.device.set_step_mode(value)
-        
+        self.command('set_step_mode', value)
+        self.settings['set_step_mode'] = num_microsteps,
+
+
+    def set_current_limit(self, max_current):
         r = chain(range(0, 32), range(32, 64, 2), range(64, 128, 4))
         allowed_vals = list(r)
         requested_value = int(max_current / 40)
@@ -144,40 +376,74 @@ class PololuT249(Motor):
 
         current = value * 40
         if current != max_current:
-            print(f'current {max_current} not selectable, using {current}')
-        self.device.set_current_limit(value)
+            eventlog.warning('motor', f'current {max_current} not selectable, using {current}')
+        self.command('set_current_limit', value)
+        self.settings['set_current_limit'] = max_current,
 
 
     def set_acceleration(self, acceleration):
         value = acceleration * self.acceleration_factor
-        self.device.set_max_acceleration(int(value))
-        self.device.set_max_deceleration(0)
+        self.command('set_max_acceleration', int(value))
+        self.command('set_max_deceleration', 0)
+        self.settings['set_acceleration'] = acceleration,
 
 
     def set_start_speed(self, start_speed):
         value = start_speed * self.speed_factor
-        self.device.set_starting_speed(int(value))
+        self.command('set_starting_speed', int(value))
+        self.settings['set_start_speed'] = start_speed,
 
 
     def start_move_to_position(self, target_position, top_speed):
         value = top_speed * self.speed_factor
         max_value = 50000 * 10000
         if value > max_value:
-            print('Speed out of range, constraining')
+            eventlog.warning('motor', 'Speed out of range, constraining')
             value = max_value
-        self.device.set_max_speed(int(value))
-        self.device.set_target_position(int(target_position))
+        self.command('set_max_speed', int(value))
+        self.command('set_target_position', int(target_position))
+        self.move_pending = int(target_position)
 
 
     def stop(self):
-        self.device.set_target_velocity(0)
-        self.stop_signal = True        
+        self.command('set_target_velocity', 0)
+        self.stop_signal = True
+        if self.move_pending is not None:
+            # Not polled since the move was commanded, whether the Tic has
+            # started decides between stopping and stationary
+            self.move_pending = None
+            self.velocity = self.command('get_current_velocity')
+
+
+    def quick_stop(self):
+        # Abrupt, without deceleration
+        self.command('halt_and_hold')
+        self.stop_signal = False
+        self.velocity = 0
+        self.move_pending = None
+
+
+    def set_position(self, position):
+        self.command('halt_and_set_position', int(position))
+        self.position = int(position)
+
+
+    def get_stats(self):
+        return self.stats
 
 
 class FakeMotor(Motor):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, clock=time.monotonic, home_switch=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # Time in seconds, replaceable by a simulated clock
+        self.clock = clock
+
+        # Simulated home switch as (position, width, period) in steps, active
+        # from position for width steps, repeating every period steps if
+        # period is not None
+        self.home_switch = home_switch
+
         self.power_on = False
         self.moving = False
         self.position = 0
@@ -204,6 +470,29 @@ class FakeMotor(Motor):
         return self.target
 
 
+    def get_velocity(self):
+        if not self.moving:
+            return 0
+        elif (self.target - self.start_position) > 0:
+            return self.speed
+        else:
+            return -self.speed
+
+
+    def is_position_retained(self):
+        return False
+
+
+    def is_home_switch_active(self):
+        if self.home_switch is None:
+            raise RuntimeError('motor has no home switch')
+        position, width, period = self.home_switch
+        offset = self.position - position
+        if period is not None:
+            offset %= period
+        return 0 <= offset < width
+
+
     def set_acceleration(self, acceleration):
         self.acceleration = acceleration
 
@@ -261,7 +550,7 @@ class FakeMotor(Motor):
         self.start_position = self.position
         self.stop_signal = False
         self.moving = True
-        self.start_time = datetime.now()
+        self.start_time = self.clock()
         self.t1 = time_acc
         self.t2 = self.t1 + time_full_speed
         self.t3 = self.t2 + time_dec
@@ -288,12 +577,26 @@ class FakeMotor(Motor):
         self.update_state()
 
 
+    def quick_stop(self):
+        self.update_state()
+        self.moving = False
+        self.speed = 0
+        self.stop_signal = False
+
+
+    def set_position(self, position):
+        if self.moving:
+            raise RuntimeError('attempted to set position while moving')
+        self.position = position
+        self.target = position
+
+
     def update_state(self):
         if not self.moving:
             return
 
         # Calculate speed and distance moved from start of move
-        t = (datetime.now() - self.start_time).total_seconds()
+        t = self.clock() - self.start_time
         if t < self.t1:
             t_off = t
             speed = self.start_speed + self.acceleration * t_off
@@ -341,3 +644,7 @@ class FakeMotor(Motor):
 
     def setup_driver(self, num_microsteps, max_current):
         pass
+
+
+    def set_current_limit(self, max_current):
+        pass
@@ -0,0 +1,277 @@
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from motor import Motor
+
+
+# State block published by the daemon, guarded by a seqlock: the sequence
+# number is odd while the daemon writes, and a reader retries until it sees
+# the same even number before and after reading.
+#   seq, heartbeat, stamp, position, velocity,
+#   energized, moving, stopping, position_retained, home_switch
+# home_switch is 0 or 1, or no_home_switch if the motor has none.
+state_format = struct.Struct('<QQdqdBBBBB19x')
+seq_format = struct.Struct('<Q')
+block_size = 64
+no_home_switch = 2
+
+# Methods executed in the daemon on request of the GUI process
+commands = {
+    'set_power_on',
+    'set_power_off',
+    'setup_driver',
+    'set_current_limit',
+    'set_acceleration',
+    'set_start_speed',
+    'start_move_to_position',
+    'stop',
+    'get_target_position',
+    'set_position',
+    'quick_stop',
+}
+
+
+def make_motor(backend, config_file, options):
+    from backends import create_motor
+    from configuration import Configuration
+    config = None if config_file is None else Configuration(config_file)
+    return create_motor(backend, config, **options)
+
+
+class StateWriter(object):
+    def __init__(self, buf, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buf = buf
+        self.seq = 0
+        self.heartbeat = 0
+
+
+    def publish(self, motor: Motor):
+        # Read the device before entering the write section, so readers
+        # never spin on a USB transfer
+        energized = motor.is_energized()
+        moving = motor.is_moving()
+        stopping = motor.is_stopping()
+        position = motor.get_position()
+        velocity = motor.get_velocity()
+        retained = motor.is_position_retained()
+        try:
+            home_switch = motor.is_home_switch_active()
+        except RuntimeError:
+            home_switch = no_home_switch
+        self.heartbeat += 1
+
+        self.seq += 1
+        seq_format.pack_into(self.buf, 0, self.seq)
+        state_format.pack_into(
+            self.buf, 0, self.seq, self.heartbeat, time.monotonic(),
+            position, velocity, energized, moving, stopping, retained,
+            home_switch)
+        self.seq += 1
+        seq_format.pack_into(self.buf, 0, self.seq)
+
+
+def run_daemon(backend, config_file, options, shm_name, conn, interval):
+    # Polls the motor every interval seconds, independent of the GUI, and
+    # executes commands arriving on conn in between. If the GUI process goes
+    # away the motor is brought to a controlled stop before exiting.
+    shm = shared_memory.SharedMemory(name=shm_name)
+    writer = StateWriter(shm.buf)
+    try:
+        motor = make_motor(backend, config_file, options)
+    except Exception as e:
+        conn.send(('error', e))
+        shm.close()
+        return
+    writer.publish(motor)
+    conn.send(('ok', None))
+
+    next_time = time.monotonic() + interval
+    try:
+        while True:
+            timeout = next_time - time.monotonic()
+            if timeout > 0 and conn.poll(timeout):
+                try:
+                    name, args = conn.recv()
+                except EOFError:
+                    stop_motor(motor, writer, interval)
+                    break
+                if name == 'close':
+                    break
+                try:
+                    if name not in commands:
+                        raise ValueError(f'unknown motor command {name}')
+                    result = getattr(motor, name)(*args)
+                    reply = ('ok', result)
+                except Exception as e:
+                    reply = ('error', e)
+                writer.publish(motor)
+                try:
+                    conn.send(reply)
+                except OSError:
+                    stop_motor(motor, writer, interval)
+                    break
+                continue
+
+            motor.update_state()
+            writer.publish(motor)
+            next_time += interval
+            now = time.monotonic()
+            if next_time < now:
+                # Overrun, skip the missed periods rather than bunching up
+                next_time = now + interval
+    finally:
+        # The writer holds a view of the buffer
+        writer.buf = None
+        shm.close()
+
+
+def stop_motor(motor, writer, interval):
+    if motor.is_moving():
+        motor.stop()
+    while motor.is_moving():
+        time.sleep(interval)
+        motor.update_state()
+        writer.publish(motor)
+
+
+class RemoteMotor(Motor):
+    # Motor running in a separate process. The state getters read the
+    # latest published state block, which update_state refreshes once per
+    # tick without a system call. Commands are round trips over a pipe and
+    # return after the daemon has executed them and published the result.
+    # The daemon creates the motor as create_motor would in this process,
+    # from the configuration file and the backend options, which must be
+    # picklable.
+    stale_timeout = 1.0
+
+    def __init__(self, backend='fake', config_file=None, options=None,
+                 interval=0.02, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shm = shared_memory.SharedMemory(create=True, size=block_size)
+        self.shm.buf[:block_size] = bytes(block_size)
+
+        # Spawned rather than forked, the child must not inherit Qt state
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_daemon,
+            args=(backend, config_file, options or {}, self.shm.name,
+                  child_conn, interval),
+            name='motor-daemon',
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.receive()
+        self.read_state()
+
+
+    def read_state(self):
+        buf = self.shm.buf
+        while True:
+            seq = seq_format.unpack_from(buf, 0)[0]
+            if seq & 1:
+                continue
+            state = state_format.unpack_from(buf, 0)
+            if state[0] == seq and seq_format.unpack_from(buf, 0)[0] == seq:
+                break
+        (_, self.heartbeat, self.stamp, self.position, self.velocity,
+         energized, moving, stopping, retained, self.home_switch) = state
+        self.energized = bool(energized)
+        self.moving = bool(moving)
+        self.stopping = bool(stopping)
+        self.position_retained = bool(retained)
+
+
+    def receive(self):
+        try:
+            status, value = self.conn.recv()
+        except EOFError:
+            raise RuntimeError('motor daemon exited') from None
+        if status == 'error':
+            raise value
+        return value
+
+
+    def call(self, name, *args):
+        self.conn.send((name, args))
+        value = self.receive()
+        self.read_state()
+        return value
+
+
+    def update_state(self):
+        self.read_state()
+        if time.monotonic() - self.stamp > self.stale_timeout:
+            if not self.process.is_alive():
+                raise RuntimeError('motor daemon exited')
+
+
+    def set_power_on(self):
+        self.call('set_power_on')
+
+    def set_power_off(self):
+        self.call('set_power_off')
+
+    def is_energized(self):
+        return self.energized
+
+    def is_moving(self):
+        return self.moving
+
+    def is_stopping(self):
+        return self.stopping
+
+    def get_position(self):
+        return self.position
+
+    def get_target_position(self):
+        return self.call('get_target_position')
+
+    def get_velocity(self):
+        return self.velocity
+
+    def is_position_retained(self):
+        return self.position_retained
+
+    def setup_driver(self, num_microsteps, max_current):
+        self.call('setup_driver', num_microsteps, max_current)
+
+    def set_current_limit(self, max_current):
+        self.call('set_current_limit', max_current)
+
+    def set_acceleration(self, acceleration):
+        self.call('set_acceleration', acceleration)
+
+    def set_start_speed(self, start_speed):
+        self.call('set_start_speed', start_speed)
+
+    def start_move_to_position(self, target_position, top_speed):
+        self.call('start_move_to_position', target_position, top_speed)
+
+    def stop(self):
+        self.call('stop')
+
+    def set_position(self, position):
+        self.call('set_position', position)
+
+    def is_home_switch_active(self):
+        if self.home_switch == no_home_switch:
+            return super().is_home_switch_active()
+        return bool(self.home_switch)
+
+    def quick_stop(self):
+        self.call('quick_stop')
+
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(('close', ()))
+            self.process.join(5)
+        self.conn.close()
+        self.shm.close()
+        self.shm.unlink()
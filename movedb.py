@@ -0,0 +1,182 @@
+import math
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS moves (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    date TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    distance REAL NOT NULL,
+    moved REAL NOT NULL,
+    speed REAL NOT NULL,
+    acceleration REAL NOT NULL,
+    start_speed REAL NOT NULL,
+    planned REAL NOT NULL,
+    duration REAL NOT NULL,
+    reason TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS moves_mode ON moves (mode);
+CREATE INDEX IF NOT EXISTS moves_date ON moves (date);
+'''
+
+columns = [
+    'time', 'date', 'mode', 'distance', 'moved', 'speed', 'acceleration',
+    'start_speed', 'planned', 'duration', 'reason',
+]
+
+
+class MoveDatabase(object):
+    # Completed moves are queued by the controller and inserted by a
+    # background thread, one transaction per batch.
+    def __init__(self, filename, batch_interval=2.0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.batch_interval = batch_interval
+
+        with sqlite3.connect(filename) as db:
+            db.executescript(schema)
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+
+    def record_move(self, mode, distance, moved, speed, acceleration,
+                    start_speed, start_time, duration, reason):
+        move = (mode, distance, moved, speed, acceleration, start_speed,
+                start_time, duration, reason)
+        self.queue.put(move)
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def writer(self):
+        from ordering import move_time
+
+        db = sqlite3.connect(self.filename)
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+
+            rows = []
+            for move in batch:
+                (mode, distance, moved, speed, acceleration, start_speed,
+                 start_time, duration, reason) = move
+                planned = float(move_time(distance, speed, start_speed,
+                                          acceleration))
+                date = datetime.fromtimestamp(start_time).date().isoformat()
+                rows.append((start_time, date, mode, distance, moved, speed,
+                             acceleration, start_speed, planned, duration,
+                             reason))
+
+            if rows:
+                with db:
+                    db.executemany(
+                        f'INSERT INTO moves ({", ".join(columns)}) '
+                        f'VALUES ({", ".join("?" * len(columns))})',
+                        rows)
+        db.close()
+
+
+def percentile(values, p):
+    # Nearest rank percentile of sorted values
+    rank = math.ceil(p / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def query_moves(db, mode=None, since=None, reason=None):
+    where = []
+    args = []
+    if mode is not None:
+        where.append('mode = ?')
+        args.append(mode)
+    if since is not None:
+        where.append('date >= ?')
+        args.append(since)
+    if reason is not None:
+        where.append('reason = ?')
+        args.append(reason)
+    query = 'SELECT mode, speed, distance, planned, duration, date FROM moves'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    return db.execute(query + ' ORDER BY time', args).fetchall()
+
+
+def report(filename, mode=None, since=None, reason='completed'):
+    db = sqlite3.connect(filename)
+    rows = query_moves(db, mode, since, reason)
+    db.close()
+
+    groups = {}
+    for row_mode, speed, distance, planned, duration, date in rows:
+        groups.setdefault((row_mode, speed), []).append((duration, planned))
+
+    print('Move durations by mode and speed')
+    print(f'{"mode":>15} {"°/s":>6} {"moves":>6} {"p50 s":>8} {"p90 s":>8} '
+          f'{"p99 s":>8} {"max s":>8} {"vs plan":>8}')
+    for (row_mode, speed), moves in sorted(groups.items()):
+        durations = sorted(d for d, p in moves)
+        overrun = sum(d for d, p in moves) / max(sum(p for d, p in moves), 1e-9)
+        print(f'{row_mode:>15} {speed:6.2f} {len(moves):6} '
+              f'{percentile(durations, 50):8.3f} '
+              f'{percentile(durations, 90):8.3f} '
+              f'{percentile(durations, 99):8.3f} '
+              f'{durations[-1]:8.3f} {overrun:8.2f}')
+
+    days = {}
+    for row_mode, speed, distance, planned, duration, date in rows:
+        day = days.setdefault(date, [0, 0.0, 0.0])
+        day[0] += 1
+        day[1] += duration
+        day[2] += distance
+
+    print()
+    print('Daily trend')
+    print(f'{"date":>10} {"moves":>6} {"mean s":>8} {"total s":>9} {"mean °":>8}')
+    for date, (n, total, distance) in sorted(days.items()):
+        print(f'{date:>10} {n:6} {total / n:8.3f} {total:9.1f} '
+              f'{distance / n:8.3f}')
+
+
+def main():
+    import argparse
+    from enums import TargetMode
+
+    modes = {m.name.lower(): m.value for m in TargetMode}
+
+    p = argparse.ArgumentParser('movedb')
+    p.add_argument('database', help='move database file')
+    p.add_argument('-m', '--mode', choices=modes, help='only moves in this target mode')
+    p.add_argument('-s', '--since', metavar='YYYY-MM-DD', help='only moves from this date')
+    p.add_argument('-r', '--reason', default='completed', help='only moves ending with this reason (all for any)')
+    args = p.parse_args()
+
+    mode = modes[args.mode] if args.mode else None
+    reason = None if args.reason == 'all' else args.reason
+    report(args.database, mode, args.since, reason)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import numpy as np
+
+from enums import Direction
+
+
+def move_time(distance, speed, start_speed, acceleration):
+    # Duration of trapezoidal moves starting and ending at start_speed, for
+    # an array of distances. Units are degrees, seconds.
+    distance = np.abs(np.asarray(distance, dtype=float))
+    dist_acc = (speed**2 - start_speed**2) / (2 * acceleration)
+
+    # Moves reaching top speed
+    time_acc = (speed - start_speed) / acceleration
+    full = 2 * time_acc + (distance - 2 * dist_acc) / speed
+
+    # Moves that start decelerating before reaching top speed
+    peak = np.sqrt(start_speed**2 + acceleration * distance)
+    short = 2 * (peak - start_speed) / acceleration
+
+    time = np.where(distance > 2 * dist_acc, full, short)
+    return np.where(distance > 0, time, 0.0)
+
+
+def optimise_visit_order(start_angle, angles, speed, start_speed, acceleration,
+                         direction=None, approach=None, backlash=0.0):
+    # Find the order and directions to visit all angles from start_angle in
+    # the least total move time.
+    #
+    # direction restricts all moves to one direction. approach requests the
+    # final approach to every target from one direction to take up backlash;
+    # moves the other way overshoot by backlash degrees and come back.
+    #
+    # Without a direction restriction the visited targets always form an arc
+    # around the start, growing at either end. Dynamic programming over the
+    # number of targets visited on each side gives the optimal tour among
+    # those in O(n^2) time, vectorised over each layer of the table.
+    angles = np.asarray(angles, dtype=float) % 360
+    n = len(angles)
+    if n == 0:
+        return np.zeros(0, dtype=int), [], 0.0
+
+    offsets = (angles - start_angle) % 360
+
+    def cost(distance, move_dir):
+        t = move_time(distance, speed, start_speed, acceleration)
+        if approach is not None and move_dir != approach and backlash > 0:
+            overshoot = move_time(np.asarray(distance) + backlash, speed,
+                                  start_speed, acceleration)
+            back = move_time(backlash, speed, start_speed, acceleration)
+            t = np.where(t > 0, overshoot + back, 0.0)
+        return t
+
+    if direction is not None:
+        if direction == Direction.CW:
+            order = np.argsort(offsets, kind='stable')
+            pos = offsets[order]
+        else:
+            order = np.argsort((360 - offsets) % 360, kind='stable')
+            pos = (360 - offsets[order]) % 360
+        dists = np.diff(np.concatenate(([0.0], pos)))
+        total = float(np.sum(cost(dists, direction)))
+        return order, [direction] * n, total
+
+    order = np.argsort(offsets, kind='stable')
+    # Cumulative distance to the k:th closest target on the CW and CCW side
+    cw = np.concatenate(([0.0], offsets[order]))
+    ccw = np.concatenate(([0.0], 360 - offsets[order][::-1]))
+
+    inf = np.inf
+    # f[i]: i targets visited CW, m - i CCW, standing at the CW end
+    # g[i]: as f, standing at the CCW end
+    f = np.array([0.0])
+    g = np.array([0.0])
+    f_choices = []
+    g_choices = []
+
+    for m in range(n):
+        i = np.arange(m + 2)
+        j = m + 1 - i
+        f_new = np.full(m + 2, inf)
+        g_new = np.full(m + 2, inf)
+        f_from_g = np.zeros(m + 2, dtype=bool)
+        g_from_f = np.zeros(m + 2, dtype=bool)
+
+        # Extend the CW end, from (i - 1, j)
+        k = i[1:]
+        jk = j[1:]
+        stay = f[k - 1] + cost(cw[k] - cw[k - 1], Direction.CW)
+        cross = g[k - 1] + cost(cw[k] + ccw[jk], Direction.CW)
+        f_new[1:] = np.minimum(stay, cross)
+        f_from_g[1:] = cross < stay
+
+        # Extend the CCW end, from (i, j - 1)
+        k = i[:-1]
+        jk = j[:-1]
+        stay = g[k] + cost(ccw[jk] - ccw[jk - 1], Direction.CCW)
+        cross = f[k] + cost(cw[k] + ccw[jk], Direction.CCW)
+        g_new[:-1] = np.minimum(stay, cross)
+        g_from_f[:-1] = cross < stay
+
+        f, g = f_new, g_new
+        f_choices.append(f_from_g)
+        g_choices.append(g_from_f)
+
+    # Walk back through the choices from the cheapest final state
+    i = int(np.argmin(np.minimum(f, g)))
+    at_cw = f[i] <= g[i]
+    total = float(min(f[i], g[i]))
+
+    visits = []
+    directions = []
+    for m in range(n, 0, -1):
+        j = m - i
+        if at_cw:
+            visits.append(order[i - 1])
+            directions.append(Direction.CW)
+            at_cw = not f_choices[m - 1][i]
+            i -= 1
+        else:
+            visits.append(order[n - j])
+            directions.append(Direction.CCW)
+            at_cw = bool(g_choices[m - 1][i])
+
+    visits.reverse()
+    directions.reverse()
+    return np.array(visits, dtype=int), directions, total
@@ -1,9 +1,9 @@
-from PyQt5.QtCore import *
-from enum import Enum
+from PyQt5.QtCore import QObject, QSocketNotifier, QTimer, pyqtSlot
+
+import eventlog
 from enums import TargetMode, MotionState, Direction
 from motion import MotionController
 from ui import MainWindow
-from configuration import Configuration
 
 
 class Presenter(QObject):
@@ -14,6 +14,11 @@ class Presenter(QObject):
         self.ui = ui
         self.timer = QTimer(self)
         self.timer.setInterval(200)
+        self.cnc = None
+        self.job = None
+        self.group = None
+        self.config_watcher = None
+        self.pending_config = None
 
         self.setup_ui()
         self.setup_connections()
@@ -34,6 +39,85 @@ class Presenter(QObject):
         self.ui.ccw_pressed.connect(self.ccw_pressed)
         self.ui.power_pressed.connect(self.power_pressed)
         self.ui.start_stop_pressed.connect(self.start_stop_pressed)
+        self.ui.stats_requested.connect(self.stats_requested)
+        self.ui.home_requested.connect(self.home_requested)
+        self.ui.job_pause_requested.connect(self.job_pause_requested)
+        self.ui.job_restart_requested.connect(self.job_restart_requested)
+
+
+    def attach_cnc(self, cnc):
+        self.cnc = cnc
+        self.cnc_notifier = QSocketNotifier(cnc.fileno(), QSocketNotifier.Read, self)
+        self.cnc_notifier.activated.connect(self.cnc_readable)
+
+
+    def attach_job(self, job):
+        self.job = job
+
+
+    def attach_config_watcher(self, watcher):
+        self.config_watcher = watcher
+        self.config_notifier = QSocketNotifier(watcher.fileno(), QSocketNotifier.Read, self)
+        self.config_notifier.activated.connect(self.config_changed)
+
+
+    def attach_axis_group(self, group):
+        # The group polls all axes together, this presenter then only
+        # updates its window. Start/stop acts on the whole group.
+        self.group = group
+        self.timer.stop()
+
+
+    @pyqtSlot()
+    def cnc_readable(self):
+        self.cnc.event_readable()
+        state = self.controller.get_motion_state()
+        if self.group is None and state in [MotionState.MOVING, MotionState.STOPPING]:
+            # Poll the move from now on, so that its end is answered promptly
+            self.timer.start(20)
+        self.update_target_mode()
+        self.update_abs_target(force=True)
+        self.update_div_target(force=True)
+        self.update_divs()
+        self.update_speed()
+        self.update_progress()
+        self.update_motion_state()
+
+
+    @pyqtSlot()
+    def config_changed(self):
+        if not self.config_watcher.read_changed():
+            return
+        try:
+            self.pending_config = self.controller.config.reload()
+        except Exception as e:
+            eventlog.warning('ui', f'configuration not reloaded: {e}')
+            return
+        if not self.controller.is_event_valid('config_set'):
+            eventlog.info('ui', 'configuration changed, applied when the table is ready')
+        self.apply_pending_config()
+
+
+    def apply_pending_config(self):
+        # The configuration stays pending while the controller refuses it,
+        # e.g. during a move, homing or a lost connection, and is dropped
+        # only once applied or rejected as invalid
+        if not self.controller.is_event_valid('config_set'):
+            return
+        config = self.pending_config
+        try:
+            changed = self.controller.event_config_set(config)
+        except ValueError as e:
+            self.pending_config = None
+            eventlog.warning('ui', f'configuration not applied: {e}')
+            return
+        except RuntimeError as e:
+            eventlog.debug('ui', f'configuration not applied yet: {e}')
+            return
+        self.pending_config = None
+        if changed:
+            eventlog.info('ui', f'configuration reloaded, applied {", ".join(changed)}', changed=changed)
+        self.update_speed()
 
 
     @pyqtSlot(TargetMode)
@@ -47,7 +131,7 @@ class Presenter(QObject):
             self.update_div_target(force=True)
         self.update_divs()
         self.update_motion_state()
-        print(f'mode changed to {mode}')
+        eventlog.info('ui', f'mode changed to {mode}', mode=mode.name)
 
 
     @pyqtSlot(float)
@@ -55,7 +139,7 @@ class Presenter(QObject):
         self.controller.event_position_set(position)
         self.update_position()
         self.update_motion_state()
-        print(f'position changed to {position}')
+        eventlog.info('ui', f'position changed to {position}', position=position)
 
 
     @pyqtSlot(float)
@@ -63,7 +147,7 @@ class Presenter(QObject):
         self.controller.event_target_set(target)
         self.update_abs_target()
         self.update_motion_state()
-        print(f'absolute target set to {target}')
+        eventlog.info('ui', f'absolute target set to {target}', target=target)
 
 
     @pyqtSlot(float)
@@ -71,7 +155,7 @@ class Presenter(QObject):
         self.controller.event_target_set(target)
         self.update_rel_target()
         self.update_motion_state()
-        print(f'relative target set to {target}')
+        eventlog.info('ui', f'relative target set to {target}', target=target)
 
 
     @pyqtSlot(int)
@@ -79,7 +163,7 @@ class Presenter(QObject):
         self.controller.event_target_set(target - 1)
         self.update_div_target()
         self.update_motion_state()
-        print(f'division target set to {target}')
+        eventlog.info('ui', f'division target set to {target}', target=target)
 
 
     @pyqtSlot(int, float, float)
@@ -88,14 +172,16 @@ class Presenter(QObject):
         self.update_divs()
         self.update_div_target()
         self.update_motion_state()
-        print(f'division parameters set; {num_divs}, {start_angle}, {extent}')
+        eventlog.info(
+            'ui', f'division parameters set; {num_divs}, {start_angle}, {extent}',
+            num_divs=num_divs, start_angle=start_angle, extent=extent)
 
 
     @pyqtSlot(float)
     def speed_set(self, speed):
         self.controller.event_speed_set(speed)
         self.update_speed()
-        print(f'speed set to {speed}')
+        eventlog.info('ui', f'speed set to {speed}', speed=speed)
 
 
     @pyqtSlot()
@@ -104,7 +190,7 @@ class Presenter(QObject):
         self.update_direction()
         if self.controller.get_target_mode() == TargetMode.RELATIVE:
             self.update_rel_target()
-        print('direction clockwise')
+        eventlog.info('ui', 'direction clockwise', direction='CW')
 
 
     @pyqtSlot()
@@ -113,7 +199,7 @@ class Presenter(QObject):
         self.update_direction()
         if self.controller.get_target_mode() == TargetMode.RELATIVE:
             self.update_rel_target()
-        print('direction counter-clockwise')
+        eventlog.info('ui', 'direction counter-clockwise', direction='CCW')
 
 
     @pyqtSlot()
@@ -121,28 +207,97 @@ class Presenter(QObject):
         self.controller.event_power()
         self.update_progress()
         self.update_motion_state()
-        print('power pressed')
+        eventlog.info('ui', 'power pressed')
 
 
     @pyqtSlot()
     def start_stop_pressed(self):
-        self.controller.event_start_stop()
+        state = self.controller.get_motion_state()
+        job_paused = self.job is not None and self.job.is_paused()
+        job_running = self.job is not None and self.job.is_running()
+        if self.group is not None:
+            self.group.event_start_stop()
+        elif job_paused and state != MotionState.MOVING:
+            self.job.resume()
+            self.job.event_periodic()
+        elif job_running and state not in [MotionState.MOVING, MotionState.STOPPING]:
+            # Between moves, e.g. in a dwell or waiting for the cut
+            self.job.pause()
+        else:
+            self.controller.event_start_stop()
+        self.update_progress()
+        self.update_motion_state()
+        eventlog.info('ui', 'start/stop pressed')
+
+
+    @pyqtSlot()
+    def stats_requested(self):
+        stats = self.controller.get_device_stats()
+        if stats is None:
+            self.ui.stats_updated([], 0, 0.0, 0)
+        else:
+            ticks, mean, peak = stats.get_tick_summary()
+            self.ui.stats_updated(stats.get_rows(), ticks, mean, peak)
+
+
+    @pyqtSlot()
+    def home_requested(self):
+        try:
+            self.controller.event_home()
+        except RuntimeError as e:
+            eventlog.warning('ui', f'cannot home: {e}')
+            return
         self.update_progress()
         self.update_motion_state()
-        print('start/stop pressed')
+
+
+    @pyqtSlot()
+    def job_pause_requested(self):
+        # The move in progress is completed, the job then stays paused
+        if self.job is None or not self.job.is_running():
+            return
+        self.job.pause()
+
+
+    @pyqtSlot(int)
+    def job_restart_requested(self, step):
+        if self.job is None:
+            eventlog.warning('ui', 'cannot restart job: no job loaded')
+            return
+        try:
+            self.job.restart(step - 1)
+        except ValueError as e:
+            eventlog.warning('ui', f'cannot restart job: {e}')
+            return
+        self.job.event_periodic()
+        self.update_motion_state()
 
 
     @pyqtSlot()
     def timeout(self):
-        self.controller.event_periodic()
+        if self.group is None:
+            self.controller.event_periodic()
         self.update_position()
         self.update_progress()
         self.update_motion_state()
+        self.update_fault()
         if self.controller.get_target_mode() == TargetMode.RELATIVE:
             self.update_rel_target()
+        if self.job is not None:
+            self.job.event_periodic()
+            self.update_target_mode()
+            self.update_abs_target()
+            self.update_div_target()
+            self.update_divs()
+            self.update_speed()
+        if self.cnc is not None:
+            self.cnc.event_periodic()
+        if self.pending_config is not None:
+            self.apply_pending_config()
         state = self.controller.get_motion_state()
         moving_states = [MotionState.MOVING, MotionState.STOPPING]
-        if state in moving_states:
+        job_running = self.job is not None and self.job.is_running()
+        if state in moving_states or job_running:
             self.timer.setInterval(20)
         else:
             self.timer.setInterval(200)
@@ -182,6 +337,9 @@ class Presenter(QObject):
         self.old_progress = None
         self.update_progress()
 
+        self.old_fault = None
+        self.update_fault()
+
 
     def update_target_mode(self):
         target_mode = self.controller.get_target_mode()
@@ -263,3 +421,37 @@ class Presenter(QObject):
             enabled, value = progress
             self.ui.progress_updated(enabled, value)
         self.old_progress = progress
+
+
+    def update_fault(self):
+        fault = self.controller.get_fault()
+        if fault != self.old_fault:
+            self.ui.fault_updated(fault)
+        self.old_fault = fault
+
+
+class AxisGroupPresenter(QObject):
+    # Drives the presenters of several axes from one timer, polling all axes
+    # concurrently before any window is updated
+    def __init__(self, group, presenters, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.group = group
+        self.presenters = presenters
+        for presenter in presenters:
+            presenter.attach_axis_group(group)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(200)
+        self.timer.timeout.connect(self.timeout)
+        self.timer.start()
+
+
+    @pyqtSlot()
+    def timeout(self):
+        self.group.event_periodic()
+        for presenter in self.presenters:
+            presenter.timeout()
+        if self.group.is_moving():
+            self.timer.setInterval(20)
+        else:
+            self.timer.setInterval(200)
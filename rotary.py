@@ -1,53 +1,361 @@
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
-
-from ui import MainWindow
-from configuration import Configuration
-from presenter import Presenter
-from motion import MotionController
-from motor import FakeMotor, PololuT249
-import ui
+# Modules are imported where they are used, so startup only pays for the
+# features in use and the window appears before the rest is loaded
+from startup import BackgroundCall, StartupReport
 
 import argparse
 import sys
 
 
-def main(config_file, fake=False):
+# Backends driving a Tic in this process, which the keepalive lane needs
+keepalive_backends = ['pololu', 'pololu-serial']
+
+
+def select_backend(config_backend, backend=None, fake=False, emulate=False,
+                   tic_port=None):
+    # The backend named on the command line, else the configured one
+    if fake:
+        return 'fake'
+    elif emulate:
+        return 'emulated'
+    elif tic_port is not None:
+        return 'pololu-serial'
+    elif backend is not None:
+        return backend
+    return config_backend
+
+
+def main(config_file, fake=False, serial_device=None, baudrate=115200,
+         job_file=None, job_step=1, job_optimise=False, journal_file=None,
+         motion_trace_file=None, move_db_file=None, usb_stats=False,
+         usb_stats_file=None, trace_file=None, profile_file=None,
+         profile_interval=5.0, session_file=None, motor_daemon=False,
+         keepalive=False, serial_number=None, emulate=False, tic_port=None,
+         tic_baudrate=115200, backend=None, startup_report=False,
+         watch_config=False):
+    report = StartupReport()
     from PyQt5.QtCore import pyqtRemoveInputHook
+    from PyQt5.QtWidgets import QApplication
     pyqtRemoveInputHook()
-    
+    report.phase('Qt import')
+
+    if trace_file is not None:
+        import spantrace
+        tracer = spantrace.SpanTracer(trace_file)
+        spantrace.install(tracer)
+    else:
+        tracer = None
+
+    if profile_file is not None:
+        from sampler import SamplingProfiler
+        profiler = SamplingProfiler(profile_interval / 1000)
+        profiler.start()
+    else:
+        profiler = None
+
     app = QApplication(sys.argv)
+    report.phase('Qt application')
+
+    from configuration import Configuration
+    config = Configuration(config_file)
+    report.phase('configuration')
+
+    exporter = None
+    options = {}
+    backend = select_backend(config.backend, backend, fake, emulate, tic_port)
+    if tic_port is not None:
+        options['port'] = tic_port
+        options['baudrate'] = tic_baudrate
+    if keepalive:
+        options['keepalive_timeout'] = config.command_timeout
+    if serial_number is not None:
+        options['serial_number'] = serial_number
+    if journal_file is not None:
+        # Only a journal can restore the angle reference of a kept register
+        options['retain_position'] = True
+    if usb_stats or usb_stats_file is not None:
+        from usbstats import DeviceStats, PrometheusExporter
+        stats = DeviceStats()
+        options['stats'] = stats
+        if usb_stats_file is not None:
+            exporter = PrometheusExporter(stats, usb_stats_file)
+
+    # Opening the motor waits for the device, the window is built meanwhile
+    def attach_motor():
+        if motor_daemon:
+            from motordaemon import RemoteMotor
+            return RemoteMotor(backend, config_file, options)
+        from backends import create_motor
+        return create_motor(backend, config, **options)
 
+    attach = BackgroundCall(attach_motor, name='motor-attach')
+    report.phase('motor attach started')
+
+    from ui import MainWindow
+    report.phase('ui import')
     ui = MainWindow()
+    report.phase('window construction')
     ui.show()
+    app.processEvents()
+    report.phase('first frame')
 
-    config = Configuration(config_file)
+    from motion import MotionController
+    from presenter import Presenter
+    report.phase('controller import')
+    motor = attach.result()
+    report.phase('waiting for motor')
+    report.add_concurrent('motor attach', attach.duration)
 
-    if fake:
-        motor = FakeMotor()
+    ctrl = MotionController(motor, config)
+
+    if journal_file is not None:
+        from journal import PositionJournal
+        journal = PositionJournal(journal_file)
+        ctrl.attach_journal(journal)
     else:
-        motor = PololuT249()
+        journal = None
+
+    if motion_trace_file is not None:
+        from motiontrace import TraceRecorder
+        trace = TraceRecorder(motion_trace_file, clock=ctrl.clock)
+        ctrl.attach_trace(trace)
+    else:
+        trace = None
+
+    if session_file is not None:
+        # Connected before the presenter, so events are recorded before the
+        # samples they cause
+        from session import SessionRecorder
+        recorder = SessionRecorder(session_file, config)
+        recorder.connect_ui(ui)
+        ctrl.attach_trace(recorder)
+    else:
+        recorder = None
+
+    if move_db_file is not None:
+        from movedb import MoveDatabase
+        move_db = MoveDatabase(move_db_file)
+        ctrl.attach_move_log(move_db)
+    else:
+        move_db = None
 
-    ctrl = MotionController(motor, config)
     pres = Presenter(ctrl, ui)
 
-    sys.exit(app.exec())
+    if job_file is not None:
+        # The job starts paused, the operator starts it with the start button
+        from job import JobRunner, load_program, optimise_program
+        steps = load_program(job_file)
+        if job_optimise:
+            steps = optimise_program(ctrl, steps)
+        job = JobRunner(ctrl, steps)
+        job.restart(job_step - 1)
+        job.pause()
+        pres.attach_job(job)
+    else:
+        job = None
+
+    if serial_device is not None:
+        from cnc import CncInterface, open_serial_port
+        port = open_serial_port(serial_device, baudrate)
+        cnc = CncInterface(ctrl, port)
+        if job is not None:
+            cnc.attach_job(job)
+        pres.attach_cnc(cnc)
+
+    if watch_config:
+        from configuration import ConfigWatcher
+        watcher = ConfigWatcher(config_file)
+        pres.attach_config_watcher(watcher)
+    else:
+        watcher = None
+    report.phase('controller and presenter')
+
+    if startup_report:
+        print(report.text())
+
+    ret = app.exec()
+    if motor_daemon:
+        motor.close()
+    if keepalive and getattr(motor, 'keepalive', None) is not None:
+        motor.keepalive.close()
+        print(motor.keepalive.summary())
+    if journal is not None:
+        journal.close()
+    if watcher is not None:
+        watcher.close()
+    if trace is not None:
+        trace.close()
+    if move_db is not None:
+        move_db.close()
+    if exporter is not None:
+        exporter.close()
+    if tracer is not None:
+        tracer.close()
+    if recorder is not None:
+        recorder.close()
+    if profiler is not None:
+        profiler.stop()
+        profiler.write_collapsed(profile_file)
+        summary = profiler.summary()
+        with open(profile_file + '.summary.txt', 'w') as f:
+            f.write(summary)
+        print(summary)
+    sys.exit(ret)
+
+
+def main_axes(config_file, fake=False, emulate=False):
+    # One window per axis section of the configuration, with coordinated
+    # start and stop
+    from PyQt5.QtCore import pyqtRemoveInputHook
+    from PyQt5.QtWidgets import QApplication
+    from axes import AxisGroup
+    from backends import create_motor
+    from configuration import Configuration, axis_names
+    from motion import MotionController
+    from presenter import Presenter, AxisGroupPresenter
+    from ui import MainWindow
+    pyqtRemoveInputHook()
+
+    app = QApplication(sys.argv)
+
+    names = axis_names(config_file)
+    if not names:
+        raise RuntimeError('no axis sections in configuration')
+    configs = {name: Configuration(config_file, name) for name in names}
+
+    if emulate:
+        from ticemu import EmulatedBus, EmulatedTic
+        devices = [
+            EmulatedTic(serial_number=config.serial_number or name)
+            for name, config in configs.items()
+        ]
+        bus = EmulatedBus(devices)
+
+    controllers = {}
+    presenters = []
+    for name, config in configs.items():
+        if fake:
+            motor = create_motor('fake', config)
+        elif emulate:
+            serial_number = config.serial_number or name
+            motor = create_motor(
+                'pololu', config, serial_number=serial_number,
+                open_device=bus.open)
+        elif config.backend == 'pololu' and config.serial_number is None:
+            raise RuntimeError(f'axis {name} has no serial_number')
+        else:
+            motor = create_motor(config.backend, config)
+
+        ui = MainWindow()
+        ui.set_axis_name(name)
+        ui.show()
+        controllers[name] = MotionController(motor, config)
+        presenters.append(Presenter(controllers[name], ui))
+
+    group = AxisGroup(controllers)
+    # Owned by the application, so it lives as long as the event loop
+    AxisGroupPresenter(group, presenters, parent=app)
+
+    ret = app.exec()
+    group.close()
+    sys.exit(ret)
 
 
 if __name__ == '__main__':
     p = argparse.ArgumentParser('rotary')
 
     p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
-    p.add_argument('-f', '--fake', action='store_true', help='run with fake motor controller')
+    p.add_argument('-f', '--fake', action='store_true', help='run with fake motor controller, same as --backend fake')
+    p.add_argument('--backend', help='motor backend, overrides the configuration (--list-backends shows them)')
+    p.add_argument('--list-backends', action='store_true', help='list the available motor backends')
+    p.add_argument('-s', '--serial', metavar='DEVICE', help='accept CNC commands on serial port')
+    p.add_argument('-b', '--baudrate', type=int, default=115200, help='CNC serial port baudrate')
+    p.add_argument('-j', '--job', metavar='FILE', help='run job from program file (.csv or .toml)')
+    p.add_argument('--job-step', type=int, default=1, help='start job at this step')
+    p.add_argument('--job-optimise', action='store_true', help='reorder job moves for least move time')
+    p.add_argument('--journal', metavar='FILE', help='keep position reference in journal file across restarts')
+    p.add_argument('--move-db', metavar='FILE', help='record completed moves in SQLite database')
+    p.add_argument('--usb-stats', action='store_true', help='collect Tic USB call statistics (F2 shows them)')
+    p.add_argument('--usb-stats-file', metavar='FILE', help='write Tic USB call statistics in Prometheus text format')
+    p.add_argument('--trace', metavar='FILE', help='write Chrome/Perfetto trace of the session')
+    p.add_argument('--profile', metavar='FILE', help='sample the session, write collapsed stacks to file')
+    p.add_argument('--profile-interval', type=float, default=5.0, help='profiler sampling interval in ms')
+    p.add_argument('--record', metavar='FILE', help='record operator events and motor samples for replay')
+    p.add_argument('--motion-trace', metavar='FILE', help='record polled motor samples to trace file')
+    p.add_argument('--motor-daemon', action='store_true', help='run the motor in a separate process')
+    p.add_argument('--keepalive', action='store_true', help='refresh the Tic command timeout from a dedicated thread')
+    p.add_argument('--serial-number', help='use the Tic with this USB serial number')
+    p.add_argument('--emulate', action='store_true', help='run with an emulated Tic')
+    p.add_argument('--tic-port', metavar='DEVICE', help='control the Tic over this serial port instead of USB')
+    p.add_argument('--tic-baudrate', type=int, default=115200, help='Tic serial port baudrate, must match the Tic setting')
+    p.add_argument('--axes', action='store_true', help='control all axes of the configuration, other options except -f and --emulate are ignored')
 
+    p.add_argument('--watch-config', action='store_true', help='apply changes to the configuration file while running')
+    p.add_argument('--startup-report', action='store_true', help='print the startup time by phase')
+
+    p.add_argument('--event-log', metavar='FILE', help='write events as JSON lines to file, rotated by size')
+    p.add_argument('--event-log-level', choices=['debug', 'info', 'warning', 'error'], default='info', help='lowest level written to the event log file')
+    p.add_argument('--event-log-size', type=float, default=10.0, help='event log file size in MB before rotating')
+    p.add_argument('--event-log-backups', type=int, default=5, help='number of rotated event log files kept')
+    p.add_argument('-v', '--verbose', action='store_true', help='show debug events, e.g. Tic variables, on the console')
     p.add_argument('-d', '--debug', action='store_true', help='start in debugger')
 
     args = p.parse_args()
 
+    if args.list_backends:
+        from backends import backend_names
+        print('\n'.join(backend_names()))
+        sys.exit(0)
+    if args.motor_daemon and (args.usb_stats or args.usb_stats_file):
+        p.error('USB statistics are not available with --motor-daemon')
+    if args.keepalive:
+        from configuration import Configuration
+        backend = select_backend(
+            Configuration(args.config).backend, args.backend, args.fake,
+            args.emulate, args.tic_port)
+        if args.motor_daemon or backend not in keepalive_backends:
+            p.error('--keepalive needs the Tic in this process')
+
+    if args.event_log is not None or args.verbose:
+        import eventlog
+        eventlog.configure(
+            args.event_log,
+            level=eventlog.levels[args.event_log_level],
+            console_level=eventlog.DEBUG if args.verbose else eventlog.INFO,
+            max_bytes=int(args.event_log_size * 1e6),
+            backups=args.event_log_backups,
+        )
 
     if args.debug:
         import pdb
         pdb.set_trace()
 
-    main(config_file=args.config, fake=args.fake)
\ No newline at end of file
+    if args.axes:
+        main_axes(args.config, fake=args.fake, emulate=args.emulate)
+
+    main(
+        config_file=args.config,
+        fake=args.fake,
+        serial_device=args.serial,
+        baudrate=args.baudrate,
+        job_file=args.job,
+        job_step=args.job_step,
+        job_optimise=args.job_optimise,
+        journal_file=args.journal,
+        motion_trace_file=args.motion_trace,
+        move_db_file=args.move_db,
+        usb_stats=args.usb_stats,
+        usb_stats_file=args.usb_stats_file,
+        trace_file=args.trace,
+        profile_file=args.profile,
+        profile_interval=args.profile_interval,
+        session_file=args.record,
+        motor_daemon=args.motor_daemon,
+        keepalive=args.keepalive,
+        serial_number=args.serial_number,
+        emulate=args.emulate,
+        tic_port=args.tic_port,
+        tic_baudrate=args.tic_baudrate,
+        backend=args.backend,
+        startup_report=args.startup_report,
+        watch_config=args.watch_config,
+    )
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import eventlog
+
+
+class SamplingProfiler(object):
+    # Samples the Python stacks of all threads from a background thread.
+    # Only the sampling thread does any work, the sampled threads are not
+    # instrumented, so the overhead is one stack walk per thread and sample.
+    components = [
+        # (component, qualified function name prefix)
+        ('Presenter.timeout', 'presenter.py:Presenter.timeout'),
+        ('PositionWidget.paintEvent', 'ui.py:PositionWidget.paintEvent'),
+        ('motor backend', 'motor.py:'),
+        ('MotionController', 'motion.py:MotionController.'),
+    ]
+
+    def __init__(self, interval=0.005, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = max(interval, 0.001)
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.duration = time.monotonic() - self.start_time
+
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample(own_id)
+            except Exception as e:
+                # Never let the profiler take down a session
+                eventlog.warning('profiler', f'profiler sample failed: {e}')
+
+
+    def sample(self, own_id):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, f'thread-{thread_id}'))
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+        self.samples += 1
+
+
+    def component(self, stack):
+        for name in reversed(stack[1:]):
+            for component, prefix in self.components:
+                if name.startswith(prefix):
+                    return component
+        if stack[-1] == 'rotary.py:main':
+            # Waiting in app.exec, the Qt event loop is in C++
+            return 'Qt event loop'
+        return 'other'
+
+
+    def write_collapsed(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{";".join(stack)} {count}\n')
+
+
+    def summary(self, top=20):
+        total = sum(self.stacks.values())
+        inclusive = Counter()
+        exclusive = Counter()
+        component_counts = Counter()
+        for stack, count in self.stacks.items():
+            exclusive[stack[-1]] += count
+            for name in set(stack[1:]):
+                inclusive[name] += count
+            component_counts[self.component(stack)] += count
+
+        def pct(n):
+            return 100 * n / max(total, 1)
+
+        lines = [
+            f'{self.samples} samples in {self.duration:.1f} s, '
+            f'{total} thread stacks',
+            '',
+            'Time by component (innermost match)',
+        ]
+        for component, n in component_counts.most_common():
+            lines.append(f'{pct(n):6.1f} %  {component}')
+
+        lines += ['', f'Top {top} functions by inclusive time']
+        for name, n in inclusive.most_common(top):
+            lines.append(f'{pct(n):6.1f} %  {name}')
+
+        lines += ['', f'Top {top} functions by own time']
+        for name, n in exclusive.most_common(top):
+            lines.append(f'{pct(n):6.1f} %  {name}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def frame_name(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{filename}:{name}'
@@ -0,0 +1,178 @@
+import gzip
+import json
+import time
+
+import eventlog
+from configuration import Configuration
+from enums import TargetMode, MotionState, Direction
+from motion import MotionController
+from motor import FakeMotor
+
+
+class SessionRecorder(object):
+    # Records the operator events reaching the presenter and every motor
+    # state sample, as gzipped JSON lines [time, kind, args...] with time in
+    # seconds from the start of the session.
+    def __init__(self, filename, config: Configuration, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file = gzip.open(filename, 'wt', encoding='ascii')
+        self.origin = time.monotonic()
+        header = {
+            'version': 1,
+            'start': time.time(),
+            'steps_per_rev': config.steps_per_rev,
+        }
+        self.file.write(json.dumps(header) + '\n')
+
+
+    def write(self, kind, *args):
+        t = round(time.monotonic() - self.origin, 6)
+        self.file.write(json.dumps([t, kind, *args]) + '\n')
+
+
+    def connect_ui(self, ui):
+        ui.target_mode_set.connect(lambda m: self.write('mode', m.name))
+        ui.position_set.connect(lambda v: self.write('position', v))
+        ui.abs_target_set.connect(lambda v: self.write('abs_target', v))
+        ui.rel_target_set.connect(lambda v: self.write('rel_target', v))
+        ui.div_target_set.connect(lambda v: self.write('div_target', v))
+        ui.div_parameters_set.connect(
+            lambda n, s, e: self.write('div_parameters', n, s, e))
+        ui.speed_set.connect(lambda v: self.write('speed', v))
+        ui.cw_pressed.connect(lambda: self.write('cw'))
+        ui.ccw_pressed.connect(lambda: self.write('ccw'))
+        ui.power_pressed.connect(lambda: self.write('power'))
+        ui.start_stop_pressed.connect(lambda: self.write('start_stop'))
+
+
+    def record(self, position, velocity, state, target, speed):
+        # The speed is replayed from the recorded events
+        self.write('sample', position, velocity, state.name, target)
+
+
+    def close(self):
+        self.file.close()
+
+
+class SimulatedClock(object):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def read_session(filename):
+    with gzip.open(filename, 'rt', encoding='ascii') as f:
+        header = json.loads(f.readline())
+        records = [json.loads(line) for line in f if line.strip()]
+    return header, records
+
+
+def apply_event(ctrl: MotionController, kind, args):
+    # Same mapping from UI events to controller events as the presenter
+    if kind == 'mode':
+        ctrl.event_target_mode_set(TargetMode[args[0]])
+    elif kind == 'position':
+        ctrl.event_position_set(args[0])
+    elif kind in ['abs_target', 'rel_target']:
+        ctrl.event_target_set(args[0])
+    elif kind == 'div_target':
+        ctrl.event_target_set(args[0] - 1)
+    elif kind == 'div_parameters':
+        ctrl.event_division_set(*args)
+    elif kind == 'speed':
+        ctrl.event_speed_set(args[0])
+    elif kind == 'cw':
+        ctrl.event_direction_set(Direction.CW)
+    elif kind == 'ccw':
+        ctrl.event_direction_set(Direction.CCW)
+    elif kind == 'power':
+        ctrl.event_power()
+    elif kind == 'start_stop':
+        ctrl.event_start_stop()
+    else:
+        raise ValueError(f'unknown event {kind}')
+
+
+def replay(filename, config: Configuration, realtime=False):
+    # Drives a controller with a fake motor through a recorded session. The
+    # fake motor runs on a simulated clock, so the session replays as fast
+    # as the controller allows unless realtime is set.
+    header, records = read_session(filename)
+    if header['steps_per_rev'] != config.steps_per_rev:
+        eventlog.warning(
+            'replay', 'session was recorded with a different configuration',
+            recorded=header['steps_per_rev'], configured=config.steps_per_rev)
+
+    clock = SimulatedClock()
+    ctrl = MotionController(FakeMotor(clock=clock), config)
+
+    events = 0
+    samples = 0
+    rejected = 0
+    state_mismatches = 0
+    max_position_error = 0
+
+    start = time.perf_counter()
+    for t, kind, *args in records:
+        clock.now = t
+        if realtime:
+            delay = t - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == 'sample':
+            position, velocity, state, target = args
+            ctrl.event_periodic()
+            samples += 1
+            if ctrl.get_motion_state() != MotionState[state]:
+                state_mismatches += 1
+            error = abs(ctrl.position_reg - position)
+            max_position_error = max(max_position_error, error)
+        else:
+            events += 1
+            try:
+                apply_event(ctrl, kind, args)
+            except RuntimeError:
+                rejected += 1
+    elapsed = time.perf_counter() - start
+
+    duration = records[-1][0] if records else 0.0
+    return {
+        'duration': duration,
+        'elapsed': elapsed,
+        'speedup': duration / elapsed if elapsed > 0 else 0.0,
+        'events': events,
+        'rejected_events': rejected,
+        'samples': samples,
+        'state_mismatches': state_mismatches,
+        'max_position_error': max_position_error,
+    }
+
+
+def main():
+    import argparse
+
+    p = argparse.ArgumentParser('session')
+    p.add_argument('session', help='recorded session file')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('--realtime', action='store_true', help='replay at recorded speed')
+    args = p.parse_args()
+
+    config = Configuration(args.config)
+    result = replay(args.session, config, args.realtime)
+
+    print(f'session duration    {result["duration"]:.1f} s')
+    print(f'replay time         {result["elapsed"]:.3f} s '
+          f'({result["speedup"]:.0f}x real time)')
+    print(f'events              {result["events"]} '
+          f'({result["rejected_events"]} rejected)')
+    print(f'samples             {result["samples"]}')
+    print(f'state mismatches    {result["state_mismatches"]}')
+    print(f'max position error  {result["max_position_error"]} steps')
+
+
+if __name__ == '__main__':
+    main()
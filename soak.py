@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import eventlog
+from configuration import Configuration
+from enums import MotionState, TargetMode
+from motion import MotionController
+from motor import FakeMotor
+from session import SimulatedClock
+
+
+# The Tic position register is a signed 32 bit value
+register_limit = 2**31 - 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(p / 100 * len(values)))
+    return values[index]
+
+
+def slope(xs, ys):
+    # Least squares slope of ys over xs
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    den = sum((x - mean_x)**2 for x in xs)
+    return num / den if den else 0.0
+
+
+class Soak(object):
+    # Runs simulated moves through the presenter, main window and controller
+    # on a simulated clock, collecting a checkpoint every interval moves.
+    # A move taking longer than this many ticks is stuck
+    max_ticks = 100000
+
+    def __init__(self, config, timer_check=2.0, rebase_revs=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5.QtWidgets import QApplication
+        from ui import MainWindow
+        from presenter import Presenter
+
+        self.app = QApplication.instance() or QApplication(sys.argv[:1])
+        self.clock = SimulatedClock()
+        self.ctrl = MotionController(FakeMotor(clock=self.clock), config)
+        if rebase_revs is not None:
+            # Rebasing happens within a short run, not after days
+            self.ctrl.rebase_threshold = rebase_revs * config.steps_per_rev
+        self.ui = MainWindow()
+        self.ui.show()
+        self.pres = Presenter(self.ctrl, self.ui)
+        self.pres.timer.stop()
+
+        self.timer_check = timer_check
+        self.moves = 0
+        self.tick_times = []
+        self.min_reg = 0
+        self.max_reg = 0
+        self.checkpoints = []
+        self.random = random.Random(1)
+
+        # Keeps stray output of the operator events off the report
+        self.devnull = open(os.devnull, 'w')
+        with contextlib.redirect_stdout(self.devnull):
+            self.ui.power_pressed.emit()
+            _, _, max_speed = self.ctrl.get_speeds()
+            self.ui.speed_set.emit(max_speed)
+            self.ui.target_mode_set.emit(TargetMode.DIVISION)
+            self.ui.div_parameters_set.emit(24, 0.0, 360.0)
+        self.tick()
+
+
+    def tick(self):
+        start = time.perf_counter()
+        self.pres.timeout()
+        self.tick_times.append(time.perf_counter() - start)
+        self.clock.now += self.pres.timer.interval() / 1000
+        reg = self.ctrl.position_reg
+        self.min_reg = min(self.min_reg, reg)
+        self.max_reg = max(self.max_reg, reg)
+
+
+    def move(self):
+        with contextlib.redirect_stdout(self.devnull):
+            self.operate()
+        ticks = 0
+        while self.ctrl.get_motion_state() != MotionState.IDLE:
+            self.tick()
+            ticks += 1
+            if ticks > self.max_ticks:
+                raise RuntimeError(f'move {self.moves} did not complete')
+        self.tick()
+        self.app.processEvents()
+        self.moves += 1
+
+
+    def operate(self):
+        # Alternate between the target modes like an operator would
+        kind = self.moves % 3
+        if kind == 0:
+            self.ui.target_mode_set.emit(TargetMode.DIVISION)
+            _, index = self.ctrl.get_div_target()
+            num_divs = len(self.ctrl.get_divs())
+            self.ui.div_target_set.emit((index + 1) % num_divs + 1)
+        elif kind == 1:
+            self.ui.target_mode_set.emit(TargetMode.ABSOLUTE)
+            self.ui.abs_target_set.emit(self.random.uniform(0, 359.999))
+        else:
+            # Relative moves keep going the same way, growing the register
+            self.ui.target_mode_set.emit(TargetMode.RELATIVE)
+            self.ui.rel_target_set.emit(self.random.uniform(1, 30))
+
+        if self.ctrl.get_motion_state() == MotionState.READY_TO_MOVE:
+            self.ui.start_stop_pressed.emit()
+
+
+    def measure_timer_drift(self):
+        # Runs the real presenter timer for a while, returning the mean
+        # lateness of its ticks as a fraction of the interval. Qt's coarse
+        # timers may be up to 5 % off.
+        if self.timer_check <= 0:
+            return 0.0
+        from PyQt5.QtCore import QEventLoop, QTimer
+
+        stamps = []
+        self.pres.timer.timeout.connect(lambda: stamps.append(time.perf_counter()))
+        self.pres.timer.start()
+        loop = QEventLoop()
+        QTimer.singleShot(int(self.timer_check * 1000), loop.quit)
+        loop.exec()
+        self.pres.timer.stop()
+        self.pres.timer.timeout.disconnect()
+        self.pres.timer.timeout.connect(self.pres.timeout)
+
+        interval = self.pres.timer.interval() / 1000
+        lateness = [b - a - interval for a, b in zip(stamps, stamps[1:])]
+        if not lateness:
+            return 0.0
+        return sum(lateness) / len(lateness) / interval
+
+
+    def checkpoint(self):
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        point = {
+            'moves': self.moves,
+            'memory': current,
+            'memory_peak': peak,
+            'objects': len(gc.get_objects()),
+            'tick_p50': percentile(self.tick_times, 50),
+            'tick_p99': percentile(self.tick_times, 99),
+            'timer_drift': self.measure_timer_drift(),
+            'min_reg': self.min_reg,
+            'max_reg': self.max_reg,
+            'rebases': self.ctrl.get_rebase_count(),
+        }
+        # Register range per checkpoint, so that rebasing shows in the trend
+        reg = self.ctrl.position_reg
+        self.min_reg = reg
+        self.max_reg = reg
+        self.tick_times = []
+        self.checkpoints.append(point)
+        print(f'{point["moves"]:7} moves  {point["memory"] / 1024:9.0f} KiB  '
+              f'{point["objects"]:8} objects  '
+              f'tick p50 {point["tick_p50"] * 1e6:6.0f} us '
+              f'p99 {point["tick_p99"] * 1e6:6.0f} us  '
+              f'drift {point["timer_drift"] * 100:5.1f} %  '
+              f'reg {point["min_reg"]}..{point["max_reg"]}  '
+              f'{point["rebases"]} rebases')
+
+
+    def run(self, moves, interval):
+        tracemalloc.start()
+        while self.moves < moves:
+            self.move()
+            if self.moves % interval == 0:
+                self.checkpoint()
+        tracemalloc.stop()
+
+
+def evaluate(checkpoints, limits, rebase_threshold, steps_per_rev, warmup=1):
+    # Returns a list of failures, each a description of a trend beyond its
+    # limit. Growth is per 1000 moves, fitted after the warmup checkpoints.
+    # Rebasing keeps the register within a move of the rebase threshold,
+    # at most a revolution, so its extent is checked against that bound
+    # instead of fitting a trend.
+    points = checkpoints[warmup:]
+    failures = []
+    if len(points) < 2:
+        return ['too few checkpoints to fit trends']
+
+    moves = [p['moves'] / 1000 for p in points]
+    memory_growth = slope(moves, [p['memory'] for p in points])
+    object_growth = slope(moves, [p['objects'] for p in points])
+    tick_growth = points[-1]['tick_p99'] / max(points[0]['tick_p99'], 1e-9)
+    drift = max(p['timer_drift'] for p in points)
+
+    reg_extent = max(max(abs(p['min_reg']), abs(p['max_reg'])) for p in checkpoints)
+    reg_bound = rebase_threshold + steps_per_rev
+    production_bound = MotionController.rebase_threshold + steps_per_rev
+
+    print()
+    print(f'memory growth       {memory_growth / 1024:10.1f} KiB / 1000 moves')
+    print(f'object growth       {object_growth:10.1f} / 1000 moves')
+    print(f'tick p99 growth     {tick_growth:10.2f} x')
+    print(f'max timer drift     {drift * 100:10.1f} %')
+    print(f'register extent     {reg_extent:10} of {reg_bound:.0f} with rebasing')
+    print(f'rebases             {checkpoints[-1]["rebases"]:10}')
+
+    if memory_growth > limits['memory']:
+        failures.append(f'memory grows {memory_growth:.0f} B / 1000 moves')
+    if object_growth > limits['objects']:
+        failures.append(f'object count grows {object_growth:.0f} / 1000 moves')
+    if tick_growth > limits['tick_growth']:
+        failures.append(f'tick p99 grew {tick_growth:.2f}x')
+    if drift > limits['timer_drift']:
+        failures.append(f'timer drift {drift * 100:.1f} %')
+    if reg_extent > reg_bound:
+        failures.append(
+            f'register reached {reg_extent}, rebasing keeps it within {reg_bound:.0f}')
+    if production_bound > register_limit:
+        failures.append(
+            f'rebase threshold {MotionController.rebase_threshold} leaves no '
+            f'headroom below the register limit {register_limit}')
+    return failures
+
+
+def main():
+    p = argparse.ArgumentParser('soak')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('-n', '--moves', type=int, default=150, help='number of simulated moves')
+    p.add_argument('-i', '--interval', type=int, default=30, help='moves between checkpoints')
+    p.add_argument('--max-memory-growth', type=float, default=512 * 1024, help='bytes per 1000 moves')
+    p.add_argument('--max-object-growth', type=float, default=500, help='objects per 1000 moves')
+    p.add_argument('--max-tick-growth', type=float, default=2.0, help='allowed growth factor of tick p99')
+    p.add_argument('--max-timer-drift', type=float, default=0.1, help='allowed mean timer lateness, as a fraction of the interval')
+    p.add_argument('--timer-check', type=float, default=0.5, help='seconds of real timer run per checkpoint')
+    p.add_argument('--rebase-revs', type=float, default=1.0, help='revolutions from 0 at which the register is moved back, instead of the production threshold')
+    p.add_argument('-o', '--output', help='write checkpoints as JSON')
+    args = p.parse_args()
+
+    # Rebasing and the like are logged, only warnings are of interest here
+    eventlog.configure(console_level=eventlog.WARNING)
+
+    config = Configuration(args.config)
+    soak = Soak(config, args.timer_check, args.rebase_revs)
+    soak.run(args.moves, args.interval)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(soak.checkpoints, f, indent=2)
+
+    limits = {
+        'memory': args.max_memory_growth,
+        'objects': args.max_object_growth,
+        'tick_growth': args.max_tick_growth,
+        'timer_drift': args.max_timer_drift,
+    }
+    failures = evaluate(
+        soak.checkpoints, limits, soak.ctrl.rebase_threshold, config.steps_per_rev)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+class SpanTracer(object):
+    # Collects spans as Chrome trace events ('X' complete events and 'i'
+    # instant events) and streams them to a JSON array file, which opens in
+    # chrome://tracing and Perfetto.
+    def __init__(self, filename, flush_size=10000, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.file = open(filename, 'w')
+        self.flush_size = flush_size
+        self.pid = os.getpid()
+        self.origin = time.perf_counter_ns()
+        self.events = []
+        self.first = True
+        self.lock = threading.Lock()
+
+        self.file.write('[\n')
+        self.metadata('process_name', {'name': 'rotary'})
+        self.metadata('thread_name', {'name': 'main'})
+
+
+    def metadata(self, name, args):
+        self.events.append(('M', name, '', 0, 0, threading.get_native_id(), args))
+
+
+    def complete(self, name, cat, start, end, args=None):
+        self.events.append(
+            ('X', name, cat, start, end - start, threading.get_native_id(), args))
+        if len(self.events) >= self.flush_size:
+            self.flush()
+
+
+    def instant(self, name, cat, args=None):
+        self.events.append(
+            ('i', name, cat, time.perf_counter_ns(), 0,
+             threading.get_native_id(), args))
+
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+            lines = []
+            for ph, name, cat, ts, dur, tid, args in events:
+                event = {
+                    'ph': ph,
+                    'name': name,
+                    'pid': self.pid,
+                    'tid': tid,
+                }
+                if ph != 'M':
+                    event['cat'] = cat
+                    event['ts'] = (ts - self.origin) / 1000
+                if ph == 'X':
+                    event['dur'] = dur / 1000
+                elif ph == 'i':
+                    event['s'] = 't'
+                if args:
+                    event['args'] = args
+                lines.append(json.dumps(event, separators=(',', ':')))
+            if not lines:
+                return
+            if not self.first:
+                self.file.write(',\n')
+            self.file.write(',\n'.join(lines))
+            self.first = False
+
+
+    def close(self):
+        self.flush()
+        self.file.write('\n]\n')
+        self.file.close()
+
+
+def traced(func, name, cat, tracer):
+    clock = time.perf_counter_ns
+    complete = tracer.complete
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            complete(name, cat, start, clock())
+
+    return wrapper
+
+
+def traced_transition(func, tracer):
+    clock = time.perf_counter_ns
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        old_state = self.motion_state
+        start = clock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            tracer.complete('MotionController.evaluate_state_transition',
+                            'controller', start, clock())
+            if self.motion_state != old_state:
+                tracer.instant(
+                    f'{old_state.name} -> {self.motion_state.name}', 'state')
+
+    return wrapper
+
+
+def trace_methods(cls, names, cat, tracer):
+    for name in names:
+        func = cls.__dict__.get(name)
+        if callable(func):
+            label = f'{cls.__name__}.{name}'
+            setattr(cls, name, traced(func, label, cat, tracer))
+
+
+def install(tracer):
+    # Replaces the methods along the path from UI to device with traced
+    # versions. Must run before any of the objects are created, as signal
+    # connections bind the methods.
+    from ui import MainWindow, PositionWidget, EnergizeButton
+    from ui import SetupButton, StartStopButton, DirectionButton
+    from presenter import Presenter
+    from motion import MotionController
+    from motor import Motor, FakeMotor, PololuT249
+
+    def slots(cls):
+        return [n for n, f in cls.__dict__.items()
+                if hasattr(f, '__pyqtSignature__')]
+
+    presenter_slots = slots(Presenter)
+    trace_methods(Presenter, presenter_slots, 'ui', tracer)
+    updates = [n for n in Presenter.__dict__ if n.startswith('update_')]
+    trace_methods(Presenter, updates, 'presenter', tracer)
+
+    trace_methods(MainWindow, slots(MainWindow), 'ui', tracer)
+
+    events = [n for n in MotionController.__dict__ if n.startswith('event_')]
+    trace_methods(MotionController, events, 'controller', tracer)
+    trace_methods(MotionController, ['calculate_target_reg'], 'controller', tracer)
+    evaluate = MotionController.evaluate_state_transition
+    MotionController.evaluate_state_transition = traced_transition(evaluate, tracer)
+
+    motor_methods = [n for n in Motor.__dict__ if not n.startswith('_')]
+    for cls in [FakeMotor, PololuT249]:
+        trace_methods(cls, motor_methods, 'motor', tracer)
+
+    widgets = [
+        PositionWidget, EnergizeButton, SetupButton, StartStopButton,
+        DirectionButton,
+    ]
+    for cls in widgets:
+        trace_methods(cls, ['paintEvent'], 'paint', tracer)
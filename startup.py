@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+
+def process_age():
+    # Seconds since the process started, in clock ticks (usually 10 ms).
+    # None where /proc is not available.
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        start_ticks = int(fields[19])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupReport(object):
+    # Time spent in each phase of startup, measured from one phase mark to
+    # the next. Work running concurrently is added with its own duration
+    # and not counted in the total.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.phases = []
+        self.concurrent = []
+        age = process_age()
+        if age is not None:
+            self.phases.append(('interpreter and imports', age))
+        self.last = time.perf_counter()
+
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+
+    def add_concurrent(self, name, duration):
+        self.concurrent.append((name, duration))
+
+
+    def text(self):
+        lines = ['startup time by phase:']
+        for name, duration in self.phases:
+            lines.append(f'  {name:32} {duration * 1000:8.1f} ms')
+        total = sum(duration for _, duration in self.phases)
+        lines.append(f'  {"total":32} {total * 1000:8.1f} ms')
+        for name, duration in self.concurrent:
+            lines.append(f'  {name + " (concurrent)":32} {duration * 1000:8.1f} ms')
+        return '\n'.join(lines)
+
+
+class BackgroundCall(object):
+    # Runs func in a thread, result() waits for it and returns its value
+    # or raises its exception
+    def __init__(self, func, name='background', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.func = func
+        self.value = None
+        self.error = None
+        self.duration = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.value = self.func()
+        except BaseException as e:
+            self.error = e
+        self.duration = time.perf_counter() - start
+
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
@@ -0,0 +1,161 @@
+import sys
+import time
+from collections import namedtuple
+
+
+class InvalidEventError(RuntimeError):
+    pass
+
+
+# A transition to target from any of sources, taken when guard(context) is
+# true. Transitions are tried in the order declared and the first one whose
+# guard holds is taken; one leading back to the current state keeps it.
+Transition = namedtuple('Transition', ['sources', 'target', 'guard'])
+
+
+class StateMachine(object):
+    # Table-driven state machine. The transitions are compiled once into a
+    # tuple of (guard, target, counter) per state, step() walks the tuple of
+    # the current state and only does more work when the state changes.
+    #
+    # events maps event names to the states accepting them. on_entry and
+    # on_exit map states to actions, called as action(old_state, new_state).
+    # Time spent in each state and the number of times each transition was
+    # taken are kept for introspection.
+    def __init__(self, states, initial, transitions, events, on_entry=None,
+                 on_exit=None, clock=time.monotonic, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.states = tuple(states)
+        self.transitions = tuple(transitions)
+        self.events = {name: frozenset(valid) for name, valid in events.items()}
+        self.on_entry = dict(on_entry or {})
+        self.on_exit = dict(on_exit or {})
+        self.clock = clock
+
+        # One counter per edge, self loops are not counted
+        self.edges = []
+        self.table = {}
+        for state in self.states:
+            row = []
+            for transition in self.transitions:
+                if state not in transition.sources:
+                    continue
+                counter = None
+                if transition.target != state:
+                    counter = len(self.edges)
+                    self.edges.append((state, transition))
+                row.append((transition.guard, transition.target, counter))
+            self.table[state] = tuple(row)
+        self.counts = [0] * len(self.edges)
+        self.dwell = dict.fromkeys(self.states, 0.0)
+        self.entries = dict.fromkeys(self.states, 0)
+
+        self.state = initial
+        self.entries[initial] = 1
+        self.entered = clock()
+
+
+    def step(self, context):
+        old_state = self.state
+        for guard, target, counter in self.table[old_state]:
+            if guard(context):
+                break
+        else:
+            return old_state
+        if counter is None:
+            return old_state
+
+        self.counts[counter] += 1
+        now = self.clock()
+        self.dwell[old_state] += now - self.entered
+        self.entered = now
+        action = self.on_exit.get(old_state)
+        if action is not None:
+            action(old_state, target)
+        self.state = target
+        self.entries[target] += 1
+        action = self.on_entry.get(target)
+        if action is not None:
+            action(old_state, target)
+        return target
+
+
+    def is_event_valid(self, event):
+        return self.state in self.events[event]
+
+
+    def check_event(self, event):
+        if self.state not in self.events[event]:
+            raise InvalidEventError(
+                f'Invalid event for state: {event} in {self.state.name}')
+
+
+    def get_valid_events(self, state=None):
+        if state is None:
+            state = self.state
+        return sorted(name for name, valid in self.events.items() if state in valid)
+
+
+    def get_dwell_times(self):
+        # Seconds spent in each state, including the current stay
+        dwell = dict(self.dwell)
+        dwell[self.state] += self.clock() - self.entered
+        return dwell
+
+
+    def get_entry_counts(self):
+        return dict(self.entries)
+
+
+    def get_transition_counts(self):
+        # {(source, target): count}, for every edge of the table
+        counts = {}
+        for (source, transition), count in zip(self.edges, self.counts):
+            key = source, transition.target
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+
+    def to_dot(self, name='states'):
+        # Graphviz source of the table, edges labelled with their guard and
+        # the number of times taken
+        dwell = self.get_dwell_times()
+        lines = [f'digraph {name} {{']
+        for state in self.states:
+            shape = 'doublecircle' if state == self.state else 'ellipse'
+            lines.append(
+                f'    {state.name} [shape={shape}, '
+                f'label="{state.name}\\n{self.entries[state]} entries, '
+                f'{dwell[state]:.1f} s"];')
+        for (source, transition), count in zip(self.edges, self.counts):
+            lines.append(
+                f'    {source.name} -> {transition.target.name} '
+                f'[label="{transition.guard.__name__} ({count})"];')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def main():
+    # Prints the motion state machine as Graphviz source
+    import argparse
+    from configuration import Configuration
+    from motion import MotionController
+    from motor import FakeMotor
+
+    p = argparse.ArgumentParser('statemachine')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('-o', '--output', help='DOT file, standard output if not given')
+    args = p.parse_args()
+
+    ctrl = MotionController(FakeMotor(), Configuration(args.config))
+    dot = ctrl.machine.to_dot('motion')
+    if args.output is None:
+        sys.stdout.write(dot)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(dot)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import os
+import select
+import tty
+import unittest
+
+import eventlog
+from backends import create_motor
+from cnc import CncInterface, open_serial_port
+from configuration import Configuration
+from enums import MotionState
+from motion import MotionController
+from session import SimulatedClock
+
+
+class CncTest(unittest.TestCase):
+    # Drives the CNC interface over a pseudo-terminal standing in for the
+    # serial line, the test writes and reads the controller's end
+    tick = 0.02
+    max_ticks = 100000
+
+    def setUp(self):
+        eventlog.configure(console_level=eventlog.WARNING)
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = open_serial_port(os.ttyname(slave))
+        os.close(slave)
+
+        config = Configuration('rotary.ini')
+        self.clock = SimulatedClock()
+        motor = create_motor('fake', config, clock=self.clock)
+        self.ctrl = MotionController(motor, config)
+        self.cnc = CncInterface(self.ctrl, self.port)
+        self.buffer = b''
+
+
+    def tearDown(self):
+        self.port.close()
+        os.close(self.master)
+
+
+    def send(self, line):
+        os.write(self.master, f'{line}\n'.encode('ascii'))
+        select.select([self.cnc], [], [], 1.0)
+        self.cnc.event_readable()
+
+
+    def replies(self):
+        while select.select([self.master], [], [], 0.05)[0]:
+            self.buffer += os.read(self.master, 4096)
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        return [line.decode('ascii') for line in lines]
+
+
+    def run_move(self):
+        # Only the controller is polled, done comes from its state change
+        for _ in range(self.max_ticks):
+            self.clock.now += self.tick
+            self.ctrl.event_periodic()
+            if self.ctrl.get_motion_state() == MotionState.IDLE:
+                return
+        self.fail('move did not end')
+
+
+    def power_on(self):
+        self.ctrl.event_power()
+        self.ctrl.event_periodic()
+
+
+    def test_move(self):
+        self.power_on()
+        self.send('G0 A90 F600')
+        self.assertEqual(self.replies(), ['ok'])
+        self.assertEqual(self.ctrl.get_speeds()[0], 10.0)
+        self.run_move()
+        self.assertEqual(self.replies(), ['done'])
+        self.assertAlmostEqual(self.ctrl.get_position_angle(), 90.0, places=3)
+        self.assertEqual(self.cnc.get_latency_stats()[0], 1)
+
+
+    def test_index_next(self):
+        self.power_on()
+        self.ctrl.event_division_set(4, 0.0, 360.0)
+        self.send('M100')
+        self.run_move()
+        self.assertEqual(self.replies(), ['ok', 'done'])
+        self.assertAlmostEqual(self.ctrl.get_position_angle(), 90.0, places=3)
+
+
+    def test_handshake(self):
+        self.power_on()
+        self.send('M101')
+        self.assertEqual(self.replies(), ['ok', 'done'])
+
+        # Held until the move has ended
+        self.send('G0 A45')
+        self.send('M101')
+        self.assertEqual(self.replies(), ['ok', 'ok'])
+        self.run_move()
+        self.assertEqual(self.replies(), ['done', 'done'])
+
+
+    def test_errors(self):
+        self.send('G0 A90')
+        self.assertEqual(self.replies(), ['error: motor not energized'])
+        self.power_on()
+        self.send('G1 A90')
+        self.send('G0 F600')
+        self.send('M999')
+        self.send('G0 A90')
+        self.send('G0 A180')
+        self.assertEqual(self.replies(), [
+            'error: unsupported code G1',
+            'error: missing A word',
+            'error: unsupported code M999',
+            'ok',
+            'error: busy',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
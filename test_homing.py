@@ -0,0 +1,95 @@
+import unittest
+
+import eventlog
+from backends import create_motor
+from configuration import Configuration
+from enums import MotionState
+from motion import MotionController
+from session import SimulatedClock
+from statemachine import InvalidEventError
+
+
+class HomingTest(unittest.TestCase):
+    # Homes on the switch of the fake motor, on a simulated clock
+    tick = 0.02
+    max_ticks = 100000
+
+    def setUp(self):
+        eventlog.configure(console_level=eventlog.WARNING)
+        self.config = Configuration('rotary.ini')
+        self.clock = SimulatedClock()
+        self.motor = create_motor('fake', self.config, clock=self.clock)
+        self.ctrl = MotionController(self.motor, self.config)
+        self.ctrl.event_power()
+        self.step()
+        self.phases = []
+
+
+    def step(self):
+        self.clock.now += self.tick
+        self.ctrl.event_periodic()
+        phase = self.ctrl.get_homing_phase()
+        if phase is not None and (not self.phases or self.phases[-1] != phase):
+            self.phases.append(phase)
+
+
+    def home(self):
+        self.ctrl.event_home()
+        self.phases = [self.ctrl.get_homing_phase()]
+        for _ in range(self.max_ticks):
+            self.step()
+            if self.ctrl.get_homing_phase() is None:
+                return
+        self.fail('homing did not end')
+
+
+    def assert_at_home(self):
+        # The switch is at home_angle, the approach stops just past it
+        angle = self.ctrl.get_position_angle()
+        error = (angle - self.config.home_angle + 180) % 360 - 180
+        self.assertLess(abs(error), 0.1)
+        self.assertTrue(self.motor.is_home_switch_active())
+
+
+    def test_seek_backoff_approach(self):
+        self.home()
+        self.assertEqual(
+            self.phases, ['seek', 'seek_stop', 'backoff', 'approach', 'approach_stop'])
+        self.assertEqual(self.ctrl.get_motion_state(), MotionState.IDLE)
+        self.assert_at_home()
+
+
+    def test_home_from_switch(self):
+        # Starting on the switch the seek is skipped
+        self.home()
+        self.home()
+        self.assertEqual(self.phases, ['seek_stop', 'backoff', 'approach', 'approach_stop'])
+        self.assert_at_home()
+
+
+    def test_inputs_rejected_while_homing(self):
+        self.ctrl.event_home()
+        self.step()
+        with self.assertRaises(InvalidEventError):
+            self.ctrl.event_target_set(90.0)
+        with self.assertRaises(InvalidEventError):
+            self.ctrl.event_position_set(0.0)
+        with self.assertRaises(InvalidEventError):
+            self.ctrl.event_home()
+
+
+    def test_stop_aborts_homing(self):
+        self.ctrl.event_home()
+        self.step()
+        self.ctrl.event_start_stop()
+        self.assertIsNone(self.ctrl.get_homing_phase())
+        for _ in range(self.max_ticks):
+            self.step()
+            if not self.motor.is_moving():
+                break
+        self.assertEqual(self.ctrl.get_motion_state(), MotionState.READY_TO_MOVE)
+        self.ctrl.event_target_set(90.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
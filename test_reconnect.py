@@ -0,0 +1,54 @@
+import unittest
+
+import eventlog
+from configuration import Configuration
+from enums import MotionState
+from motion import MotionController
+from motor import PololuT249
+from ticemu import EmulatedBus, EmulatedTic, reconnect_scenario, run_ticks, wait_for
+
+
+class ReconnectTest(unittest.TestCase):
+    # Loses the connection to an emulated Tic, the controller must carry on
+    # with the position it had
+
+    def setUp(self):
+        eventlog.configure(console_level=eventlog.WARNING)
+        self.config = Configuration('rotary.ini')
+
+
+    def test_unplug_while_idle(self):
+        device = EmulatedTic(command_timeout=self.config.command_timeout)
+        motor = PololuT249(open_device=EmulatedBus([device]).open)
+        ctrl = MotionController(motor, self.config)
+        ctrl.event_power()
+        ctrl.event_target_set(45.0)
+        ctrl.event_start_stop()
+        done = wait_for(ctrl, lambda: ctrl.get_motion_state() == MotionState.IDLE, 30.0)
+        self.assertIsNotNone(done)
+        position = ctrl.get_position_reg()
+
+        device.unplug()
+        run_ticks(ctrl, 0.1)
+        self.assertEqual(ctrl.get_motion_state(), MotionState.DISCONNECTED)
+        device.plug()
+        resumed = wait_for(
+            ctrl, lambda: ctrl.get_motion_state() != MotionState.DISCONNECTED, 5.0)
+        self.assertIsNotNone(resumed)
+
+        # The Tic stayed energized and kept its register
+        self.assertEqual(ctrl.get_motion_state(), MotionState.IDLE)
+        self.assertEqual(ctrl.get_position_reg(), position)
+        self.assertAlmostEqual(ctrl.get_position_angle(), 45.0, places=3)
+
+
+    def test_usb_scenario(self):
+        self.assertEqual(reconnect_scenario(self.config, 'usb'), [])
+
+
+    def test_serial_scenario(self):
+        self.assertEqual(reconnect_scenario(self.config, 'serial'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,444 @@
+import errno
+import math
+import os
+import select
+import threading
+import time
+from types import SimpleNamespace
+
+from tictransport import (
+    GET_VARIABLE, QUICK, SEVEN_BITS, TIC_T249, TicTransport,
+    open_serial_tic, tic_commands, tic_variables,
+)
+
+
+class EmulatedUSBError(OSError):
+    pass
+
+
+class EmulatedTic(object):
+    # Emulates the parts of a Tic T249 used by PololuT249, in the units of
+    # the device: positions in microsteps, speeds in microsteps per 10000 s,
+    # accelerations in microsteps per 100 s**2. The device can be unplugged
+    # and power cycled to exercise error handling.
+    def __init__(self, serial_number='00000001', command_timeout=1.0,
+                 clock=time.monotonic, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.serial_number = serial_number
+        self.command_timeout = command_timeout
+        self.clock = clock
+        self.plugged = True
+        self.generation = 0
+        self.power_on_reset()
+
+
+    def power_on_reset(self):
+        self.op_state = 2
+        self.position = 0.0
+        self.velocity = 0.0
+        self.target_position = 0
+        self.target_velocity = None
+        self.max_speed = 2000000
+        self.starting_speed = 0
+        self.max_accel = 40000
+        self.step_mode = 0
+        self.current_limit = 0
+        # Limit switch bits of the misc flags, set to simulate the inputs
+        self.limit_flags = 0
+        self.last_time = self.clock()
+        self.last_keepalive = self.last_time
+
+
+    def unplug(self):
+        # Open handles stay broken even after the device is plugged in again
+        self.plugged = False
+        self.generation += 1
+
+
+    def plug(self):
+        self.plugged = True
+
+
+    def power_cycle(self):
+        self.generation += 1
+        self.power_on_reset()
+
+
+    def advance(self):
+        now = self.clock()
+        dt = now - self.last_time
+        self.last_time = now
+
+        energized = self.op_state == 10
+        if energized and now - self.last_keepalive > self.command_timeout:
+            # Command timeout, a soft error stopping the motor
+            self.op_state = 4
+        if self.op_state not in [10, 4]:
+            self.velocity = 0.0
+            return
+
+        # Integrate in short steps, in steps/s and steps/s**2
+        accel = self.max_accel / 100
+        while dt > 0:
+            h = min(dt, 0.001)
+            dt -= h
+            v = self.velocity / 10000
+            if self.op_state == 4:
+                goal = 0.0
+            elif self.target_velocity is not None:
+                goal = self.target_velocity / 10000
+            else:
+                # Fastest speed from which the target can still be reached
+                # by decelerating, the Tic arrives without overshoot
+                remaining = self.target_position - self.position
+                top = self.max_speed / 10000
+                reachable = math.sqrt(2 * accel * abs(remaining))
+                goal = math.copysign(min(top, reachable), remaining)
+                if v * remaining > 0 and abs(v) > abs(goal):
+                    # Decelerating along the braking curve
+                    v = goal
+                if abs(v * h) >= abs(remaining) and v * remaining >= 0:
+                    self.position = float(self.target_position)
+                    self.velocity = 0.0
+                    continue
+            if v < goal:
+                v = min(goal, v + accel * h)
+            else:
+                v = max(goal, v - accel * h)
+            self.position += v * h
+            self.velocity = v * 10000
+
+
+    # Device commands and variables
+
+    def energize(self):
+        self.op_state = 10
+
+    def deenergize(self):
+        self.op_state = 2
+
+    def reset_command_timeout(self):
+        self.last_keepalive = self.clock()
+
+    def exit_safe_start(self):
+        if self.op_state == 4:
+            self.op_state = 10
+
+    def halt_and_hold(self):
+        self.velocity = 0.0
+        self.target_position = int(self.position)
+        self.target_velocity = None
+
+    def halt_and_set_position(self, position):
+        self.halt_and_hold()
+        self.position = float(position)
+        self.target_position = position
+
+    def set_target_position(self, position):
+        self.target_position = position
+        self.target_velocity = None
+
+    def set_target_velocity(self, velocity):
+        self.target_velocity = velocity
+
+    def set_max_speed(self, speed):
+        self.max_speed = speed
+
+    def set_starting_speed(self, speed):
+        self.starting_speed = speed
+
+    def set_max_acceleration(self, accel):
+        self.max_accel = accel
+
+    def set_max_deceleration(self, decel):
+        pass
+
+    def set_step_mode(self, mode):
+        self.step_mode = mode
+
+    def set_current_limit(self, limit):
+        self.current_limit = limit
+
+    def get_operation_state(self):
+        return self.op_state
+
+    def get_misc_flags(self):
+        return self.limit_flags | (1 if self.op_state == 10 else 0)
+
+    def get_current_position(self):
+        return int(self.position)
+
+    def get_current_velocity(self):
+        return int(self.velocity)
+
+    def get_target_position(self):
+        return self.target_position
+
+    def get_variables(self):
+        return {
+            'operation_state': self.op_state,
+            'misc_flags': self.get_misc_flags(),
+            'target_position': self.target_position,
+            'max_speed': self.max_speed,
+            'max_acceleration': self.max_accel,
+            'current_position': int(self.position),
+            'current_velocity': int(self.velocity),
+            'step_mode': self.step_mode,
+            'current_limit': self.current_limit,
+        }
+
+
+    def variable_block(self):
+        # The variables as laid out in the memory of the Tic
+        variables = self.get_variables()
+        end = max(offset + length for offset, length, _ in tic_variables.values())
+        block = bytearray(end)
+        for name, (offset, length, signed) in tic_variables.items():
+            block[offset:offset + length] = variables[name].to_bytes(
+                length, 'little', signed=signed)
+        return block
+
+
+class EmulatedHandle(TicTransport):
+    # An open USB connection to an emulated device, standing in for
+    # UsbTransport. Every call takes transfer_time, like a control transfer.
+    def __init__(self, device: EmulatedTic, transfer_time=0.0):
+        self._device = device
+        self._generation = device.generation
+        self._transfer_time = transfer_time
+        self.address = device.serial_number
+        self.usb = SimpleNamespace(
+            idProduct=TIC_T249,
+            serial_number=device.serial_number,
+        )
+
+
+    def __getattr__(self, name):
+        method = getattr(self._device, name)
+        device = self._device
+        generation = self._generation
+        transfer_time = self._transfer_time
+
+        def call(*args):
+            if transfer_time:
+                time.sleep(transfer_time)
+            if not device.plugged or device.generation != generation:
+                raise EmulatedUSBError(errno.ENODEV, 'No such device')
+            device.advance()
+            return method(*args)
+
+        return call
+
+
+class EmulatedBus(object):
+    # Opens emulated devices like ticlib.TicUSB opens real ones
+    def __init__(self, devices, transfer_time=0.0, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.devices = devices
+        self.transfer_time = transfer_time
+
+
+    def open(self, serial_number=None):
+        for device in self.devices:
+            if not device.plugged:
+                continue
+            if serial_number is None or device.serial_number == serial_number:
+                return EmulatedHandle(device, self.transfer_time)
+        raise Exception('USB device not found')
+
+
+class SerialTicEmulator(object):
+    # Serves an emulated device on a pseudo-terminal in the Tic serial
+    # protocol, compact or Pololu. The time the bytes take on the wire at
+    # baudrate is added to each exchange. Open port with SerialTransport.
+    def __init__(self, device: EmulatedTic, baudrate=115200, device_number=14,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import tty
+        self.device = device
+        self.device_number = device_number
+        # Start, 8 data and stop bit per byte
+        self.byte_time = 10 / baudrate
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.formats = {code: (name, fmt) for name, (code, fmt) in tic_commands.items()}
+        self.buffer = bytearray()
+
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name='tic-serial-emulator', daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            time.sleep(len(data) * self.byte_time)
+            self.buffer += data
+            response = self.execute()
+            if response:
+                time.sleep(len(response) * self.byte_time)
+                os.write(self.master, response)
+
+
+    def execute(self):
+        # Executes the complete commands in the buffer, returns the answers
+        # to the reads among them
+        response = bytearray()
+        buffer = self.buffer
+        while buffer:
+            if buffer[0] == 0xAA:
+                if len(buffer) < 3:
+                    break
+                addressed = buffer[1] == self.device_number
+                code = buffer[2] | 0x80
+                header = 3
+            elif buffer[0] & 0x80:
+                addressed = True
+                code = buffer[0]
+                header = 1
+            else:
+                # Out of frame, dropped like the Tic does
+                del buffer[0]
+                continue
+
+            if code == GET_VARIABLE:
+                name, data_length = None, 2
+            elif code in self.formats:
+                name, fmt = self.formats[code]
+                data_length = {QUICK: 0, SEVEN_BITS: 1}.get(fmt, 5)
+            else:
+                del buffer[:header]
+                continue
+            if len(buffer) < header + data_length:
+                break
+            data = bytes(buffer[header:header + data_length])
+            del buffer[:header + data_length]
+            if not addressed or not self.device.plugged:
+                continue
+
+            self.device.advance()
+            if name is None:
+                offset, length = data
+                response += self.device.variable_block()[offset:offset + length]
+            elif data_length == 0:
+                getattr(self.device, name)()
+            elif data_length == 1:
+                getattr(self.device, name)(data[0])
+            else:
+                value = bytes(
+                    b | (((data[0] >> i) & 1) << 7) for i, b in enumerate(data[1:]))
+                getattr(self.device, name)(int.from_bytes(value, 'little', signed=True))
+        return bytes(response)
+
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def run_ticks(ctrl, duration, interval=0.02):
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        ctrl.event_periodic()
+        time.sleep(interval)
+
+
+def wait_for(ctrl, condition, timeout, interval=0.02):
+    # Returns the time until condition holds, or None on timeout
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        ctrl.event_periodic()
+        if condition():
+            return time.monotonic() - start
+        time.sleep(interval)
+    return None
+
+
+def reconnect_scenario(config, transport='usb'):
+    # Drops the connection during a move and power cycles the Tic while
+    # idle, checking that work resumes with the angle reference intact
+    from enums import MotionState, TargetMode
+    from motion import MotionController
+    from motor import PololuT249
+
+    device = EmulatedTic(command_timeout=config.command_timeout)
+    if transport == 'serial':
+        emulator = SerialTicEmulator(device)
+        open_device = open_serial_tic(emulator.port, device_number=14)
+    else:
+        open_device = EmulatedBus([device]).open
+    ctrl = MotionController(PololuT249(open_device=open_device), config)
+    failures = []
+
+    ctrl.event_power()
+    ctrl.event_target_mode_set(TargetMode.ABSOLUTE)
+    ctrl.event_target_set(30.0)
+    ctrl.event_start_stop()
+    run_ticks(ctrl, 0.5)
+
+    device.unplug()
+    run_ticks(ctrl, 0.3)
+    if ctrl.get_motion_state() != MotionState.DISCONNECTED:
+        failures.append('unplugged device not reported as disconnected')
+    device.plug()
+    resumed = wait_for(
+        ctrl, lambda: ctrl.get_motion_state() != MotionState.DISCONNECTED, 5.0)
+    print(f'unplugged while moving: resumed after {resumed} s')
+    if resumed is None or resumed > 1.0:
+        failures.append('no reconnect within 1 s')
+
+    done = wait_for(
+        ctrl, lambda: ctrl.get_motion_state() == MotionState.IDLE, 30.0)
+    angle = ctrl.get_position_angle()
+    print(f'move completed: {done is not None}, at {angle:.4f} degrees')
+    if done is None or abs(angle - 30.0) > 1e-3:
+        failures.append('move did not complete at its target')
+
+    device.unplug()
+    device.power_cycle()
+    run_ticks(ctrl, 0.2)
+    device.plug()
+    resumed = wait_for(
+        ctrl, lambda: ctrl.get_motion_state() != MotionState.DISCONNECTED, 5.0)
+    angle = ctrl.get_position_angle()
+    print(f'power cycled while idle: resumed after {resumed} s, '
+          f'state {ctrl.get_motion_state().name}, at {angle:.4f} degrees')
+    if resumed is None or abs(angle - 30.0) > 1e-3:
+        failures.append('angle reference lost across power cycle')
+    if ctrl.get_motion_state() != MotionState.UNPOWERED:
+        failures.append('power cycled motor not reported as unpowered')
+
+    return failures
+
+
+def main():
+    import argparse
+    from configuration import Configuration
+
+    p = argparse.ArgumentParser('ticemu')
+    p.add_argument('-c', '--config', default='rotary.ini', help='configuration file')
+    p.add_argument('-t', '--transport', choices=['usb', 'serial'], action='append', help='transports to test, default both')
+    args = p.parse_args()
+
+    failures = []
+    for transport in args.transport or ['usb', 'serial']:
+        print(f'{transport}:')
+        failures += reconnect_scenario(Configuration(args.config), transport)
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
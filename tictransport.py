@@ -0,0 +1,268 @@
+import errno
+
+# Product id of the Tic T249
+TIC_T249 = 0x00C9
+
+# Command bytes and formats of the Tic serial and I2C protocols, see
+# https://www.pololu.com/docs/0J71/8
+QUICK = 0
+SEVEN_BITS = 1
+THIRTY_TWO_BITS = 2
+
+tic_commands = {
+    'set_target_position':   (0xE0, THIRTY_TWO_BITS),
+    'set_target_velocity':   (0xE3, THIRTY_TWO_BITS),
+    'halt_and_set_position': (0xEC, THIRTY_TWO_BITS),
+    'halt_and_hold':         (0x89, QUICK),
+    'reset_command_timeout': (0x8C, QUICK),
+    'deenergize':            (0x86, QUICK),
+    'energize':              (0x85, QUICK),
+    'exit_safe_start':       (0x83, QUICK),
+    'set_max_speed':         (0xE6, THIRTY_TWO_BITS),
+    'set_starting_speed':    (0xE5, THIRTY_TWO_BITS),
+    'set_max_acceleration':  (0xEA, THIRTY_TWO_BITS),
+    'set_max_deceleration':  (0xE9, THIRTY_TWO_BITS),
+    'set_step_mode':         (0x94, SEVEN_BITS),
+    'set_current_limit':     (0x91, SEVEN_BITS),
+}
+
+GET_VARIABLE = 0xA1
+
+# Longest block the Tic returns for one get variable command
+max_block_read = 15
+
+# Variables read by PololuT249: offset, length, signed
+tic_variables = {
+    'operation_state':  (0x00, 1, False),
+    'misc_flags':       (0x01, 1, False),
+    'target_position':  (0x0A, 4, True),
+    'max_speed':        (0x16, 4, False),
+    'max_acceleration': (0x1E, 4, False),
+    'current_position': (0x22, 4, True),
+    'current_velocity': (0x26, 4, True),
+    'step_mode':        (0x49, 1, False),
+    'current_limit':    (0x4A, 1, False),
+}
+
+
+def encode_command(code, fmt, value=0):
+    if fmt == QUICK:
+        return bytes([code])
+    elif fmt == SEVEN_BITS:
+        return bytes([code, value & 0x7F])
+    data = (value & 0xFFFFFFFF).to_bytes(4, 'little')
+    # The most significant bits of the data bytes travel in a byte of their
+    # own, every byte after the command byte is below 0x80
+    msbs = sum(((b >> 7) & 1) << i for i, b in enumerate(data))
+    return bytes([code, msbs] + [b & 0x7F for b in data])
+
+
+def encode_read(offset, length):
+    return bytes([GET_VARIABLE, offset, length])
+
+
+def decode_variable(data, offset, length, signed):
+    return int.from_bytes(data[offset:offset + length], 'little', signed=signed)
+
+
+class TicTimeoutError(OSError):
+    # The Tic did not answer, or answered short
+    pass
+
+
+class TicTransport(object):
+    # Connection to a Tic. Subclasses provide the ticlib methods used by
+    # PololuT249 and the address identifying the unit for reconnects. A
+    # pipelined transport also provides poll, which sends the commands and
+    # reads of a control tick in one round trip.
+    address = None
+    pipelined = False
+
+    def poll(self, refresh_timeout):
+        # Returns operation state, current position and current velocity
+        raise NotImplementedError('implement in subclass')
+
+
+class UsbTransport(TicTransport):
+    # ticlib.TicUSB, one control transfer per command or variable
+    def __init__(self, serial_number=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import ticlib
+        self.tic = ticlib.TicUSB(serial_number=serial_number)
+        if self.tic.usb.idProduct != TIC_T249:
+            raise RuntimeError('Unknown Pololu device')
+        self.address = self.tic.usb.serial_number
+
+
+    def __getattr__(self, name):
+        method = getattr(self.tic, name)
+
+        def call(*args):
+            try:
+                return method(*args)
+            except RuntimeError as e:
+                # ticlib reports short reads as RuntimeError
+                raise TicTimeoutError(errno.EIO, str(e)) from e
+        return call
+
+
+class SerialTransport(TicTransport):
+    # Tic on a serial port (TTL serial, or the USB virtual COM port), in the
+    # compact protocol or, with a device number, the Pololu protocol. The
+    # Tic answers commands in order and only answers reads, so the commands
+    # and reads of a tick are written at once and the answers read back
+    # together.
+    pipelined = True
+
+    def __init__(self, port, baudrate=115200, device_number=None,
+                 timeout=0.1, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import serial
+        self.port = serial.Serial(port, baudrate, timeout=timeout)
+        self.address = port
+        self.device_number = device_number
+        self.port.reset_input_buffer()
+
+        # The poll request only depends on whether the command timeout is
+        # refreshed, both variants are built once
+        reads = (
+            self.frame(encode_read(0x00, 1)) +
+            self.frame(encode_read(0x22, 8))
+        )
+        exit_safe_start = self.encode('exit_safe_start')
+        self.poll_requests = {
+            True: self.encode('reset_command_timeout') + exit_safe_start + reads,
+            False: exit_safe_start + reads,
+        }
+
+
+    def frame(self, request):
+        if self.device_number is None:
+            return request
+        # Pololu protocol: start byte, device number, command without its
+        # top bit
+        return bytes([0xAA, self.device_number, request[0] & 0x7F]) + request[1:]
+
+
+    def encode(self, name, value=0):
+        code, fmt = tic_commands[name]
+        return self.frame(encode_command(code, fmt, value))
+
+
+    def transfer(self, request, response_length):
+        self.port.write(request)
+        if response_length == 0:
+            return b''
+        response = self.port.read(response_length)
+        if len(response) != response_length:
+            # Stale answers would shift every later read, start afresh
+            self.port.reset_input_buffer()
+            raise TicTimeoutError(errno.ETIMEDOUT, 'no response from Tic')
+        return response
+
+
+    def read_block(self, offset, length):
+        # Reads any length, in as many get variable commands as needed but
+        # one round trip
+        request = b''
+        chunk_offset = offset
+        while chunk_offset < offset + length:
+            chunk = min(max_block_read, offset + length - chunk_offset)
+            request += self.frame(encode_read(chunk_offset, chunk))
+            chunk_offset += chunk
+        return self.transfer(request, length)
+
+
+    def get_variable(self, name):
+        offset, length, signed = tic_variables[name]
+        data = self.read_block(offset, length)
+        return decode_variable(data, 0, length, signed)
+
+
+    def poll(self, refresh_timeout):
+        data = self.transfer(self.poll_requests[refresh_timeout], 9)
+        return (
+            data[0],
+            decode_variable(data, 1, 4, True),
+            decode_variable(data, 5, 4, True),
+        )
+
+
+    def close(self):
+        self.port.close()
+
+
+    # Commands and variables as in ticlib
+
+    def energize(self):
+        self.transfer(self.encode('energize'), 0)
+
+    def deenergize(self):
+        self.transfer(self.encode('deenergize'), 0)
+
+    def reset_command_timeout(self):
+        self.transfer(self.encode('reset_command_timeout'), 0)
+
+    def exit_safe_start(self):
+        self.transfer(self.encode('exit_safe_start'), 0)
+
+    def halt_and_hold(self):
+        self.transfer(self.encode('halt_and_hold'), 0)
+
+    def halt_and_set_position(self, position):
+        self.transfer(self.encode('halt_and_set_position', position), 0)
+
+    def set_target_position(self, position):
+        self.transfer(self.encode('set_target_position', position), 0)
+
+    def set_target_velocity(self, velocity):
+        self.transfer(self.encode('set_target_velocity', velocity), 0)
+
+    def set_max_speed(self, speed):
+        self.transfer(self.encode('set_max_speed', speed), 0)
+
+    def set_starting_speed(self, speed):
+        self.transfer(self.encode('set_starting_speed', speed), 0)
+
+    def set_max_acceleration(self, accel):
+        self.transfer(self.encode('set_max_acceleration', accel), 0)
+
+    def set_max_deceleration(self, decel):
+        self.transfer(self.encode('set_max_deceleration', decel), 0)
+
+    def set_step_mode(self, mode):
+        self.transfer(self.encode('set_step_mode', mode), 0)
+
+    def set_current_limit(self, limit):
+        self.transfer(self.encode('set_current_limit', limit), 0)
+
+    def get_operation_state(self):
+        return self.get_variable('operation_state')
+
+    def get_misc_flags(self):
+        return self.get_variable('misc_flags')
+
+    def get_current_position(self):
+        return self.get_variable('current_position')
+
+    def get_current_velocity(self):
+        return self.get_variable('current_velocity')
+
+    def get_target_position(self):
+        return self.get_variable('target_position')
+
+    def get_variables(self):
+        # All variables used here, in one round trip
+        end = max(offset + length for offset, length, _ in tic_variables.values())
+        data = self.read_block(0, end)
+        return {
+            name: decode_variable(data, offset, length, signed)
+            for name, (offset, length, signed) in tic_variables.items()
+        }
+
+
+def open_serial_tic(port, baudrate=115200, device_number=None):
+    # Opener for PololuT249, which reopens the same port on reconnects
+    def open_device(address=None):
+        return SerialTransport(address or port, baudrate, device_number)
+    return open_device
@@ -0,0 +1,106 @@
+import math
+import time
+
+
+class TrackingMonitor(object):
+    # Compares the positions polled during a move with the trapezoidal
+    # profile planned for it: start_speed at the start, acceleration up to
+    # top speed and the same deceleration to the target, as the drivers
+    # move. Units are steps and seconds. check() is a few float operations,
+    # cheap enough for every tick.
+    #
+    # The tracking error of every sample goes into running statistics, over
+    # the current move and over all moves.
+    def __init__(self, tolerance, clock=time.monotonic, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tolerance = tolerance
+        self.clock = clock
+        self.active = False
+        self.last_error = 0.0
+
+        self.move_samples = 0
+        self.move_sum_sq = 0.0
+        self.move_max = 0.0
+        self.samples = 0
+        self.sum_sq = 0.0
+        self.max_error = 0.0
+
+
+    def start(self, start_reg, target_reg, top_speed, start_speed, acceleration):
+        dist_to_go = abs(target_reg - start_reg)
+        time_acc = (top_speed - start_speed) / acceleration
+        dist_acc = (top_speed + start_speed) * time_acc / 2
+        if 2 * dist_acc < dist_to_go:
+            time_full_speed = (dist_to_go - 2 * dist_acc) / top_speed
+        else:
+            # Decelerates before reaching top speed
+            b_over_2a = start_speed / acceleration
+            time_acc = -b_over_2a + math.sqrt(b_over_2a**2 + dist_to_go / acceleration)
+            time_full_speed = 0.0
+            dist_acc = dist_to_go / 2
+            top_speed = start_speed + time_acc * acceleration
+
+        self.start_reg = start_reg
+        self.sign = 1 if target_reg > start_reg else -1
+        self.start_speed = start_speed
+        self.acceleration = acceleration
+        self.top_speed = top_speed
+        self.t1 = time_acc
+        self.t2 = time_acc + time_full_speed
+        self.t3 = self.t2 + time_acc
+        self.d1 = dist_acc
+        self.d2 = dist_to_go - dist_acc
+        self.d3 = dist_to_go
+        self.start_time = self.clock()
+        self.move_samples = 0
+        self.move_sum_sq = 0.0
+        self.move_max = 0.0
+        self.active = True
+
+
+    def cancel(self):
+        # The profile no longer applies, e.g. after a stop
+        self.active = False
+
+
+    def planned_distance(self, t):
+        if t < self.t1:
+            return self.start_speed * t + self.acceleration * t * t / 2
+        elif t < self.t2:
+            return self.d1 + self.top_speed * (t - self.t1)
+        elif t < self.t3:
+            t_off = t - self.t2
+            return self.d2 + self.top_speed * t_off - self.acceleration * t_off * t_off / 2
+        return self.d3
+
+
+    def check(self, position):
+        # Returns False if the position is further from the plan than the
+        # tolerance
+        moved = (position - self.start_reg) * self.sign
+        error = moved - self.planned_distance(self.clock() - self.start_time)
+        self.last_error = error
+        error = abs(error)
+        self.move_samples += 1
+        self.move_sum_sq += error * error
+        if error > self.move_max:
+            self.move_max = error
+        self.samples += 1
+        self.sum_sq += error * error
+        if error > self.max_error:
+            self.max_error = error
+        return error <= self.tolerance
+
+
+    def get_move_stats(self):
+        # Samples, RMS and maximum tracking error of the current or last move
+        n = self.move_samples
+        rms = math.sqrt(self.move_sum_sq / n) if n else 0.0
+        return n, rms, self.move_max
+
+
+    def get_stats(self):
+        # As get_move_stats, over all moves
+        n = self.samples
+        rms = math.sqrt(self.sum_sq / n) if n else 0.0
+        return n, rms, self.max_error
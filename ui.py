@@ -1,8 +1,17 @@
-from PyQt5 import QtGui
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
-from enums import TargetMode, MotionState, Direction, DivMode
+from PyQt5.QtCore import (
+    QLineF, QPointF, QRectF, QSignalBlocker, QSize, QTimer, Qt, pyqtSignal,
+    pyqtSlot,
+)
+from PyQt5.QtGui import (
+    QBrush, QColor, QKeySequence, QPaintEvent, QPainter, QPen, QPolygonF,
+)
+from PyQt5.QtWidgets import (
+    QAbstractItemView, QAbstractSpinBox, QApplication, QComboBox, QDialog,
+    QDialogButtonBox, QDoubleSpinBox, QGridLayout, QInputDialog, QLabel,
+    QMainWindow, QProgressBar, QPushButton, QShortcut, QSpinBox,
+    QStackedWidget, QTableWidget, QTableWidgetItem, QVBoxLayout, QWidget,
+)
+from enums import TargetMode, MotionState, Direction
 import math
 import sys
 
@@ -220,11 +229,16 @@ class Progress(QProgressBar):
                 background-color: lightgreen;
             }'''
 
+        self.styled_enabled = None
         self.setEnabled(False)
 
 
     def setEnabled(self, enabled):
         super().setEnabled(enabled)
+        if enabled == self.styled_enabled:
+            # Setting a style sheet repolishes and repaints synchronously
+            return
+        self.styled_enabled = enabled
         if enabled:
             self.setStyleSheet(self.enabled_stylesheet)
             self.setTextVisible(True)
@@ -375,6 +389,10 @@ class MainWindow(QMainWindow):
     ccw_pressed = pyqtSignal()
     power_pressed = pyqtSignal()
     start_stop_pressed = pyqtSignal()
+    stats_requested = pyqtSignal()
+    home_requested = pyqtSignal()
+    job_pause_requested = pyqtSignal()
+    job_restart_requested = pyqtSignal(int)
 
 
     def __init__(self, *args, **kwargs):
@@ -382,10 +400,16 @@ class MainWindow(QMainWindow):
 
         self.mode_map = {i: m for i, m in enumerate(TargetMode)}
 
-        self.setWindowTitle('Martins snurrbord')
+        self.title = 'Martins snurrbord'
+        self.disconnected = False
+        self.fault = None
+        self.setWindowTitle(self.title)
         self.create_widgets()
         self.create_layout()
-        self.create_division_dialog()
+        # Dialogs are built on first use
+        self.division_dialog = None
+        self.div_parameters = (2, 0.0, 360.0)
+        self.stats_dialog = None
         self.create_internal_connections()
         self.create_external_signals()
 
@@ -394,6 +418,9 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot(TargetMode)
     def target_mode_updated(self, mode):
+        index = list(TargetMode).index(mode)
+        with QSignalBlocker(self.mode_combo):
+            self.mode_combo.setCurrentIndex(index)
         self.setup_current_mode(mode)
 
 
@@ -435,6 +462,9 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot(int, float, float, list)
     def div_parameters_updated(self, num, start, extent):
+        self.div_parameters = num, start, extent
+        if self.division_dialog is None:
+            return
         with QSignalBlocker(self.div_num_spinbox):
             self.div_num_spinbox.setValue(num)
         with QSignalBlocker(self.div_start_spinbox):
@@ -467,6 +497,11 @@ class MainWindow(QMainWindow):
             self.speed_spinbox.setRange(min_speed, max_speed)
 
 
+    def set_axis_name(self, name):
+        self.title = f'Martins snurrbord - {name}'
+        self.setWindowTitle(self.title)
+
+
     @pyqtSlot(MotionState)
     def motion_state_updated(self, state):
         if state == MotionState.UNPOWERED:
@@ -484,7 +519,13 @@ class MainWindow(QMainWindow):
         elif state == MotionState.STOPPING:
             p, e, v = True, False, False
             inp = False
+        elif state == MotionState.DISCONNECTED:
+            p, e, v = False, False, True
+            inp = False
 
+        self.disconnected = state == MotionState.DISCONNECTED
+        self.update_title()
+        self.energize_button.setEnabled(state != MotionState.DISCONNECTED)
         self.energize_button.powered = p
         self.start_stop_button.enabled = e
         self.start_stop_button.start_visible = v
@@ -505,12 +546,63 @@ class MainWindow(QMainWindow):
             f.setEnabled(inp)
 
 
+    def fault_updated(self, fault):
+        self.fault = fault
+        self.update_title()
+
+
+    def update_title(self):
+        if self.disconnected:
+            self.setWindowTitle(f'{self.title} - motor disconnected, reconnecting')
+        elif self.fault is not None:
+            self.setWindowTitle(f'{self.title} - fault: {self.fault}')
+        else:
+            self.setWindowTitle(self.title)
+
+
     @pyqtSlot(bool, int)
     def progress_updated(self, enabled, progress):
         self.progress.setEnabled(enabled)
         self.progress.setValue(progress)
 
 
+    @pyqtSlot(list, int, float, int)
+    def stats_updated(self, rows, ticks, mean_transfers, max_transfers):
+        if self.stats_dialog is None:
+            self.create_stats_dialog()
+
+        table = self.stats_table
+        table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            name, count, p50, p99, peak, errors, timeouts = row
+            values = [
+                name,
+                str(count),
+                f'{p50:.0f}',
+                f'{p99:.0f}',
+                f'{peak:.0f}',
+                str(errors),
+                str(timeouts),
+            ]
+            for c, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if c > 0:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                table.setItem(r, c, item)
+        table.resizeColumnsToContents()
+
+        if rows:
+            text = (f'{ticks} ticks, {mean_transfers:.1f} transfers per tick '
+                    f'on average, {max_transfers} at most')
+        else:
+            text = 'Device call statistics are not enabled'
+        self.stats_label.setText(text)
+
+        if not self.stats_dialog.isVisible():
+            self.stats_dialog.show()
+            self.stats_timer.start()
+
+
     @pyqtSlot(TargetMode)
     def internal_mode_select(self, mode):
         self.setup_current_mode(mode)
@@ -519,10 +611,14 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def show_division_dialog(self):
+        if self.division_dialog is None:
+            self.create_division_dialog()
+            self.div_parameters_updated(*self.div_parameters)
         if self.division_dialog.exec():
             num = self.div_num_spinbox.value()
             start = self.div_start_spinbox.value()
             extent = self.div_extent_spinbox.value()
+            self.div_parameters = num, start, extent
             self.div_parameters_set.emit(num, start, extent)
 
 
@@ -585,56 +681,15 @@ class MainWindow(QMainWindow):
         self.div_tgt_spinbox.setRange(1, 2)
         self.div_tgt_spinbox.setWrapping(True)
 
-        # In division dialog
-        self.div_num_spinbox = QSpinBox()
-        self.div_num_spinbox.setRange(2, 1000)
-
-        self.div_start_spinbox = QDoubleSpinBox()
-        self.div_start_spinbox.setSuffix('°')
-        self.div_start_spinbox.setDecimals(3)
-        self.div_start_spinbox.setRange(0, 359.999)
-
-        self.div_extent_spinbox = QDoubleSpinBox()
-        self.div_extent_spinbox.setSuffix('°')
-        self.div_extent_spinbox.setDecimals(3)
-        self.div_extent_spinbox.setRange(0.001, 360)
-
         all_spinboxes = [
             self.position_spinbox,
             self.speed_spinbox,
             self.abs_tgt_spinbox,
             self.rel_tgt_spinbox,
             self.div_tgt_spinbox,
-            self.div_num_spinbox,
-            self.div_start_spinbox,
-            self.div_extent_spinbox,
         ]
         for s in all_spinboxes:
-            s.setStyleSheet('''
-                QDoubleSpinBox::up-button {
-                    width: 24px;
-                }
-                QDoubleSpinBox::down-button {
-                    width: 24px;
-                }
-                QDoubleSpinBox {
-                    font-size: 36px;
-                    padding-right: 16px;
-                }
-                QSpinBox::up-button {
-                    width: 24px;
-                }
-                QSpinBox::down-button {
-                    width: 24px;
-                }
-                QSpinBox {
-                    font-size: 36px;
-                    padding-right: 16px;
-                }
-                ''')
-            s.setAlignment(Qt.AlignRight)
-            s.setFixedHeight(64)
-            s.setButtonSymbols(QAbstractSpinBox.NoButtons)
+            self.style_spinbox(s)
 
         # Mode switcher
         self.mode_combo = EnumCombo(TargetMode)
@@ -653,33 +708,52 @@ class MainWindow(QMainWindow):
         self.speed_label = QLabel('&Speed')
         self.speed_label.setBuddy(self.speed_spinbox)
 
-        # In division dialog
-        self.div_num_label = QLabel('&Number of divisions')
-        self.div_num_label.setBuddy(self.div_num_spinbox)
-
-        self.div_start_label = QLabel('&Start angle')
-        self.div_start_label.setBuddy(self.div_start_spinbox)
-
-        self.div_extent_label = QLabel('E&xtent angle')
-        self.div_extent_label.setBuddy(self.div_extent_spinbox)
-
         all_labels = [
             self.mode_label,
             self.position_label,
             self.target_label,
             self.speed_label,
-            self.div_num_label,
-            self.div_start_label,
-            self.div_extent_label,
         ]
         for l in all_labels:
-            l.setStyleSheet('font-size: 16px')
-            l.setAlignment(Qt.AlignHCenter)
+            self.style_label(l)
 
         # Position rose
         self.position_rose = PositionWidget()
 
 
+    def style_spinbox(self, s):
+        s.setStyleSheet('''
+                QDoubleSpinBox::up-button {
+                    width: 24px;
+                }
+                QDoubleSpinBox::down-button {
+                    width: 24px;
+                }
+                QDoubleSpinBox {
+                    font-size: 36px;
+                    padding-right: 16px;
+                }
+                QSpinBox::up-button {
+                    width: 24px;
+                }
+                QSpinBox::down-button {
+                    width: 24px;
+                }
+                QSpinBox {
+                    font-size: 36px;
+                    padding-right: 16px;
+                }
+                ''')
+        s.setAlignment(Qt.AlignRight)
+        s.setFixedHeight(64)
+        s.setButtonSymbols(QAbstractSpinBox.NoButtons)
+
+
+    def style_label(self, l):
+        l.setStyleSheet('font-size: 16px')
+        l.setAlignment(Qt.AlignHCenter)
+
+
     def create_layout(self):
         # Create the sublayout for the division mode
         div_layout = QGridLayout()
@@ -740,6 +814,33 @@ class MainWindow(QMainWindow):
 
 
     def create_division_dialog(self):
+        self.div_num_spinbox = QSpinBox()
+        self.div_num_spinbox.setRange(2, 1000)
+
+        self.div_start_spinbox = QDoubleSpinBox()
+        self.div_start_spinbox.setSuffix('°')
+        self.div_start_spinbox.setDecimals(3)
+        self.div_start_spinbox.setRange(0, 359.999)
+
+        self.div_extent_spinbox = QDoubleSpinBox()
+        self.div_extent_spinbox.setSuffix('°')
+        self.div_extent_spinbox.setDecimals(3)
+        self.div_extent_spinbox.setRange(0.001, 360)
+
+        self.div_num_label = QLabel('&Number of divisions')
+        self.div_num_label.setBuddy(self.div_num_spinbox)
+
+        self.div_start_label = QLabel('&Start angle')
+        self.div_start_label.setBuddy(self.div_start_spinbox)
+
+        self.div_extent_label = QLabel('E&xtent angle')
+        self.div_extent_label.setBuddy(self.div_extent_spinbox)
+
+        for s in [self.div_num_spinbox, self.div_start_spinbox, self.div_extent_spinbox]:
+            self.style_spinbox(s)
+        for l in [self.div_num_label, self.div_start_label, self.div_extent_label]:
+            self.style_label(l)
+
         dialog = QDialog()
         dialog.setWindowTitle('Division parameters')
         dialog.setModal(Qt.ApplicationModal)
@@ -764,9 +865,53 @@ class MainWindow(QMainWindow):
         self.division_dialog = dialog
 
 
+    def create_stats_dialog(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle('Device call statistics')
+
+        headers = [
+            'Call', 'Count', 'p50 µs', 'p99 µs', 'Max µs', 'Errors', 'Timeouts',
+        ]
+        self.stats_table = QTableWidget(0, len(headers))
+        self.stats_table.setHorizontalHeaderLabels(headers)
+        self.stats_table.verticalHeader().setVisible(False)
+        self.stats_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.stats_label = QLabel()
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.stats_table)
+        layout.addWidget(self.stats_label)
+        dialog.setLayout(layout)
+        dialog.resize(640, 360)
+
+        # Refresh while visible
+        self.stats_timer = QTimer(dialog)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.stats_requested)
+        dialog.finished.connect(self.stats_timer.stop)
+
+        self.stats_dialog = dialog
+
+
+    @pyqtSlot()
+    def show_job_restart_dialog(self):
+        step, ok = QInputDialog.getInt(
+            self, 'Restart job', 'Restart the job at step', 1, 1, 1000000)
+        if ok:
+            self.job_restart_requested.emit(step)
+
+
     def create_internal_connections(self):
         self.mode_combo.itemActivated.connect(self.internal_mode_select)
         self.div_setup_button.pressed.connect(self.show_division_dialog)
+        self.stats_shortcut = QShortcut(QKeySequence('F2'), self)
+        self.stats_shortcut.activated.connect(self.stats_requested)
+        self.home_shortcut = QShortcut(QKeySequence('Ctrl+H'), self)
+        self.home_shortcut.activated.connect(self.home_requested)
+        self.job_pause_shortcut = QShortcut(QKeySequence('Ctrl+P'), self)
+        self.job_pause_shortcut.activated.connect(self.job_pause_requested)
+        self.job_restart_shortcut = QShortcut(QKeySequence('Ctrl+J'), self)
+        self.job_restart_shortcut.activated.connect(self.show_job_restart_dialog)
 
 
     def create_external_signals(self):
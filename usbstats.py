@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+
+
+class LatencyHistogram(object):
+    # Log-linear histogram of nanosecond values in the style of HdrHistogram.
+    # Each power of two is split into 16 buckets, so values are resolved to
+    # within about 6 %.
+    sub_bits = 4
+    sub_count = 1 << sub_bits
+    num_buckets = 64 * sub_count
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = [0] * self.num_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def record(self, value):
+        if value < self.sub_count:
+            index = value
+        else:
+            exp = value.bit_length() - self.sub_bits - 1
+            sub = (value >> exp) & (self.sub_count - 1)
+            index = (exp + 1) * self.sub_count + sub
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def bucket_upper(self, index):
+        if index < self.sub_count:
+            return index + 1
+        exp = index // self.sub_count - 1
+        sub = index % self.sub_count
+        return (self.sub_count + sub + 1) << exp
+
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        threshold = p / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= threshold:
+                return min(self.bucket_upper(index), self.max)
+        return self.max
+
+
+    def cumulative_below(self, limits):
+        # Number of values in buckets entirely at or below each limit
+        result = []
+        cumulative = 0
+        index = 0
+        for limit in limits:
+            while index < self.num_buckets and self.bucket_upper(index) <= limit:
+                cumulative += self.counts[index]
+                index += 1
+            result.append(cumulative)
+        return result
+
+
+class CallStats(object):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.timeouts = 0
+
+
+class DeviceStats(object):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = {}
+        self.ticks = 0
+        self.tick_transfers = 0
+        self.transfers_per_tick = LatencyHistogram()
+
+
+    def get_call(self, name):
+        if name not in self.calls:
+            self.calls[name] = CallStats()
+        return self.calls[name]
+
+
+    def tick(self):
+        self.ticks += 1
+        self.transfers_per_tick.record(self.tick_transfers)
+        self.tick_transfers = 0
+
+
+    def get_rows(self):
+        # (call, count, p50 us, p99 us, max us, errors, timeouts)
+        rows = []
+        for name, call in sorted(list(self.calls.items())):
+            h = call.latency
+            rows.append((
+                name,
+                h.count,
+                h.percentile(50) / 1000,
+                h.percentile(99) / 1000,
+                h.max / 1000,
+                call.errors,
+                call.timeouts,
+            ))
+        return rows
+
+
+    def get_tick_summary(self):
+        h = self.transfers_per_tick
+        mean = h.total / h.count if h.count else 0
+        return self.ticks, mean, h.max
+
+
+    def prometheus_text(self):
+        limits_s = [
+            0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+            0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+        ]
+        limits_ns = [int(s * 1e9) for s in limits_s]
+
+        lines = [
+            '# HELP rotary_tic_call_duration_seconds Tic USB call latency',
+            '# TYPE rotary_tic_call_duration_seconds histogram',
+        ]
+        calls = sorted(list(self.calls.items()))
+        for name, call in calls:
+            h = call.latency
+            below = h.cumulative_below(limits_ns)
+            for limit, count in zip(limits_s, below):
+                lines.append(
+                    f'rotary_tic_call_duration_seconds_bucket'
+                    f'{{call="{name}",le="{limit}"}} {count}')
+            lines.append(
+                f'rotary_tic_call_duration_seconds_bucket'
+                f'{{call="{name}",le="+Inf"}} {h.count}')
+            lines.append(
+                f'rotary_tic_call_duration_seconds_sum'
+                f'{{call="{name}"}} {h.total / 1e9}')
+            lines.append(
+                f'rotary_tic_call_duration_seconds_count'
+                f'{{call="{name}"}} {h.count}')
+
+        lines.append('# HELP rotary_tic_call_errors_total Tic USB calls raising an error')
+        lines.append('# TYPE rotary_tic_call_errors_total counter')
+        for name, call in calls:
+            lines.append(f'rotary_tic_call_errors_total{{call="{name}"}} {call.errors}')
+
+        lines.append('# HELP rotary_tic_call_timeouts_total Tic USB calls timing out')
+        lines.append('# TYPE rotary_tic_call_timeouts_total counter')
+        for name, call in calls:
+            lines.append(f'rotary_tic_call_timeouts_total{{call="{name}"}} {call.timeouts}')
+
+        h = self.transfers_per_tick
+        lines.append('# HELP rotary_tic_transfers_per_tick USB transfers per control tick')
+        lines.append('# TYPE rotary_tic_transfers_per_tick summary')
+        for q in [0.5, 0.9, 0.99]:
+            value = h.percentile(q * 100)
+            lines.append(f'rotary_tic_transfers_per_tick{{quantile="{q}"}} {value}')
+        lines.append(f'rotary_tic_transfers_per_tick_sum {h.total}')
+        lines.append(f'rotary_tic_transfers_per_tick_count {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, filename):
+        # Written to a temporary file and renamed, so a collector never reads
+        # a partial file
+        tmp_name = filename + '.tmp'
+        with open(tmp_name, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_name, filename)
+
+
+class InstrumentedDevice(object):
+    # Wraps a ticlib device, timing every method call
+    def __init__(self, device, stats: DeviceStats):
+        self._device = device
+        self._stats = stats
+        self._wrappers = {}
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if not callable(attr):
+            return attr
+        if name not in self._wrappers:
+            self._wrappers[name] = self._wrap(name, attr)
+        return self._wrappers[name]
+
+
+    def _wrap(self, name, method):
+        stats = self._stats
+        call = stats.get_call(name)
+        record = call.latency.record
+        clock = time.perf_counter_ns
+
+        def wrapper(*args, **kwargs):
+            stats.tick_transfers += 1
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if is_timeout(e):
+                    call.timeouts += 1
+                else:
+                    call.errors += 1
+                raise
+            finally:
+                record(clock() - start)
+
+        return wrapper
+
+
+def is_timeout(e):
+    return 'Timeout' in type(e).__name__ or getattr(e, 'errno', None) == 110
+
+
+class PrometheusExporter(object):
+    def __init__(self, stats: DeviceStats, filename, interval=10.0,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+        self.filename = filename
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.stats.write_prometheus(self.filename)
+
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.stats.write_prometheus(self.filename)